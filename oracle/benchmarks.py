@@ -0,0 +1,474 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Accuracy and speed benchmarks for oracle components. """
+
+from __future__ import division, absolute_import, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+__all__ = ["photosphere_interpolation", "ccf_peak_refinement"]
+
+# Standard library.
+import logging
+import multiprocessing
+from time import time
+
+# Third-party.
+import numpy as np
+from scipy.spatial import Delaunay
+
+# Module-specific.
+from oracle import photospheres
+from oracle.specutils import cross_correlate
+from oracle.photospheres.interpolator import BaseInterpolator, \
+    resample_photosphere, _protect_qhull, _recarray_to_array
+
+logger = logging.getLogger("oracle")
+
+# The photosphere interpolator for each worker process, and the structures that
+# are calculated once for the cached-simplex and multilinear methods.
+_interpolator = None
+_triangulation = None
+_regular_grid = None
+
+
+def _initialise_interpolator(kind, kwargs):
+    global _interpolator
+    _interpolator = photospheres.interpolator(kind=kind, **kwargs)
+
+
+def _grid_coordinates():
+    """
+    Return the stellar parameters of the photosphere grid, without any that
+    have a single value.
+    """
+    points = _recarray_to_array(_interpolator.stellar_parameters)
+    return points[:, _protect_qhull(points)]
+
+
+def _initialise_methods(methods):
+    """
+    Triangulate the grid for the cached-simplex method, and index it for the
+    multilinear method. This is done once, before any workers are forked.
+    """
+
+    global _triangulation, _regular_grid
+
+    points = _grid_coordinates()
+    if "cached-simplex" in methods:
+        # Rescale the points like the griddata methods do.
+        t_init = time()
+        _triangulation = Delaunay((points - points.min(axis=0)) \
+            / np.ptp(points, axis=0))
+        logger.info("Triangulated {0} photospheres in {1:.1f} seconds".format(
+            len(points), time() - t_init))
+
+    if "multilinear" in methods:
+        _regular_grid = ([np.unique(column) for column in points.T],
+            dict([(tuple(point), i) for i, point in enumerate(points)]))
+
+
+def _weighted_photosphere(indices, weights):
+    """
+    Interpolate a photosphere as a weighted sum of grid photospheres, in the
+    same way as the griddata methods: the photospheres are resampled onto the
+    interpolated opacity scale, and logarithmic quantities are summed in log
+    space.
+    """
+
+    quantities = _interpolator.photospheric_quantities
+    neighbours = np.array(_interpolator.photospheres[indices], dtype=float)
+    if _interpolator.opacity_scale is not None:
+        opacity_index = quantities.index(_interpolator.opacity_scale)
+        opacities = np.dot(weights, neighbours[:, :, opacity_index])
+        neighbours = np.array([resample_photosphere(opacities, neighbour,
+            opacity_index) for neighbour in neighbours])
+
+    logarithmic = [quantities.index(quantity) for quantity in \
+        _interpolator.logarithmic_photosphere_quantities \
+        if quantity in quantities]
+    neighbours[:, :, logarithmic] = np.log10(neighbours[:, :, logarithmic])
+    interpolated = np.tensordot(weights, neighbours, axes=1)
+    interpolated[:, logarithmic] = 10**interpolated[:, logarithmic]
+    return interpolated
+
+
+def _barycentric(triangulation, point):
+    """
+    Return the vertices of the simplex that contains a point, and the
+    barycentric weights of the point (as used by
+    :class:`scipy.interpolate.LinearNDInterpolator`).
+    """
+
+    simplex = triangulation.find_simplex(point)
+    if simplex < 0:
+        raise ValueError("point {} is outside of the triangulation".format(
+            point))
+
+    transform = triangulation.transform[simplex]
+    weights = np.dot(transform[:-1], point - transform[-1])
+    return (triangulation.simplices[simplex], np.append(weights,
+        1 - weights.sum()))
+
+
+def _cached_simplex(index):
+    """
+    Interpolate the photosphere of a grid model from the simplex that contains
+    it when the model is removed from the cached triangulation of the grid.
+
+    Removing a model only changes the simplices around it, which are replaced
+    by the triangulation of its neighbouring vertices. The latency is that of a
+    query against the cached triangulation of the full grid, which is how the
+    method would be used.
+    """
+
+    point = _triangulation.points[index]
+
+    t_init = time()
+    _weighted_photosphere(*_barycentric(_triangulation, point))
+    latency = time() - t_init
+
+    indptr, neighbours = _triangulation.vertex_neighbor_vertices
+    neighbours = neighbours[indptr[index]:indptr[index + 1]]
+    vertices, weights = _barycentric(
+        Delaunay(_triangulation.points[neighbours]), point)
+    return (_weighted_photosphere(neighbours[vertices], weights), latency)
+
+
+def _multilinear_weights(axes, lookup, point):
+    """
+    Return the grid models at the corners of the cell that contains a point,
+    and their multilinear interpolation weights (as used by
+    :class:`scipy.interpolate.RegularGridInterpolator`). Corners with no weight
+    are excluded.
+    """
+
+    corners, weights = [()], np.ones(1)
+    for axis, value in zip(axes, point):
+        i = axis.searchsorted(value)
+        if i < axis.size and axis[i] == value:
+            nodes = [(value, 1.)]
+        elif 0 < i < axis.size:
+            t = (value - axis[i - 1])/(axis[i] - axis[i - 1])
+            nodes = [(axis[i - 1], 1 - t), (axis[i], t)]
+        else:
+            raise ValueError("point {} is outside of the grid".format(point))
+
+        corners = [corner + (node, ) for corner in corners \
+            for node, weight in nodes]
+        weights = np.outer(weights,
+            [weight for node, weight in nodes]).flatten()
+
+    try:
+        indices = [lookup[corner] \
+            for corner, weight in zip(corners, weights) if weight > 0]
+    except KeyError:
+        raise ValueError("the grid has no model at a corner of the cell that "
+            "contains {}".format(point))
+    return (np.array(indices), weights[weights > 0])
+
+
+def _multilinear(index):
+    """
+    Interpolate the photosphere of a grid model by multilinear interpolation on
+    the regular grid without its effective temperature (the first stellar
+    parameter). The models at the grid's edges in effective temperature, or
+    next to missing models, cannot be interpolated.
+    """
+
+    axes, lookup = _regular_grid
+    point = _grid_coordinates()[index]
+
+    t_init = time()
+    indices, weights = _multilinear_weights(
+        [axes[0][axes[0] != point[0]]] + axes[1:], lookup, point)
+    interpolated = _weighted_photosphere(indices, weights)
+    return (interpolated, time() - t_init)
+
+
+def _leave_one_out(args):
+    """
+    Interpolate the photosphere at the grid point with the given index while
+    ignoring the model at that grid point, and return the difference between
+    the interpolated and the actual photospheric structure.
+    """
+
+    index, method = args
+    _interpolator.method = method
+
+    # Interpolate at the full grid point (including any additional dimensions,
+    # like MARCS geometry) so that sub-class behaviour does not move the point.
+    point = list(_interpolator.stellar_parameters[index])
+    expected = _interpolator.photospheres[index]
+
+    try:
+        if method == "cached-simplex":
+            interpolated, latency = _cached_simplex(index)
+
+        elif method == "multilinear":
+            interpolated, latency = _multilinear(index)
+
+        else:
+            t_init = time()
+            photosphere = BaseInterpolator.interpolate(_interpolator, *point,
+                __ignore_nearest=True)
+            latency = time() - t_init
+            interpolated = np.array([photosphere[quantity] \
+                for quantity in _interpolator.photospheric_quantities]).T
+
+    # Qhull errors (e.g., from coplanar neighbours) are RuntimeErrors.
+    except (ValueError, RuntimeError, np.linalg.LinAlgError) as e:
+        logger.debug("Could not interpolate photosphere {0} at {1}: {2}"\
+            .format(index, point, e))
+        return (index, np.nan * np.ones(expected.shape), np.nan)
+
+    difference = interpolated - expected
+
+    # Compare logarithmic quantities in the same space that they are
+    # interpolated in.
+    for quantity in _interpolator.logarithmic_photosphere_quantities:
+        try:
+            i = _interpolator.photospheric_quantities.index(quantity)
+        except ValueError:
+            continue
+        difference[:, i] = np.log10(interpolated[:, i]/expected[:, i])
+
+    return (index, difference, latency)
+
+
+def photosphere_interpolation(kind="marcs", methods=("linear", "nearest",
+    "cached-simplex", "multilinear"), threads=1, percentiles=(50, 90, 99),
+    indices=None, **kwargs):
+    """
+    Perform a leave-one-out test for every model in a grid of photospheres.
+
+    Each model is removed from the grid in turn and the photospheric structure
+    is interpolated at the stellar parameters of that model from the remaining
+    neighbours. The difference between the interpolated and the actual
+    structure is recorded at every depth for every photospheric quantity,
+    along with the time taken for each interpolation.
+
+    :param kind: [optional]
+        The kind of model photospheres to benchmark.
+
+    :type kind:
+        str
+
+    :param methods: [optional]
+        The interpolation methods to benchmark. The 'cached-simplex' method
+        interpolates across a Delaunay triangulation of the whole grid that is
+        calculated once, and 'multilinear' interpolates across the cells of the
+        regular grid (leaving out every model with the same effective
+        temperature). Other methods are passed to
+        :func:`scipy.interpolate.griddata`, where 'linear' calculates a Qhull
+        Delaunay triangulation of the neighbouring points for every call.
+
+    :type methods:
+        tuple of str
+
+    :param threads: [optional]
+        The number of worker processes to use.
+
+    :type threads:
+        int
+
+    :param percentiles: [optional]
+        The percentiles to report for the errors and the per-call latency.
+
+    :type percentiles:
+        tuple
+
+    :param indices: [optional]
+        The indices of the models to leave out. By default every model in the
+        grid is used.
+
+    :type indices:
+        list of int
+
+    :returns:
+        A dictionary containing the results for each interpolation method. For
+        every method there are absolute error percentiles with shape
+        (N_percentiles, N_depth, N_quantities), the latency percentiles in
+        seconds, the raw differences and latencies, the number of models that
+        could not be interpolated, and the number of non-finite differences in
+        the models that could. Non-finite differences are ignored in the
+        percentiles.
+
+    :rtype:
+        dict
+    """
+
+    # Failures must be recorded, not replaced by the (left out) nearest model.
+    kwargs["live_dangerously"] = False
+    _initialise_interpolator(kind, kwargs)
+    _initialise_methods(methods)
+
+    N = len(_interpolator.stellar_parameters)
+    indices = np.arange(N) if indices is None else np.array(indices)
+    quantities = _interpolator.photospheric_quantities
+
+    # Worker processes inherit the interpolator when they are forked.
+    pool = multiprocessing.Pool(threads) if threads > 1 else None
+
+    results = {}
+    for method in methods:
+        logger.info("Running leave-one-out test for {0} {1} photospheres with"
+            " {2} interpolation".format(indices.size, kind, method))
+
+        args = [(index, method) for index in indices]
+        t_init = time()
+        if pool is None:
+            output = map(_leave_one_out, args)
+        else:
+            output = pool.map(_leave_one_out, args,
+                chunksize=max(1, int(len(args)/(4 * threads))))
+        t_taken = time() - t_init
+
+        differences = np.array([each[1] for each in output])
+        latencies = np.array([each[2] for each in output])
+        failed = ~np.isfinite(latencies)
+
+        absolute_differences = np.abs(differences[~failed])
+        non_finite = ~np.isfinite(absolute_differences)
+        absolute_differences[non_finite] = np.nan
+
+        results[method] = {
+            "indices": indices,
+            "quantities": quantities,
+            "percentiles": percentiles,
+            "differences": differences,
+            "latencies": latencies,
+            "failed": failed.sum(),
+            "non_finite": non_finite.sum(),
+            "time_taken": t_taken,
+            "error_percentiles": np.nanpercentile(absolute_differences,
+                percentiles, axis=0) if absolute_differences.size \
+                else np.nan * np.ones([len(percentiles)] + \
+                    list(differences.shape[1:])),
+            "latency_percentiles": np.nanpercentile(latencies[~failed],
+                percentiles) if np.any(~failed) \
+                else np.nan * np.ones(len(percentiles))
+        }
+
+        # Summarise.
+        latency_text = ", ".join(["p{0:.0f} = {1:.2f} ms".format(p, 1e3 * v) \
+            for p, v in zip(percentiles, results[method]["latency_percentiles"])])
+        logger.info("Interpolation latency with {0} method: {1} ({2} of {3} "
+            "failed, {4} non-finite differences)".format(method, latency_text,
+                failed.sum(), failed.size, non_finite.sum()))
+        for i, quantity in enumerate(quantities):
+            # Report the worst depth for each percentile.
+            error_text = ", ".join(["p{0:.0f} = {1:.2e}".format(p, v) \
+                for p, v in zip(percentiles, np.nanmax(
+                    results[method]["error_percentiles"][:, :, i], axis=1))])
+            logger.info("Maximum absolute error in {0} across all depths with "
+                "{1} method: {2}".format(quantity, method, error_text))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+def ccf_peak_refinement(methods=("fit", "gaussian", "parabolic"),
+    num_ccfs=1000, num_pixels=401, noise=0.01, percentiles=(50, 90, 99),
+    seed=None):
+    """
+    Compare the accuracy and speed of the methods that re-measure the highest
+    peak of cross-correlation functions, using synthetic Gaussian peaks with
+    known sub-pixel positions and widths.
+
+    :param methods: [optional]
+        The peak re-measurement methods to benchmark (see
+        :func:`oracle.specutils.cross_correlate.cross_correlate_grid`).
+
+    :type methods:
+        tuple of str
+
+    :param num_ccfs: [optional]
+        The number of synthetic cross-correlation functions.
+
+    :type num_ccfs:
+        int
+
+    :param num_pixels: [optional]
+        The number of pixels in each cross-correlation function.
+
+    :type num_pixels:
+        int
+
+    :param noise: [optional]
+        The standard deviation of the noise added to each (unit height) peak.
+
+    :type noise:
+        float
+
+    :param percentiles: [optional]
+        The percentiles to report for the absolute errors.
+
+    :type percentiles:
+        tuple
+
+    :param seed: [optional]
+        The seed for the random number generator.
+
+    :type seed:
+        int
+
+    :returns:
+        A dictionary containing the results for each method: the time taken per
+        cross-correlation function, the velocity and velocity width errors (in
+        km/s), and the percentiles of the absolute errors.
+
+    :rtype:
+        dict
+    """
+
+    c = 299792.458 # km/s
+    random = np.random.RandomState(seed)
+
+    # A CCF sampled like a typical log-linear spectrum (~1.3 km/s per pixel).
+    dz = 1.3/c
+    z_array = dz * (np.arange(num_pixels) - num_pixels//2)
+
+    x = np.arange(num_pixels)
+    centres = num_pixels//2 + random.uniform(-20, 20, size=num_ccfs)
+    stddevs = random.uniform(0.5, 1.5, size=num_ccfs)
+    ccfs = np.exp(-0.5 * ((x - centres[:, None])/stddevs[:, None])**2) \
+        + 0.05 + random.normal(0, noise, size=(num_ccfs, num_pixels))
+    heights = ccfs.max(axis=1)
+
+    true_v = c * np.interp(centres, x, z_array)
+    true_width = c * stddevs * dz
+
+    results = {}
+    for method in methods:
+        t_init = time()
+        z, z_width = cross_correlate._remeasure_peaks(z_array, ccfs, heights,
+            method)
+        t_taken = time() - t_init
+
+        v_errors = c * np.array(z) - true_v
+        width_errors = c * np.array(z_width) - true_width
+        results[method] = {
+            "time_per_ccf": t_taken/num_ccfs,
+            "velocity_errors": v_errors,
+            "width_errors": width_errors,
+            "percentiles": percentiles,
+            "velocity_error_percentiles": np.percentile(np.abs(v_errors),
+                percentiles),
+            "width_error_percentiles": np.percentile(np.abs(width_errors),
+                percentiles)
+        }
+
+        logger.info("Peak re-measurement with {0} method took {1:.3f} ms per "
+            "CCF. Absolute velocity errors: {2}. Absolute width errors: {3}"\
+            .format(method, 1e3 * t_taken/num_ccfs,
+                ", ".join(["p{0:.0f} = {1:.3f} km/s".format(p, v) for p, v in \
+                    zip(percentiles, results[method]["velocity_error_percentiles"])]),
+                ", ".join(["p{0:.0f} = {1:.3f} km/s".format(p, v) for p, v in \
+                    zip(percentiles, results[method]["width_error_percentiles"])])))
+
+    return results
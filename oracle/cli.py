@@ -10,16 +10,21 @@ __author__ = "Andy Casey <arc@ast.cam.ac.uk>"
 # Standard library.
 import argparse
 import cPickle as pickle
+import csv
 import logging
+import multiprocessing
 import os
 import sys
-from time import time
+from hashlib import md5
+from time import sleep, time
 
 # Third-party.
 import matplotlib.pyplot as plt
+import numpy as np
 
 # Module-specific.
 import oracle
+from oracle import pipeline, results
 
 logger = logging.getLogger("oracle")
 
@@ -35,20 +40,12 @@ def common_basename(filenames):
     common_prefix = common_prefix.rstrip("_-")
     return common_prefix if len(common_prefix) > 0 else "source"
 
-def estimate(args):
-    """ Estimate model parameters by cross-correlation against a grid. """
-
-    # Do we have to read from file?
-    if args.read_from_filename:
-        with open(args.spectrum_filenames[0], "r") as fp:
-            all_sources = [r.split() for r in map(str.strip, fp.readlines())]
-    else:
-        all_sources = [args.spectrum_filenames]
+def default_model(threads=4):
+    """ Return the model used to estimate parameters. """
 
-    # Create the model.
     # TODO this is just a basic GALAH model. We should really read from a
     # model filename instead.
-    model = oracle.models.Model({ "model": {
+    return oracle.models.Model({ "model": {
             "redshift": True,
             "continuum": 3,
             "continuum_mask": [
@@ -60,72 +57,601 @@ def estimate(args):
             ]
         },
         "settings": {
-            "threads": 4
+            "threads": threads
         }
         })
 
-    successful, exceptions = 0, 0
-    for i, filenames in enumerate(all_sources):
-        
-        basename = common_basename(filenames)
-        logger.info("Sources for #{0} (basename {1}): {2}".format(i + 1,
-            basename, ", ".join(filenames)))
 
-        t_init = time()
-        try:
-            data = map(oracle.specutils.Spectrum1D.load, filenames)
-            initial_theta, expected_dispersion, expected_flux = \
-                model.initial_theta(data, full_output=True)
+# The model used by each worker process to estimate parameters.
+_estimate_model = None
+
+
+def _initialise_estimate(model, grid_filename=None):
+    global _estimate_model
+
+    # Grids that are not shared are loaded (or memory-mapped) by each worker.
+    if not hasattr(model, "_loaded_grid"):
+        model._loaded_grid = model._load_grid(grid_filename)
+        model._grid_filename = grid_filename
+    _estimate_model = model
+
+
+def _estimate_source(args):
+    """
+    Estimate the model parameters for a single source, save the output, and
+    return a row for the results table and the data to plot (if required).
+    """
+    return _estimate_loaded_source(_load_source(args))
+
+
+def _load_source(args):
+    """
+    Load the spectra of a single source. Any exception is returned in place of
+    the spectra, so that it is recorded with the other results.
+    """
+
+    i, filenames, plotting, debug = args
+
+    basename = common_basename(filenames)
+    logger.info("Sources for #{0} (basename {1}): {2}".format(i + 1,
+        basename, ", ".join(filenames)))
+
+    t_init = time()
+    try:
+        data = map(oracle.specutils.Spectrum1D.load, filenames)
+
+    except Exception as e:
+        logger.exception("Exception raised when trying to load source #"\
+            "{0}".format(i + 1))
+        if debug: raise
+        data = e
+
+    return (args, data, time() - t_init)
+
 
+def _estimate_loaded_source(args):
+    """
+    Estimate the model parameters for a single source from its loaded spectra,
+    save the output, and return a row for the results table and the data to
+    plot (if required).
+    """
+
+    (i, filenames, plotting, debug), data, time_taken = args
+    basename = common_basename(filenames)
+
+    row = {
+        "index": i + 1,
+        "basename": basename,
+        "filenames": ";".join(filenames),
+        "success": False,
+        "error": ""
+    }
+
+    t_init = time() - time_taken
+    try:
+        if isinstance(data, Exception):
+            raise data
+        initial_theta, expected_dispersion, expected_flux = \
+            _estimate_model.initial_theta(data, full_output=True)
+
+    except Exception as e:
+        if e is not data:
+            logger.exception("Exception raised when trying to analyse source "\
+                "#{0}".format(i + 1))
+        if debug: raise
+        row.update(error="{0}: {1}".format(type(e).__name__, e),
+            time_taken=time() - t_init)
+        return (row, None)
+
+    row.update(success=True, time_taken=time() - t_init)
+    logger.info("Completed source #{0} successfully in {1:.1f} seconds".format(
+        i + 1, row["time_taken"]))
+
+    # Try and add v_helio?
+    try:
+        initial_theta["v_helio"] = data[0].v_helio
+    except KeyError:
+        logger.exception("Could not calculate heliocentric velocity "
+            "correction for source #{}".format(i + 1))
+        initial_theta["v_helio"] = np.nan
+
+    logger.info("Initial model parameters for source #{0} is {1}".format(
+        i + 1, initial_theta))
+    row.update(initial_theta)
+
+    # Save the initial theta information to somewhere.
+    output_filename = "initial-{}.pkl".format(basename)
+    with open(output_filename, "wb") as fp:
+        pickle.dump((initial_theta, expected_dispersion, expected_flux),
+            fp, -1)
+    logger.info("Saved output to {0}".format(output_filename))
+
+    # The figure is rendered elsewhere, so only return what is needed for it.
+    plot = None
+    if plotting:
+        plot = ("source-{}-initial.png".format(basename),
+            [(channel.disp, channel.flux) for channel in data],
+            expected_dispersion, expected_flux)
+
+    return (row, plot)
+
+
+def _plot_source(plot_filename, channels, expected_dispersion, expected_flux):
+    """
+    Plot the observed channels of a source and the expected fluxes from the
+    initial model parameters.
+
+    :param plot_filename:
+        The filename to save the figure to.
+
+    :type plot_filename:
+        str
+
+    :param channels:
+        The dispersion and flux of each observed channel.
+
+    :type channels:
+        list of tuple
+
+    :param expected_dispersion:
+        The dispersion points of the expected fluxes.
+
+    :type expected_dispersion:
+        :class:`numpy.array`
+
+    :param expected_flux:
+        The expected fluxes.
+
+    :type expected_flux:
+        :class:`numpy.array`
+    """
+
+    fig, axes = plt.subplots(len(channels))
+    axes = np.atleast_1d(axes)
+    for ax, (disp, flux) in zip(axes, channels):
+        ax.plot(disp, flux, c="k")
+        ylim = ax.get_ylim()
+        ax.plot(expected_dispersion, expected_flux, c="r", zorder=-1)
+        ax.set_xlim(disp.min(), disp.max())
+        ax.set_ylim(ylim)
+        ax.set_ylabel("Counts")
+
+    ax.set_xlabel("Wavelength")
+    fig.tight_layout()
+    fig.savefig(plot_filename)
+    plt.close(fig)
+    logger.info("Saved figure to {0}".format(plot_filename))
+    return plot_filename
+
+
+class _PlotQueue(object):
+    """
+    Render figures in a background process, so that plotting does not slow
+    down the analysis. At most `max_pending` figures are queued at once.
+    """
+
+    def __init__(self, max_pending=100):
+        self.max_pending = max_pending
+        self._pool = multiprocessing.Pool(1)
+        self._pending = []
+
+
+    def submit(self, plot):
+        self._pending.append(self._pool.apply_async(_plot_source, plot))
+        while len(self._pending) > self.max_pending:
+            self._wait(self._pending.pop(0))
+
+
+    def _wait(self, result):
+        try:
+            result.get()
         except:
-            exceptions += 1
-            logger.exception("Exception raised when trying to analyse source #"\
-                "{0}".format(i + 1))
-            if args.debug: raise
+            logger.exception("Exception raised when plotting a figure")
 
-        else:
-            successful += 1
-            logger.info("Completed successfully in {0:.1f} seconds".format(
-                time() - t_init))
 
-            # Try and add v_helio?
-            try:
-                initial_theta["v_helio"] = data[0].v_helio
-            except KeyError:
-                logger.exception("Could not calculate heliocentric velocity "
-                    "correction for source #{}".format(i + 1))
-                initial_theta["v_helio"] = np.nan
-
-            logger.info("Initial model parameters for source #{0} is {1}".format(
-                i + 1, initial_theta))
-
-            # Save the initial theta information to somewhere.
-            output_filename = "initial-{}.pkl".format(basename)
-            with open(output_filename, "wb") as fp:
-                pickle.dump((initial_theta, expected_dispersion, expected_flux),
-                    fp, -1)
-            logger.info("Saved output to {0}".format(output_filename))
-
-            if args.plotting:
-                plot_filename = "source-{}-initial.png".format(basename)
-                fig, axes = plt.subplots(len(data))
-                for j, (ax, channel) in enumerate(zip(axes, data)):
-                    ax.plot(channel.disp, channel.flux, c="k")
-                    ylim = ax.get_ylim()
-                    ax.plot(expected_dispersion, expected_flux, c="r", zorder=-1)
-                    ax.set_xlim(channel.disp.min(), channel.disp.max())
-                    ax.set_ylim(ylim)
-                    ax.set_ylabel("Counts")
-
-                ax.set_xlabel("Wavelength")
-                fig.tight_layout()
-                fig.savefig(plot_filename)
-                logger.info("Saved figure to {0}".format(plot_filename))
-                plt.close("all")
-
-    logger.info("{0} successful, {1} exceptions".format(successful, exceptions))
+    def close(self):
+        """ Wait for all of the queued figures to be rendered. """
+        for result in self._pending:
+            self._wait(result)
+        self._pending = []
+        self._pool.close()
+        self._pool.join()
+
+
+def _source_hash(filenames, digest=None):
+    """
+    Return the hash that identifies a source in the results database: the hash
+    of its input files, or of their names if the files could not be read.
+    """
+
+    if digest is None:
+        digest = results.Manifest.hash(filenames)
+    return digest or md5(results.Manifest.key(filenames)).hexdigest()
+
+
+def _parse_value(value):
+    """ Convert a value from a CSV table to a boolean, number or string. """
+
+    if value in ("True", "False"):
+        return value == "True"
+    try:
+        return float(value) if value != "" else None
+    except ValueError:
+        return value
+
+
+def ingest(args):
+    """ Insert the rows of results tables into a results database. """
+
+    from oracle import database
+
+    t_init = time()
+    with database.ResultsDatabase(args.database_filename) as db:
+        for table_filename in args.table_filenames:
+            with open(table_filename, "rb") as fp:
+                rows = [dict([(k, _parse_value(v)) for k, v in row.items()]) \
+                    for row in csv.DictReader(fp)]
+
+            for row in rows:
+                row["hash"] = _source_hash(row["filenames"].split(";"))
+            db.insert_stars(rows)
+            logger.info("Inserted {0} rows from {1}".format(len(rows),
+                table_filename))
+
+    logger.info("Ingested {0} tables in {1:.1f} seconds".format(
+        len(args.table_filenames), time() - t_init))
+
+
+def estimate(args):
+    """ Estimate model parameters by cross-correlation against a grid. """
+
+    # Do we have to read from file?
+    if args.read_from_filename:
+        with open(args.spectrum_filenames[0], "r") as fp:
+            all_sources = [r.split() for r in map(str.strip, fp.readlines())]
+    else:
+        all_sources = [args.spectrum_filenames]
+
+    if os.path.exists(args.table_filename) and not (args.overwrite \
+        or args.resume):
+        raise IOError("results table {} already exists and we have been "
+            "asked not to overwrite it".format(args.table_filename))
+
+    # The manifest records which sources have been completed, so that an
+    # interrupted run can be resumed.
+    manifest_filename = args.manifest_filename \
+        or "{}.manifest".format(args.table_filename)
+    manifest = results.Manifest(manifest_filename, overwrite=not args.resume)
+
+    sources = []
+    for i, filenames in enumerate(all_sources):
+        digest = manifest.hash(filenames)
+        if manifest.pending(filenames, digest, args.max_attempts):
+            sources.append((i, filenames, digest))
+
+    if len(sources) < len(all_sources):
+        logger.info("Skipping {0} of {1} sources that were completed (or "
+            "failed {2} times) in a previous run".format(
+                len(all_sources) - len(sources), len(all_sources),
+                args.max_attempts))
+
+    # Worker processes cannot have their own pools.
+    model = default_model(threads=4 if args.workers < 2 else 1)
+
+    # Start the plotting process before the grid is loaded.
+    plots = _PlotQueue() if args.plotting and sources else None
+
+    workers = max(1, min(args.workers, len(sources)))
+    if workers > 1:
+        # Load the grid once, and share it with the workers. Memory-mapped grid
+        # stores are already shared through the page cache.
+        if args.grid_filename is None or not os.path.isdir(args.grid_filename):
+            model.share_grid(filename=args.grid_filename)
+        pool = multiprocessing.Pool(workers, initializer=_initialise_estimate,
+            initargs=(model, args.grid_filename))
+        mapper = lambda f, a: pool.imap_unordered(f, a)
+
+    else:
+        # Load the spectra of the next sources while the model (which is not
+        # thread-safe) estimates the current one.
+        pool = None
+        _initialise_estimate(model, args.grid_filename)
+        stages = pipeline.Pipeline([
+            pipeline.Stage("load", _load_source, workers=2),
+            pipeline.Stage("estimate", _estimate_loaded_source)
+        ], max_queued=2)
+
+        def mapper(function, items):
+            for result in stages.run(items):
+                if not result.success:
+                    # Only in debug mode do the stages raise exceptions.
+                    raise RuntimeError("exception raised in the {0} stage:\n"
+                        "{1}".format(result.stage, result.error))
+                yield result.value
+
+    successful, exceptions = 0, 0
+    columns = ("index", "basename", "filenames", "success", "time_taken",
+        "error")
+
+    digests = dict([(i, digest) for i, filenames, digest in sources])
+
+    # Results are inserted into the database in batches.
+    db, db_rows = None, []
+    if args.database_filename is not None:
+        from oracle import database
+        db = database.ResultsDatabase(args.database_filename)
+
+    t_init = time()
+    try:
+        with results.CSVTable(args.table_filename, columns,
+            append=args.resume) as table:
+            for row, plot in mapper(_estimate_source, [(i, filenames,
+                args.plotting, args.debug) for i, filenames, _ in sources]):
+
+                if plot is not None:
+                    plots.submit(plot)
+
+                # Only record the source once its row is in the table.
+                table_row = table.write(row)
+                manifest.record(all_sources[row["index"] - 1],
+                    digests[row["index"] - 1], row["success"], row=table_row,
+                    time_taken=row["time_taken"], error=row["error"])
+
+                if db is not None:
+                    db_rows.append(dict(row, hash=_source_hash(
+                        all_sources[row["index"] - 1],
+                        digests[row["index"] - 1])))
+                    if len(db_rows) >= args.database_batch_size:
+                        db.insert_stars(db_rows)
+                        db_rows = []
+
+                if row["success"]:
+                    successful += 1
+                else:
+                    exceptions += 1
+
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        model.close_pool()
+        manifest.close()
+        if plots is not None:
+            plots.close()
+        if db is not None:
+            if db_rows:
+                db.insert_stars(db_rows)
+            db.close()
+
+    logger.info("{0} successful, {1} exceptions in {2:.1f} seconds with {3} "
+        "worker(s)".format(successful, exceptions, time() - t_init, workers))
     
 
+def _plot_saved_source(args):
+    """ Plot a source from its input spectra and saved initial output. """
+
+    basename, filenames, overwrite = args
+    plot_filename = "source-{}-initial.png".format(basename)
+    if os.path.exists(plot_filename) and not overwrite:
+        logger.info("Skipping figure {} because it already exists".format(
+            plot_filename))
+        return True
+
+    try:
+        data = map(oracle.specutils.Spectrum1D.load, filenames)
+        with open("initial-{}.pkl".format(basename), "rb") as fp:
+            initial_theta, expected_dispersion, expected_flux = pickle.load(fp)
+
+        _plot_source(plot_filename, [(channel.disp, channel.flux) \
+            for channel in data], expected_dispersion, expected_flux)
+
+    except:
+        logger.exception("Exception raised when plotting source {}".format(
+            basename))
+        return False
+    return True
+
+
+def plot(args):
+    """ Plot the sources in a results table from their saved outputs. """
+
+    with open(args.table_filename, "rb") as fp:
+        rows = [row for row in csv.DictReader(fp) if row["success"] == "True"]
+
+    # Sources that were attempted more than once have more than one row.
+    sources = dict([(row["basename"], row["filenames"].split(";")) \
+        for row in rows])
+    sources = [(basename, filenames, args.overwrite) \
+        for basename, filenames in sorted(sources.items())]
+
+    logger.info("Plotting {0} sources from {1}".format(len(sources),
+        args.table_filename))
+
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers)
+        plotted = pool.map(_plot_saved_source, sources)
+        pool.close()
+        pool.join()
+    else:
+        plotted = map(_plot_saved_source, sources)
+
+    logger.info("{0} figures plotted, {1} failed".format(sum(plotted),
+        len(plotted) - sum(plotted)))
+
+
+def enqueue(args):
+    """ Add sources to a shared work queue. """
+
+    from oracle import taskqueue
+
+    if args.read_from_filename:
+        with open(args.spectrum_filenames[0], "r") as fp:
+            sources = [r.split() for r in map(str.strip, fp.readlines()) if r]
+    else:
+        sources = [args.spectrum_filenames]
+
+    # Workers may run in other directories.
+    sources = [map(os.path.abspath, filenames) for filenames in sources]
+
+    queue = taskqueue.TaskQueue(args.queue_directory)
+    queue.put(sources, kind="estimate", batch_size=args.batch_size)
+    logger.info("Queue {0} now has {1}".format(args.queue_directory,
+        queue.counts()))
+
+
+def _run_estimate_task(task, filename):
+    """ Estimate parameters for the sources in a task, writing a table. """
+
+    columns = ("index", "basename", "filenames", "success", "time_taken",
+        "error")
+    with results.CSVTable(filename, columns) as table:
+        for i, filenames in enumerate(task.data["sources"]):
+            row, plot = _estimate_source((i, filenames, False, False))
+            table.write(row)
+
+
+def worker(args):
+    """
+    Process tasks from a shared work queue until no tasks are pending or
+    claimed by other workers. While other workers have claimed tasks, this
+    worker returns any whose leases expire to the queue, and processes them.
+    """
+
+    import threading
+    from oracle import taskqueue
+
+    queue = taskqueue.TaskQueue(args.queue_directory)
+    name = taskqueue.worker_name()
+    handlers = {"estimate": _run_estimate_task}
+
+    model = default_model(threads=args.threads)
+    _initialise_estimate(model, args.grid_filename)
+
+    def renew_leases(task, stop):
+        while not stop.wait(args.lease/3.):
+            try:
+                queue.renew(task)
+            except OSError:
+                logger.warn("Lost the lease on task {}".format(task.id))
+                return
+
+    completed, idle_since = 0, time()
+    try:
+        while True:
+            queue.requeue_expired(args.lease, args.max_attempts)
+            task = queue.claim(name)
+
+            if task is None:
+                counts = queue.counts()
+                if counts["claimed"] > 0:
+                    # Tasks are requeued if other workers die, so we wait until
+                    # the claimed tasks are finished.
+                    idle_since = time()
+                    sleep(min(args.lease/3., 10))
+
+                elif counts["pending"] == 0:
+                    if time() - idle_since > args.wait:
+                        break
+                    sleep(min(args.wait, 10))
+                continue
+
+            # Renew the lease in the background while the task runs.
+            stop = threading.Event()
+            renewer = threading.Thread(target=renew_leases, args=(task, stop))
+            renewer.daemon = True
+            renewer.start()
+
+            filename = os.path.join(args.queue_directory, "results",
+                "{0}.{1}.csv".format(task.id, name))
+            try:
+                handlers[task.data["kind"]](task, filename)
+
+            except:
+                logger.exception("Exception raised when running task {}"\
+                    .format(task.id))
+                stop.set()
+                queue.fail(task, "{0}: {1}".format(*sys.exc_info()[:2]),
+                    args.max_attempts)
+                if args.debug: raise
+
+            else:
+                stop.set()
+                queue.complete(task, filename)
+                completed += 1
+
+            finally:
+                stop.set()
+                renewer.join()
+
+            idle_since = time()
+
+    finally:
+        model.close_pool()
+
+    logger.info("Worker {0} completed {1} tasks. Queue is now {2}".format(name,
+        completed, queue.counts()))
+
+
+def serve(args):
+    """ Serve analysis requests from a long-lived process. """
+
+    # Import here to avoid slowing down other commands.
+    from oracle import server
+
+    analyst = server.Analyst(default_model(threads=args.threads),
+        grid_filename=args.grid_filename, photosphere_kinds=args.photospheres)
+    server.serve(analyst, host=args.host, port=args.port)
+
+
+def interpolation_benchmark(args):
+    """ Benchmark photosphere interpolation with a leave-one-out test. """
+
+    # Import here to avoid slowing down other commands.
+    from oracle import benchmarks
+
+    results = benchmarks.photosphere_interpolation(args.kind,
+        methods=args.methods, threads=args.threads)
+    _save_benchmark(results, args)
+    return results
+
+
+def ccf_benchmark(args):
+    """ Benchmark the methods that re-measure cross-correlation peaks. """
+
+    # Import here to avoid slowing down other commands.
+    from oracle import benchmarks
+
+    results = benchmarks.ccf_peak_refinement(methods=args.methods,
+        num_ccfs=args.num_ccfs, noise=args.noise, seed=args.seed)
+    _save_benchmark(results, args)
+    return results
+
+
+def convert_grid(args):
+    """ Convert a pickled grid of model spectra to a memory-mapped store. """
+
+    from oracle.models import grid
+
+    t_init = time()
+    grid.convert(args.grid_filename, args.directory, clobber=args.overwrite)
+    logger.info("Converted grid in {0:.1f} seconds".format(time() - t_init))
+
+
+def _save_benchmark(results, args):
+    """ Pickle benchmark results to the output filename, if one was given. """
+
+    if args.output_filename is None:
+        return
+
+    if os.path.exists(args.output_filename) and not args.overwrite:
+        raise IOError("output filename {} already exists and we have been "
+            "asked not to overwrite it".format(args.output_filename))
+
+    with open(args.output_filename, "wb") as fp:
+        pickle.dump(results, fp, -1)
+    logger.info("Saved benchmark results to {0}".format(args.output_filename))
+
+
 
 def parser(input_args=None):
 
@@ -162,12 +688,196 @@ def parser(input_args=None):
         help="Read input spectra from a single filename")
     estimate_parser.add_argument(
         "--no-plots", dest="plotting", action="store_false", default=True,
-        help="Disable plotting")
+        help="Disable plotting (figures can be made later with 'oracle plot')")
+    estimate_parser.add_argument(
+        "-w", "--workers", dest="workers", type=int, default=1,
+        help="The number of processes to distribute the sources across")
+    estimate_parser.add_argument(
+        "--grid", dest="grid_filename", default=None,
+        help="The filename of the model grid (a pickle or a memory-mapped grid"
+            " directory)")
+    estimate_parser.add_argument(
+        "-o", "--output", dest="table_filename", default="initial-theta.csv",
+        help="The filename of the results table for all sources")
+    estimate_parser.add_argument(
+        "--resume", dest="resume", action="store_true", default=False,
+        help="Resume a previous run by skipping the sources that were completed"
+            " and appending to the results table")
+    estimate_parser.add_argument(
+        "--max-attempts", dest="max_attempts", type=int, default=3,
+        help="The maximum number of times to attempt a failed source when "
+            "resuming")
+    estimate_parser.add_argument(
+        "--manifest", dest="manifest_filename", default=None,
+        help="The filename of the run manifest (default: the results table "
+            "filename with '.manifest' appended)")
+    estimate_parser.add_argument(
+        "--database", dest="database_filename", default=None,
+        help="Also insert the results into this SQLite results database")
+    estimate_parser.add_argument(
+        "--database-batch-size", dest="database_batch_size", type=int,
+        default=100, help="The number of results to insert into the database "
+            "in each transaction")
     estimate_parser.add_argument(
         "spectrum_filenames", nargs="+",
         help="Filenames of (observed) spectroscopic data")
     estimate_parser.set_defaults(func=estimate)
 
+    # Create parser for the plot command
+    plot_parser = subparsers.add_parser(
+        "plot", parents=[parent_parser],
+        help="Plot the successful sources in a results table from 'oracle "
+            "estimate', using the saved outputs.")
+    plot_parser.add_argument(
+        "-w", "--workers", dest="workers", type=int, default=1,
+        help="The number of processes to plot with")
+    plot_parser.add_argument(
+        "table_filename", nargs="?", default="initial-theta.csv",
+        help="The filename of the results table")
+    plot_parser.set_defaults(func=plot)
+
+    # Create parser for the enqueue command
+    enqueue_parser = subparsers.add_parser(
+        "enqueue", parents=[parent_parser],
+        help="Add sources to a work queue in a shared directory, which can be "
+            "processed by 'oracle worker' processes on any node.")
+    enqueue_parser.add_argument(
+        "-r", action="store_true", dest="read_from_filename", default=False,
+        help="Read input spectra from a single filename")
+    enqueue_parser.add_argument(
+        "-b", "--batch-size", dest="batch_size", type=int, default=10,
+        help="The number of sources in each task")
+    enqueue_parser.add_argument(
+        "queue_directory", type=str,
+        help="The shared queue directory")
+    enqueue_parser.add_argument(
+        "spectrum_filenames", nargs="+",
+        help="Filenames of (observed) spectroscopic data")
+    enqueue_parser.set_defaults(func=enqueue)
+
+    # Create parser for the worker command
+    worker_parser = subparsers.add_parser(
+        "worker", parents=[parent_parser],
+        help="Process tasks from a work queue in a shared directory. Results "
+            "for each task are written to the queue's 'results' directory.")
+    worker_parser.add_argument(
+        "--lease", dest="lease", type=float, default=600,
+        help="Tasks claimed by workers that have not renewed their lease within"
+            " this many seconds are returned to the queue")
+    worker_parser.add_argument(
+        "--max-attempts", dest="max_attempts", type=int, default=3,
+        help="The maximum number of times to attempt a task")
+    worker_parser.add_argument(
+        "--wait", dest="wait", type=float, default=0,
+        help="The number of seconds to wait for new tasks once no tasks are "
+            "pending or claimed by other workers, before exiting")
+    worker_parser.add_argument(
+        "-t", "--threads", dest="threads", type=int, default=1,
+        help="The number of processes to cross-correlate with")
+    worker_parser.add_argument(
+        "--grid", dest="grid_filename", default=None,
+        help="The filename of the model grid (a pickle or a memory-mapped grid"
+            " directory)")
+    worker_parser.add_argument(
+        "queue_directory", type=str,
+        help="The shared queue directory")
+    worker_parser.set_defaults(func=worker)
+
+    # Create parser for the ingest command
+    ingest_parser = subparsers.add_parser(
+        "ingest", parents=[parent_parser],
+        help="Insert the rows of results tables (e.g., from 'oracle estimate' "
+            "or 'oracle worker') into a SQLite results database.")
+    ingest_parser.add_argument(
+        "database_filename", type=str,
+        help="The filename of the results database")
+    ingest_parser.add_argument(
+        "table_filenames", nargs="+",
+        help="The filenames of the results tables")
+    ingest_parser.set_defaults(func=ingest)
+
+    # Create parser for the serve command
+    serve_parser = subparsers.add_parser(
+        "serve", parents=[parent_parser],
+        help="Serve estimate, synthesis and abundance requests over HTTP from "
+            "a long-lived process that keeps the grid and photospheres loaded.")
+    serve_parser.add_argument(
+        "--host", dest="host", default="127.0.0.1",
+        help="The address to listen on")
+    serve_parser.add_argument(
+        "-p", "--port", dest="port", type=int, default=8765,
+        help="The port to listen on")
+    serve_parser.add_argument(
+        "-t", "--threads", dest="threads", type=int, default=4,
+        help="The number of processes to cross-correlate with")
+    serve_parser.add_argument(
+        "--grid", dest="grid_filename", default=None,
+        help="The filename of the model grid (a pickle or a memory-mapped grid"
+            " directory)")
+    serve_parser.add_argument(
+        "--photospheres", dest="photospheres", nargs="*", default=[],
+        help="The kinds of model photospheres to load at start-up")
+    serve_parser.set_defaults(func=serve)
+
+    # Create parser for the interpolation benchmark command
+    benchmark_parser = subparsers.add_parser(
+        "interpolation-benchmark", parents=[parent_parser],
+        help="Benchmark the accuracy and speed of photosphere interpolation by "
+            "leaving out each model in the grid.")
+    benchmark_parser.add_argument(
+        "kind", type=str,
+        help="The kind of model photospheres (e.g., MARCS, Castelli/Kurucz)")
+    benchmark_parser.add_argument(
+        "-m", "--methods", dest="methods", nargs="+",
+        default=["linear", "nearest", "cached-simplex", "multilinear"],
+        help="The interpolation methods to benchmark: griddata methods (e.g., "
+            "linear, nearest), a cached Delaunay triangulation of the grid "
+            "(cached-simplex), or multilinear interpolation on the regular "
+            "grid (multilinear)")
+    benchmark_parser.add_argument(
+        "-t", "--threads", dest="threads", type=int, default=1,
+        help="The number of processes to use")
+    benchmark_parser.add_argument(
+        "-o", "--output", dest="output_filename", default=None,
+        help="Save the per-depth errors and latencies to this pickle filename")
+    benchmark_parser.set_defaults(func=interpolation_benchmark)
+
+    # Create parser for the ccf-benchmark command
+    ccf_benchmark_parser = subparsers.add_parser(
+        "ccf-benchmark", parents=[parent_parser],
+        help="Benchmark the accuracy and speed of re-measuring the peaks of "
+            "synthetic cross-correlation functions.")
+    ccf_benchmark_parser.add_argument(
+        "-m", "--methods", dest="methods", nargs="+",
+        default=["fit", "gaussian", "parabolic"],
+        help="The peak re-measurement methods to benchmark")
+    ccf_benchmark_parser.add_argument(
+        "-n", dest="num_ccfs", type=int, default=1000,
+        help="The number of synthetic cross-correlation functions")
+    ccf_benchmark_parser.add_argument(
+        "--noise", dest="noise", type=float, default=0.01,
+        help="The noise added to each (unit height) cross-correlation peak")
+    ccf_benchmark_parser.add_argument(
+        "--seed", dest="seed", type=int, default=None,
+        help="The seed for the random number generator")
+    ccf_benchmark_parser.add_argument(
+        "-o", "--output", dest="output_filename", default=None,
+        help="Save the errors and timings to this pickle filename")
+    ccf_benchmark_parser.set_defaults(func=ccf_benchmark)
+
+    # Create parser for the convert-grid command
+    convert_grid_parser = subparsers.add_parser(
+        "convert-grid", parents=[parent_parser],
+        help="Convert a pickled grid of model spectra to a memory-mapped grid "
+            "directory, which is stored by wavelength.")
+    convert_grid_parser.add_argument(
+        "grid_filename", type=str,
+        help="The filename of the pickled grid")
+    convert_grid_parser.add_argument(
+        "directory", type=str,
+        help="The directory to write the memory-mapped grid to")
+    convert_grid_parser.set_defaults(func=convert_grid)
+
     args = parser.parse_args(input_args)
     logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
     return args
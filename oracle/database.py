@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" An indexed SQLite database of stellar parameters and line abundances. """
+
+from __future__ import division, absolute_import, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+__all__ = ["ResultsDatabase"]
+
+# Standard library.
+import json
+import logging
+import sqlite3
+from time import time
+
+# Third-party.
+import numpy as np
+
+logger = logging.getLogger("oracle")
+
+# Columns of the stars table, besides the identifier and content hash. Any other
+# model parameters (e.g., per-channel velocities and continuum coefficients)
+# are stored as JSON in the 'theta' column.
+_STAR_COLUMNS = (
+    ("name", "TEXT"),
+    ("filenames", "TEXT"),
+    ("success", "INTEGER"),
+    ("error", "TEXT"),
+    ("time_taken", "REAL"),
+    ("effective_temperature", "REAL"),
+    ("surface_gravity", "REAL"),
+    ("metallicity", "REAL"),
+    ("microturbulence", "REAL"),
+    ("v_rad", "REAL"),
+    ("v_helio", "REAL"),
+)
+
+# Columns of the lines table, besides the star identifier. The '[X/M]' column of
+# a results table is stored as 'x_m', and any other columns are stored as JSON
+# in the 'extra' column.
+_LINE_COLUMNS = (
+    ("wavelength", "REAL"),
+    ("species", "REAL"),
+    ("excitation_potential", "REAL"),
+    ("loggf", "REAL"),
+    ("equivalent_width", "REAL"),
+    ("log_eps", "REAL"),
+    ("log_eps_Solar", "REAL"),
+    ("x_m", "REAL"),
+    ("outlier", "INTEGER"),
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stars (
+    id INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL UNIQUE,
+    {star_columns},
+    theta TEXT,
+    inserted REAL
+);
+CREATE INDEX IF NOT EXISTS stars_name ON stars (name);
+CREATE INDEX IF NOT EXISTS stars_teff ON stars (effective_temperature);
+CREATE INDEX IF NOT EXISTS stars_logg ON stars (surface_gravity);
+CREATE INDEX IF NOT EXISTS stars_feh ON stars (metallicity);
+
+CREATE TABLE IF NOT EXISTS lines (
+    star_id INTEGER NOT NULL REFERENCES stars (id) ON DELETE CASCADE,
+    {line_columns},
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS lines_star ON lines (star_id);
+CREATE INDEX IF NOT EXISTS lines_species ON lines (species, wavelength);
+""".format(
+    star_columns=",\n    ".join(["{0} {1}".format(*c) for c in _STAR_COLUMNS]),
+    line_columns=",\n    ".join(["{0} {1}".format(*c) for c in _LINE_COLUMNS]))
+
+
+def _value(value):
+    """ Convert a value to one that SQLite can store. """
+
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
+def _where(ranges, columns, prefix=""):
+    """
+    Return a SQL condition and its arguments that restrict columns to values or
+    (inclusive) ranges, where either bound of a range can be None.
+
+    :param ranges:
+        The values or ranges for each column.
+
+    :type ranges:
+        dict
+
+    :param columns:
+        The names of the columns that can be restricted.
+
+    :type columns:
+        tuple of str
+
+    :param prefix: [optional]
+        A prefix for the column names in the condition (e.g., the table name).
+
+    :type prefix:
+        str
+
+    :raises ValueError:
+        If a column is not one of the given columns.
+    """
+
+    unknown = set(ranges).difference(columns)
+    if unknown:
+        raise ValueError("unknown column(s): {}".format(
+            ", ".join(sorted(unknown))))
+
+    conditions, arguments = [], []
+    for column, value in sorted(ranges.items()):
+        column = prefix + column
+        if isinstance(value, (tuple, list)):
+            lower, upper = value
+            if lower is not None:
+                conditions.append("{} >= ?".format(column))
+                arguments.append(lower)
+            if upper is not None:
+                conditions.append("{} <= ?".format(column))
+                arguments.append(upper)
+        else:
+            conditions.append("{} = ?".format(column))
+            arguments.append(value)
+
+    return (" AND ".join(conditions) or "1", arguments)
+
+
+class ResultsDatabase(object):
+    """
+    A database of results with a row for each star, and a row for each line
+    measured in each star. The stars are keyed by a hash of their input data,
+    so reprocessing a star replaces its previous results (and lines).
+
+    :param filename:
+        The filename of the SQLite database. It is created if it does not exist.
+
+    :type filename:
+        str
+
+    :param timeout: [optional]
+        The number of seconds to wait for another process to finish writing.
+
+    :type timeout:
+        float
+    """
+
+    star_columns = tuple([c[0] for c in _STAR_COLUMNS])
+    line_columns = tuple([c[0] for c in _LINE_COLUMNS])
+
+    def __init__(self, filename, timeout=60):
+
+        self.filename = filename
+        self.connection = sqlite3.connect(filename, timeout=timeout)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(_SCHEMA)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def close(self):
+        self.connection.close()
+
+
+    def insert_stars(self, rows):
+        """
+        Insert (or replace) results for many stars in a single transaction.
+
+        :param rows:
+            The results for each star. Every row must contain a 'hash' of the
+            input data for the star. The 'basename' is used as the name of the
+            star if no 'name' is given. Values for the columns of the stars
+            table are stored in those columns, and all other values are stored
+            as JSON in the 'theta' column.
+
+        :type rows:
+            list of dict
+
+        :returns:
+            The identifiers of the inserted stars. If many rows have the same
+            hash (e.g., a failed attempt and a retry from a resumed run), only
+            the last of them is inserted.
+        """
+
+        # Keep the last row for each hash, in order.
+        last = dict([(row["hash"], i) for i, row in enumerate(rows)])
+        rows = [row for i, row in enumerate(rows) if last[row["hash"]] == i]
+
+        columns = ("hash", ) + self.star_columns + ("theta", "inserted")
+        statement = "INSERT INTO stars ({0}) VALUES ({1})".format(
+            ", ".join(columns), ", ".join(["?"] * len(columns)))
+
+        ids = []
+        with self.connection:
+            # Replace the results (and lines) from previous processing.
+            self.connection.executemany("DELETE FROM stars WHERE hash = ?",
+                [(row["hash"], ) for row in rows])
+
+            for row in rows:
+                row = row.copy()
+                row.setdefault("name", row.get("basename", None))
+                theta = dict([(k, _value(v)) for k, v in row.items() \
+                    if k not in columns and k not in ("basename", "index")])
+                values = [row["hash"]] \
+                    + [_value(row.get(c, None)) for c in self.star_columns] \
+                    + [json.dumps(theta, sort_keys=True), time()]
+                ids.append(self.connection.execute(statement, values).lastrowid)
+
+        return ids
+
+
+    def insert_lines(self, star_hash, lines):
+        """
+        Insert (or replace) the lines measured in a star.
+
+        :param star_hash:
+            The hash of the input data for the star.
+
+        :type star_hash:
+            str
+
+        :param lines:
+            The lines, e.g., the results table from
+            :func:`oracle.models.EqualibriumModel.estimate_stellar_parameters`.
+
+        :type lines:
+            :class:`astropy.table.Table` or list of dict
+        """
+
+        star = self.connection.execute("SELECT id FROM stars WHERE hash = ?",
+            (star_hash, )).fetchone()
+        if star is None:
+            raise KeyError("no star with hash {}".format(star_hash))
+
+        names = lines.colnames if hasattr(lines, "colnames") else None
+        columns = ("star_id", ) + self.line_columns + ("extra", )
+        statement = "INSERT INTO lines ({0}) VALUES ({1})".format(
+            ", ".join(columns), ", ".join(["?"] * len(columns)))
+
+        values = []
+        for line in lines:
+            if names is not None:
+                line = dict(zip(names, line))
+            line = dict([(k if k != "[X/M]" else "x_m", v) \
+                for k, v in line.items()])
+            extra = dict([(k, _value(v)) for k, v in line.items() \
+                if k not in self.line_columns])
+            values.append([star["id"]] \
+                + [_value(line.get(c, None)) for c in self.line_columns] \
+                + [json.dumps(extra, sort_keys=True)])
+
+        with self.connection:
+            self.connection.execute("DELETE FROM lines WHERE star_id = ?",
+                (star["id"], ))
+            self.connection.executemany(statement, values)
+
+        return len(values)
+
+
+    def stars(self, **ranges):
+        """
+        Return the stars with values (or within inclusive ranges) for some
+        columns, e.g., ``stars(effective_temperature=(5000, 6000), success=1)``.
+        Either bound of a range can be None, and unknown columns raise a
+        ValueError.
+
+        :returns:
+            A list of dictionaries, including the decoded 'theta'.
+        """
+
+        condition, arguments = _where(ranges,
+            ("id", "hash") + self.star_columns + ("inserted", ))
+        cursor = self.connection.execute(
+            "SELECT * FROM stars WHERE {} ORDER BY id".format(condition),
+            arguments)
+
+        stars = []
+        for row in cursor:
+            star = dict(zip(row.keys(), row))
+            star["theta"] = json.loads(star["theta"] or "{}")
+            stars.append(star)
+        return stars
+
+
+    def lines(self, star=None, **ranges):
+        """
+        Return the lines with values (or within inclusive ranges) for some
+        columns, e.g., ``lines(species=26.0, outlier=0)``, optionally for a
+        single star. Unknown columns raise a ValueError.
+
+        :param star: [optional]
+            The name, hash or identifier of the star.
+
+        :type star:
+            str or int
+
+        :returns:
+            A list of dictionaries, including the star name and decoded 'extra'
+            values.
+        """
+
+        ranges = ranges.copy()
+        if star is not None:
+            star_id = self._star_id(star)
+            if star_id is None:
+                return []
+            ranges["star_id"] = star_id
+
+        condition, arguments = _where(ranges,
+            ("star_id", ) + self.line_columns, prefix="lines.")
+        cursor = self.connection.execute("SELECT stars.name, lines.* FROM lines"
+            " JOIN stars ON stars.id = lines.star_id WHERE {} ORDER BY "
+            "lines.star_id, lines.species, lines.wavelength".format(condition),
+            arguments)
+
+        lines = []
+        for row in cursor:
+            line = dict(zip(row.keys(), row))
+            line["extra"] = json.loads(line["extra"] or "{}")
+            lines.append(line)
+        return lines
+
+
+    def _star_id(self, star):
+        """ Return the identifier of a star from its id, hash or name. """
+
+        if isinstance(star, (int, long)):
+            return star
+
+        row = self.connection.execute("SELECT id FROM stars WHERE hash = ? OR "
+            "name = ? ORDER BY id DESC", (star, star)).fetchone()
+        return None if row is None else row["id"]
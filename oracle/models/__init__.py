@@ -1,6 +1,7 @@
 # coding: utf-8
 
 import utils
+from .grid import GridIndex, GridView
 from .model import Model
 from .generative import GenerativeModel
 from .equalibria import *
\ No newline at end of file
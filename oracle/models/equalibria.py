@@ -24,6 +24,43 @@ logger = logging.getLogger("oracle")
 import matplotlib.pyplot as plt
 
 
+def _locked_atomic_abundances(*args, **kwargs):
+    """ Calculate atomic abundances with the in-process MOOG library. """
+    with synthesis.lock:
+        return synthesis.moog.atomic_abundances(*args, **kwargs)
+
+
+class SolverState(object):
+    """
+    The state of a single equalibrium solve: the transitions that are still
+    acceptable, and the history of sampled stellar parameters. Each solve has
+    its own state, so many stars can be solved at once (e.g., in threads).
+
+    :param transitions:
+        The atomic transitions used in the solve.
+
+    :type transitions:
+        :class:`astropy.table.Table`
+    """
+
+    def __init__(self, transitions):
+        self.transitions = transitions
+        self.acceptable = np.ones(len(transitions), dtype=bool)
+        self.sampled_theta = []
+        self.sampled_state_sums = []
+
+
+    def record(self, theta, total_state):
+        """ Record the total equalibrium state at some stellar parameters. """
+        self.sampled_theta.append(np.copy(theta))
+        self.sampled_state_sums.append(total_state)
+
+
+    def diverged(self, n=100):
+        """ Return whether each of the last `n` samples were invalid. """
+        return len(self.sampled_state_sums) > n \
+            and not np.any(np.isfinite(self.sampled_state_sums[-n:]))
+
 
 class BaseEqualibriumModel(Model):
 
@@ -118,6 +155,12 @@ class BaseEqualibriumModel(Model):
 
         This method can operate using an atomic transition table with measured
         equivalent widths, or it can measure atomic transitions from spectra.
+
+        Atomic abundances are calculated with the in-process MOOG library,
+        which is used by one thread at a time. Another function with the same
+        signature as :func:`oracle.synthesis.moog.atomic_abundances` (e.g., one
+        that sends the calculation to a pool of processes) can be given with
+        the `atomic_abundances` keyword.
         """
 
         # If transitions is given and includes equivalent_widths, then that's
@@ -157,12 +200,11 @@ class BaseEqualibriumModel(Model):
 
         debug = kwargs.pop("debug", False)
         equalibrium_state_kwds = kwargs.pop("equalibrium_state", {})
+        calculate_abundances = kwargs.pop("atomic_abundances",
+            _locked_atomic_abundances)
 
-        global acceptable, sampled_theta, sampled_state_sums
-
-        sampled_theta = []
-        sampled_state_sums = []
-        acceptable = np.ones(len(atomic_transitions), dtype=bool)
+        solver = SolverState(atomic_transitions)
+        acceptable = solver.acceptable
 
         # Any transition limits that are not dependent on abundances can be
         # applied now, before the objective function.
@@ -177,11 +219,8 @@ class BaseEqualibriumModel(Model):
 
         def objective_function(theta, full_output=False):
 
-            global acceptable, sampled_theta, sampled_state_sums
-
             # Total disaster recovery:
-            if (len(sampled_state_sums) > 100 \
-                and not np.any(np.isfinite(sampled_state_sums[-100:]))):
+            if solver.diverged(100):
                 raise ValueError("last hundred sampled thetas returned NaNs")
 
             _exception_response = np.nan * np.ones(len(theta))
@@ -189,8 +228,7 @@ class BaseEqualibriumModel(Model):
                 np.nan * acceptable.sum(), {})
                 
             def invalid_value():
-                sampled_theta.append(theta)
-                sampled_state_sums.append(np.nan)
+                solver.record(theta, np.nan)
 
                 return _exception_full_response \
                     if full_output else _exception_response 
@@ -212,7 +250,7 @@ class BaseEqualibriumModel(Model):
             try:
                 photosphere = self._photosphere_interpolator(
                     effective_temperature, surface_gravity, metallicity)
-                atomic_abundances = synthesis.moog.atomic_abundances(
+                atomic_abundances = calculate_abundances(
                     atomic_transitions[acceptable], photosphere,
                     microturbulence=xi, debug=debug)
 
@@ -244,8 +282,7 @@ class BaseEqualibriumModel(Model):
 
             # Append to the sample.
             total_state = (state**2).sum()
-            sampled_theta.append(np.copy(theta))
-            sampled_state_sums.append(total_state)
+            solver.record(theta, total_state)
 
             logger.debug("Equalibrium state: {0} {1:.3e}".format(
                 state, total_state))
@@ -281,7 +318,8 @@ class BaseEqualibriumModel(Model):
 
         _exception_response = (np.nan * np.ones(4), None, np.nan * np.ones(4))
         _exception_full_response = (np.nan * np.ones(4), None,
-            np.nan * np.ones(4), sampled_theta, sampled_state_sums, {})
+            np.nan * np.ones(4), solver.sampled_theta,
+            solver.sampled_state_sums, {})
 
         iteration, t_init = 0, time()
         
@@ -425,8 +463,8 @@ class BaseEqualibriumModel(Model):
             name="outlier", data=~acceptable, dtype=bool))
 
         # Arrayify for later.
-        sampled_theta = np.array(sampled_theta)
-        sampled_state_sums = np.array(sampled_state_sums)
+        sampled_theta = np.array(solver.sampled_theta)
+        sampled_state_sums = np.array(solver.sampled_state_sums)
 
         # Save the successful equalibrium information for pickling.
         logger.info("Saving successful equalibrium information to the model.")
@@ -489,7 +527,6 @@ class BaseEqualibriumModel(Model):
             fitted_profiles = self.fit_all_atomic_transitions(data, **initial_theta)
 
         # Create a copy of the transitions for our little 'objective adventure'.
-        global transitions
         transitions = self.atomic_transitions.copy()
         for_equalibria = np.isfinite(transitions["equivalent_width"]) \
             * (transitions["equivalent_width"] > 0) \
@@ -501,18 +538,17 @@ class BaseEqualibriumModel(Model):
         initial_state, info = utils.equalibrium_state(transitions,
             metallicity=sp_initial_theta[2], **state_kwds)
 
-        transitions = transitions[info["~outliers"]]
+        solver = SolverState(transitions[info["~outliers"]])
 
         def objective_function(theta):
             """ Minimise the simultaeous equalibrium constraints. """
 
-            global transitions
+            transitions = solver.transitions
             stellar_parameters, microturbulence = theta[:3], theta[3]
             try:
                 photosphere = self._photosphere_interpolator(*stellar_parameters)
-                abundances = \
-                    synthesis.moog.atomic_abundances(transitions,
-                        photosphere, microturbulence=microturbulence)
+                abundances = _locked_atomic_abundances(transitions,
+                    photosphere, microturbulence=microturbulence)
 
             except:
                 logger.exception("Exception while calculating abundances at {}"\
@@ -523,7 +559,8 @@ class BaseEqualibriumModel(Model):
             state, info = utils.equalibrium_state(transitions,
                     metallicity=stellar_parameters[2], **state_kwds)
             # Remove outliers from future iterations
-            transitions = transitions[info["~outliers"]]
+            solver.transitions = transitions[info["~outliers"]]
+            solver.record(theta, (state**2).sum())
 
             # TODO: Save transitions table for future introspection.
 
@@ -544,6 +581,7 @@ class BaseEqualibriumModel(Model):
         op_kwds["full_output"] = True
 
         result = op.fsolve(objective_function, sp_initial_theta, **op_kwds)
+        transitions = solver.transitions
 
         # Show the new lines
         import matplotlib.pyplot as plt
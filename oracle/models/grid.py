@@ -0,0 +1,576 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Storing, indexing and searching grids of model spectra. """
+
+from __future__ import division, absolute_import, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+__all__ = ["GridIndex", "GridView", "convert", "fingerprint", "load",
+    "marginalised_chi_sq", "posterior", "write"]
+
+import cPickle as pickle
+import logging
+import os
+from hashlib import md5
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+logger = logging.getLogger("oracle")
+
+
+def write(directory, points, dispersion, fluxes, clobber=False,
+    block_size=1000):
+    """
+    Write a grid of model spectra to a directory in a memory-mappable format.
+    The fluxes are stored by wavelength (with shape (N_pixels, N_models)), so
+    the fluxes of all models across some wavelength range are contiguous on
+    disk.
+
+    :param directory:
+        The directory to write the grid to.
+
+    :type directory:
+        str
+
+    :param points:
+        The stellar parameters of the grid points.
+
+    :type points:
+        :class:`numpy.core.records.recarray`
+
+    :param dispersion:
+        The dispersion points of the model spectra.
+
+    :type dispersion:
+        :class:`numpy.array`
+
+    :param fluxes:
+        The model fluxes, with shape (N_models, N_pixels).
+
+    :type fluxes:
+        :class:`numpy.ndarray`
+
+    :param clobber: [optional]
+        Overwrite an existing grid in the directory.
+
+    :type clobber:
+        bool
+
+    :param block_size: [optional]
+        The number of models to transpose and write at once.
+
+    :type block_size:
+        int
+    """
+
+    if fluxes.shape != (len(points), len(dispersion)):
+        raise ValueError("fluxes must have shape (N_models, N_pixels)")
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    elif os.path.exists(os.path.join(directory, "fluxes.npy")) and not clobber:
+        raise IOError("a grid already exists in {}".format(directory))
+
+    np.save(os.path.join(directory, "points.npy"), points)
+    np.save(os.path.join(directory, "dispersion.npy"), dispersion)
+
+    stored = np.lib.format.open_memmap(os.path.join(directory, "fluxes.npy"),
+        mode="w+", dtype=fluxes.dtype, shape=fluxes.shape[::-1])
+    for i in xrange(0, len(points), block_size):
+        stored[:, i:i + block_size] = fluxes[i:i + block_size].T
+    stored.flush()
+    del stored
+
+    logger.info("Wrote grid of {0} models with {1} pixels to {2}".format(
+        len(points), len(dispersion), directory))
+
+
+def load(directory):
+    """
+    Load a grid of model spectra that was written with :func:`write`. The
+    fluxes are memory-mapped, so only the pages for the wavelengths that are
+    used are read from disk, and processes that load the same grid share the
+    same physical pages.
+
+    :param directory:
+        The directory containing the grid.
+
+    :type directory:
+        str
+
+    :returns:
+        The stellar parameters of the grid points, the dispersion points, and
+        the (read-only) model fluxes with shape (N_models, N_pixels).
+    """
+
+    points = np.load(os.path.join(directory, "points.npy"))
+    dispersion = np.load(os.path.join(directory, "dispersion.npy"))
+    fluxes = np.load(os.path.join(directory, "fluxes.npy"), mmap_mode="r")
+    return (points.view(np.recarray), dispersion, fluxes.T)
+
+
+def convert(filename, directory, clobber=False):
+    """
+    Convert a pickled grid of model spectra (containing the grid points, the
+    dispersion, the fluxes and the number of pixels in each channel) to the
+    memory-mappable format written by :func:`write`.
+
+    :param filename:
+        The filename of the pickled grid.
+
+    :type filename:
+        str
+
+    :param directory:
+        The directory to write the grid to.
+
+    :type directory:
+        str
+
+    :param clobber: [optional]
+        Overwrite an existing grid in the directory.
+
+    :type clobber:
+        bool
+    """
+
+    with open(filename, "rb") as fp:
+        points, dispersion, fluxes, px = pickle.load(fp)
+
+    write(directory, points, dispersion, fluxes.reshape(points.size, sum(px)),
+        clobber=clobber)
+
+
+def fingerprint(dispersion, *args):
+    """
+    Return a MD5 hash that uniquely describes some dispersion points (and any
+    other arguments that affect how they are compared to the grid, such as the
+    masked regions).
+
+    :param dispersion:
+        The dispersion points.
+
+    :type dispersion:
+        :class:`numpy.array`
+
+    :returns:
+        The hexadecimal digest.
+
+    :rtype:
+        str
+    """
+
+    digest = md5(np.ascontiguousarray(dispersion, dtype=float).tostring())
+    digest.update(repr(args).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _masked_edges(mask):
+    """
+    Return the slice indices that remove the masked pixels at either end of a
+    mask (where True indicates a masked pixel).
+    """
+
+    if not np.any(mask):
+        return (0, None)
+
+    changes = np.where(np.diff(mask))[0]
+    left = changes[0] + 1 if mask[0] else 0
+    right = changes[-1] - 1 if mask[-1] else None
+    return (left, right)
+
+
+class GridView(object):
+    """
+    The grid pixels, masks and continuum design matrices for a channel with some
+    observed dispersion. These are identical for every star observed with the
+    same instrument setup, so they only need to be calculated once.
+
+    :param grid_dispersion:
+        The dispersion points of the grid.
+
+    :type grid_dispersion:
+        :class:`numpy.array`
+
+    :param dispersion:
+        The observed dispersion points of the channel.
+
+    :type dispersion:
+        :class:`numpy.array`
+
+    :param key: [optional]
+        A key that describes the view (e.g., from :func:`fingerprint`).
+
+    :type key:
+        str
+    """
+
+    def __init__(self, grid_dispersion, dispersion, key=None):
+
+        self.key = key
+        self.size = dispersion.size
+
+        # The grid pixels that span the observed channel.
+        self.indices = grid_dispersion.searchsorted(
+            [dispersion[0], dispersion[-1]]) + [0, 1]
+        self.dispersion = grid_dispersion[self.indices[0]:self.indices[1]]
+
+        # Linear interpolation weights from the observed pixels to the grid
+        # pixels, as used by np.interp (with NaNs outside the channel).
+        right = np.clip(dispersion.searchsorted(self.dispersion, "right"),
+            1, dispersion.size - 1)
+        self._left = right - 1
+        self._weights = (self.dispersion - dispersion[self._left]) \
+            / (dispersion[right] - dispersion[self._left])
+        self._outside = (self.dispersion < dispersion[0]) \
+            + (self.dispersion > dispersion[-1])
+
+        self.masks = {}
+        self.edges = {}
+        self._designs = {}
+
+
+    def rebin(self, flux):
+        """
+        Linearly interpolate observed values onto the grid pixels of the view.
+
+        :param flux:
+            The values at the observed dispersion points.
+
+        :type flux:
+            :class:`numpy.array`
+
+        :returns:
+            The values at the grid dispersion points, which are NaN outside of
+            the observed channel.
+
+        :rtype:
+            :class:`numpy.array`
+        """
+
+        if flux.size != self.size:
+            raise ValueError("expected {0} values, not {1}".format(self.size,
+                flux.size))
+
+        rebinned = flux[self._left] * (1 - self._weights) \
+            + flux[self._left + 1] * self._weights
+        rebinned[self._outside] = np.nan
+        return rebinned
+
+
+    def add_mask(self, name, mask):
+        """
+        Add a mask to the view, and record the slice that removes the masked
+        pixels at either end of it.
+
+        :param name:
+            The name of the mask.
+
+        :type name:
+            str
+
+        :param mask:
+            A boolean array for the grid pixels of the view, where True
+            indicates a masked pixel.
+
+        :type mask:
+            :class:`numpy.array`
+        """
+
+        self.masks[name] = mask
+        self.edges[name] = _masked_edges(mask)
+
+
+    def masked(self, name, finite=None):
+        """
+        Return a mask of the view (where True indicates a masked pixel) and the
+        slice that removes the masked pixels at either end of it.
+
+        :param name:
+            The name of the mask.
+
+        :type name:
+            str
+
+        :param finite: [optional]
+            A boolean array indicating which pixels have finite values. Pixels
+            that are not finite are also masked.
+
+        :type finite:
+            :class:`numpy.array`
+        """
+
+        if finite is None or np.all(finite):
+            return (self.masks[name], self.edges[name])
+
+        mask = self.masks[name] + ~finite
+        return (mask, _masked_edges(mask))
+
+
+    def design(self, degree, scaled=False):
+        """
+        Return the (cached) Vandermonde design matrix for a polynomial continuum
+        at the grid pixels of the view.
+
+        :param degree:
+            The polynomial degree.
+
+        :type degree:
+            int
+
+        :param scaled: [optional]
+            Scale the dispersion points to [-0.5, 0.5] so that the design matrix
+            is well-conditioned.
+
+        :type scaled:
+            bool
+        """
+
+        try:
+            return self._designs[(degree, scaled)]
+
+        except KeyError:
+            x = self.dispersion
+            if scaled:
+                x = (x - x.mean())/x.ptp()
+            design = np.vander(x, degree + 1)
+            self._designs[(degree, scaled)] = design
+            return design
+
+
+class GridIndex(object):
+    """
+    An index of the stellar parameters of grid points, which allows the grid
+    points within some box (e.g., from photometric priors) or nearest to some
+    point to be found without searching the entire grid.
+
+    :param points:
+        The stellar parameters of the grid points.
+
+    :type points:
+        :class:`numpy.core.records.recarray`
+    """
+
+    def __init__(self, points):
+
+        self.points = points
+        self.names = tuple(points.dtype.names)
+
+        # Per-axis sorted indices for box queries.
+        self._order = {}
+        self._sorted = {}
+        for name in self.names:
+            self._order[name] = np.argsort(points[name], kind="mergesort")
+            self._sorted[name] = points[name][self._order[name]]
+
+        # A KD-tree in scaled units for nearest neighbour queries.
+        values = np.vstack([points[name] for name in self.names]).T\
+            .astype(float)
+        self._offset = values.min(axis=0)
+        self._scale = values.ptp(axis=0)
+        self._scale[self._scale == 0] = 1.
+        self._tree = cKDTree((values - self._offset)/self._scale)
+
+
+    def __len__(self):
+        return self.points.size
+
+
+    def box(self, bounds):
+        """
+        Return the indices of the grid points that lie within a box in parameter
+        space.
+
+        :param bounds:
+            The lower and upper bounds (inclusive) for each parameter. Either
+            bound can be None, and parameters that are not given are not
+            restricted.
+
+        :type bounds:
+            dict
+
+        :returns:
+            The sorted indices of the grid points within the box.
+
+        :rtype:
+            :class:`numpy.array`
+        """
+
+        inside = np.ones(len(self), dtype=bool)
+        for name, (lower, upper) in bounds.items():
+            if name not in self._sorted:
+                raise KeyError("unknown grid parameter '{0}' (available: {1})"\
+                    .format(name, ", ".join(self.names)))
+
+            values = self._sorted[name]
+            start = 0 if lower is None else values.searchsorted(lower, "left")
+            end = len(values) if upper is None \
+                else values.searchsorted(upper, "right")
+
+            within = np.zeros(len(self), dtype=bool)
+            within[self._order[name][start:end]] = True
+            inside *= within
+
+        return np.where(inside)[0]
+
+
+    def nearest(self, point, k=1):
+        """
+        Return the indices of the grid points nearest to a point in parameter
+        space, where each parameter is scaled by the extent of the grid.
+
+        :param point:
+            The value of every grid parameter.
+
+        :type point:
+            dict
+
+        :param k: [optional]
+            The number of nearest grid points to return.
+
+        :type k:
+            int
+
+        :returns:
+            The indices of the nearest grid points, ordered by distance.
+
+        :rtype:
+            :class:`numpy.array`
+        """
+
+        x = (np.array([point[name] for name in self.names], dtype=float) \
+            - self._offset)/self._scale
+        distances, indices = self._tree.query(x, k=k)
+        return np.atleast_1d(indices)
+
+
+def marginalised_chi_sq(flux, ivariance, model_fluxes, design=None,
+    block_size=1000):
+    """
+    Calculate the inverse-variance-weighted chi-squared value between an
+    observed spectrum and every model in a grid, where each model is multiplied
+    by a continuum that is linear in its coefficients. The best continuum
+    coefficients for every model are solved analytically with matrix products,
+    and the continuum is marginalised (with a flat prior) in the likelihood.
+
+    :param flux:
+        The observed flux, with shape (N_pixels, ).
+
+    :type flux:
+        :class:`numpy.array`
+
+    :param ivariance:
+        The inverse variance of the observed flux. Pixels with zero inverse
+        variance are ignored.
+
+    :type ivariance:
+        :class:`numpy.array`
+
+    :param model_fluxes:
+        The model fluxes on the same pixels, with shape (N_models, N_pixels).
+
+    :type model_fluxes:
+        :class:`numpy.ndarray`
+
+    :param design: [optional]
+        The continuum design matrix with shape (N_pixels, N_coefficients),
+        e.g., a Vandermonde matrix. If not given, the models are compared to the
+        observed flux without a continuum.
+
+    :type design:
+        :class:`numpy.ndarray`
+
+    :param block_size: [optional]
+        The maximum number of models to evaluate at once.
+
+    :type block_size:
+        int
+
+    :returns:
+        The minimum chi-squared value and the marginalised log-likelihood
+        (up to a constant) for every model. Models whose continuum coefficients
+        cannot be determined (e.g., if there are fewer unmasked pixels than
+        coefficients) have infinite chi-squared values.
+    """
+
+    flux = np.where(ivariance > 0, flux, 0)
+    N_models, N_pixels = model_fluxes.shape
+
+    chi_sqs = np.zeros(N_models)
+    log_likelihoods = np.zeros(N_models)
+    data_term = np.dot(ivariance, flux**2)
+
+    if design is not None:
+        K = design.shape[1]
+        # The weighted products of the design columns, and with the data.
+        outer = (ivariance[:, None, None] * design[:, :, None] \
+            * design[:, None, :]).reshape(N_pixels, K * K)
+        data_design = (ivariance * flux)[:, None] * design
+
+    for i in xrange(0, N_models, block_size):
+        block = slice(i, i + block_size)
+        F = np.asarray(model_fluxes[block], dtype=float)
+
+        if design is None:
+            chi_sqs[block] = data_term - 2 * np.dot(F, ivariance * flux) \
+                + np.dot(F**2, ivariance)
+            log_likelihoods[block] = -0.5 * chi_sqs[block]
+            continue
+
+        # For each model, the normal equations are A^T W A and A^T W y, where
+        # the design matrix A is the continuum design scaled by the model.
+        ATA = np.dot(F**2, outer).reshape(-1, K, K)
+        ATy = np.dot(F, data_design)
+
+        try:
+            coefficients = np.linalg.solve(ATA, ATy[:, :, None])[:, :, 0]
+
+        except np.linalg.LinAlgError:
+            # Solve each model separately, so that only the models with
+            # singular normal equations are excluded.
+            coefficients = np.nan * np.ones(ATy.shape)
+            for j in xrange(ATA.shape[0]):
+                try:
+                    coefficients[j] = np.linalg.solve(ATA[j], ATy[j])
+                except np.linalg.LinAlgError:
+                    continue
+
+        block_chi_sqs = data_term - (ATy * coefficients).sum(axis=1)
+        sign, log_det = np.linalg.slogdet(ATA)
+        singular = ~np.isfinite(block_chi_sqs) + (sign <= 0)
+
+        block_chi_sqs[singular] = np.inf
+        chi_sqs[block] = block_chi_sqs
+        log_likelihoods[block] = np.where(singular, -np.inf,
+            -0.5 * (block_chi_sqs + log_det))
+
+    return (chi_sqs, log_likelihoods)
+
+
+def posterior(log_likelihoods):
+    """
+    Return the normalised posterior probability of every grid point, given the
+    log-likelihoods and a uniform prior over grid points.
+
+    :param log_likelihoods:
+        The log-likelihood of every grid point. Grid points with non-finite
+        values have zero probability.
+
+    :type log_likelihoods:
+        :class:`numpy.array`
+
+    :raises ValueError:
+        If no grid point has a finite log-likelihood.
+    """
+
+    finite = np.isfinite(log_likelihoods)
+    if not np.any(finite):
+        raise ValueError("no grid points have a finite likelihood")
+
+    log_likelihoods = np.where(finite, log_likelihoods, -np.inf)
+    probabilities = np.exp(log_likelihoods - log_likelihoods.max())
+    return probabilities/probabilities.sum()
@@ -11,23 +11,93 @@ __author__ = "Andy Casey <arc@ast.cam.ac.uk>"
 import cPickle as pickle
 import logging
 import os
+import threading
 import yaml
 import numpy as np
 import warnings
+from collections import OrderedDict
 from hashlib import md5
+from multiprocessing.pool import ThreadPool
 from pkg_resources import resource_stream
 from scipy import ndimage, stats, optimize as op
 
 logger = logging.getLogger("oracle")
 
-from oracle import photospheres, specutils, utils
-from oracle.models import profiles, validation
+from oracle import photospheres, sharedmem, specutils, utils
+from oracle.models import grid, profiles, validation
 
 from astropy import constants
 
 # Silence 'Polyfit may be poorly conditioned' messages
 warnings.simplefilter("ignore", np.RankWarning)
 
+# Grid views are created by the threads that analyse each channel.
+_grid_view_lock = threading.Lock()
+
+
+def _fit_continuum(design, model_flux, observed_flux, sigma_clip=None,
+    iterations=3):
+    """
+    Solve for the polynomial continuum coefficients that best scale a model
+    spectrum to the observed flux, by linear least-squares.
+
+    :param design:
+        The Vandermonde design matrix for the polynomial continuum, with shape
+        (N_pixels, N_coefficients).
+
+    :type design:
+        :class:`numpy.ndarray`
+
+    :param model_flux:
+        The model flux at each pixel.
+
+    :type model_flux:
+        :class:`numpy.array`
+
+    :param observed_flux:
+        The observed flux at each pixel.
+
+    :type observed_flux:
+        :class:`numpy.array`
+
+    :param sigma_clip: [optional]
+        Iteratively exclude pixels with residuals more than this many standard
+        deviations from the continuum-scaled model.
+
+    :type sigma_clip:
+        float
+
+    :param iterations: [optional]
+        The maximum number of sigma-clipping iterations.
+
+    :type iterations:
+        int
+
+    :returns:
+        The polynomial coefficients (highest order first) and a mask of the
+        pixels that were used.
+    """
+
+    A = design * model_flux[:, None]
+    # Scale the columns, as they span many orders of magnitude.
+    scale = np.sqrt((A**2).sum(axis=0))
+    scale[scale == 0] = 1.
+
+    use = np.ones(observed_flux.size, dtype=bool)
+    for iteration in xrange(1 + (iterations if sigma_clip else 0)):
+        coefficients = np.linalg.lstsq(A[use]/scale, observed_flux[use])[0] \
+            / scale
+        if not sigma_clip:
+            break
+
+        residuals = observed_flux - np.dot(A, coefficients)
+        clipped = np.abs(residuals) <= sigma_clip * residuals[use].std()
+        if np.all(clipped == use) or clipped.sum() < A.shape[1]:
+            break
+        use = clipped
+
+    return (coefficients, use)
+
 
 class Model(object):
 
@@ -93,6 +163,16 @@ class Model(object):
         for key in state.keys():
             if key not in allowed_keys:
                 del state[key]
+
+        # Shared grids are only pickled by name, so we can keep them. Other
+        # grids are loaded again (or memory-mapped) from their filename, which
+        # also identifies the grid in the template and view caches.
+        grid = self.__dict__.get("_loaded_grid", None)
+        if grid is not None \
+        and all([isinstance(_, sharedmem.SharedArray) for _ in grid]):
+            state["_loaded_grid"] = grid
+        if "_grid_filename" in self.__dict__:
+            state["_grid_filename"] = self._grid_filename
         return state
 
     def __setstate__(self, state):
@@ -170,9 +250,15 @@ class Model(object):
         """
         This is a temporary function until I can generalise the grid.
 
+        If the filename is a directory, the grid is memory-mapped from it (see
+        :func:`oracle.models.grid.write`).
+
         TODO
         """
 
+        if filename is not None and os.path.isdir(filename):
+            return grid.load(filename)
+
         if filename is None:
             with resource_stream(__name__, "galah-ambre-grid.pkl") as fp:
                 grid_points, grid_dispersion, grid_fluxes, px = pickle.load(fp)
@@ -186,6 +272,173 @@ class Model(object):
         return (grid_points, grid_dispersion, grid_fluxes)
 
 
+    def cluster_grid(self, num_clusters, by_parameters=False, filename=None,
+        **kwargs):
+        """
+        Cluster the model grid so that cross-correlations can first be performed
+        against a representative of each cluster, and then only against the
+        members of the most similar clusters.
+
+        :param num_clusters:
+            The number of clusters.
+
+        :type num_clusters:
+            int
+
+        :param by_parameters: [optional]
+            Tile the grid in parameter space instead of clustering by spectral
+            similarity.
+
+        :type by_parameters:
+            bool
+
+        :param filename: [optional]
+            The filename of the grid to load, if it is not already loaded.
+
+        :type filename:
+            str
+
+        :returns:
+            The template clusters.
+
+        :rtype:
+            :class:`oracle.specutils.cross_correlate.TemplateClusters`
+        """
+
+        if not hasattr(self, "_loaded_grid"):
+            filename = filename or getattr(self, "_grid_filename", None)
+            self._loaded_grid = self._load_grid(filename)
+            self._grid_filename = filename
+
+        grid_points, grid_dispersion, grid_fluxes = self._loaded_grid
+
+        # Limit the number of pixels used to cluster by flux.
+        kwargs.setdefault("stride", max(1, int(grid_dispersion.size/2000)))
+        self._template_clusters = specutils.cross_correlate.cluster_templates(
+            grid_fluxes, num_clusters,
+            points=grid_points if by_parameters else None, **kwargs)
+        return self._template_clusters
+
+
+    def share_grid(self, name=None, filename=None):
+        """
+        Publish the model grid to shared memory. Worker processes that receive
+        this model will attach to the published grid by name instead of
+        receiving a copy of it, or loading the grid themselves.
+
+        :param name: [optional]
+            The name to publish the grid as. If not given, a name that is unique
+            to this process and model is used.
+
+        :type name:
+            str
+
+        :param filename: [optional]
+            The filename of the grid to load, if it is not already loaded.
+
+        :type filename:
+            str
+
+        :returns:
+            The name of the published grid.
+        """
+
+        if not hasattr(self, "_loaded_grid"):
+            filename = filename or getattr(self, "_grid_filename", None)
+            self._loaded_grid = self._load_grid(filename)
+            self._grid_filename = filename
+
+        if name is None:
+            name = "grid-{0}-{1}".format(os.getpid(), id(self))
+
+        self._loaded_grid = tuple([sharedmem.publish("{0}-{1}".format(name,
+            suffix), array) for suffix, array in \
+                zip(("points", "dispersion", "fluxes"), self._loaded_grid)])
+        return name
+
+
+    def cross_correlation_pool(self):
+        """
+        Return the persistent pool of worker processes that this model uses to
+        cross-correlate spectra against the grid, or None if only one thread is
+        permitted. The pool is created the first time it is required, and is
+        re-used until :func:`close_pool` is called.
+        """
+
+        threads = self.config["settings"]["threads"]
+        if threads < 2:
+            return None
+
+        if getattr(self, "_ccf_pool", None) is None:
+            self._ccf_pool = specutils.cross_correlate.CrossCorrelationPool(
+                threads)
+        return self._ccf_pool
+
+
+    def close_pool(self):
+        """ Close the pool of worker processes used by this model, if any. """
+
+        if getattr(self, "_ccf_pool", None) is not None:
+            self._ccf_pool.close()
+            self._ccf_pool = None
+
+
+    def grid_view(self, dispersion):
+        """
+        Return the (cached) view of the model grid for a channel with some
+        observed dispersion. The view contains the grid pixels that span the
+        channel, the cross-correlation and continuum masks, and the continuum
+        design matrices, which are the same for every star observed with the
+        same instrument setup. The most recently used views are kept, up to the
+        grid_views setting (default 32).
+
+        :param dispersion:
+            The observed dispersion points of the channel.
+
+        :type dispersion:
+            :class:`numpy.array`
+
+        :rtype:
+            :class:`oracle.models.grid.GridView`
+        """
+
+        mask_keys = ("cross_correlation_mask", "continuum_mask")
+        key = grid.fingerprint(dispersion, getattr(self, "_grid_filename", None),
+            [self.config["model"].get(mask_key, None) for mask_key in mask_keys])
+
+        with _grid_view_lock:
+            if not hasattr(self, "_grid_views"):
+                self._grid_views = OrderedDict()
+
+            try:
+                view = self._grid_views.pop(key)
+
+            except KeyError:
+                view = self._grid_view(dispersion, key)
+
+            self._grid_views[key] = view
+            maxsize = self.config["settings"].get("grid_views", 32)
+            while len(self._grid_views) > maxsize:
+                self._grid_views.popitem(last=False)
+            return view
+
+
+    def _grid_view(self, dispersion, key):
+        """ Create the view of the model grid for some observed dispersion. """
+
+        mask_keys = ("cross_correlation_mask", "continuum_mask")
+        grid_dispersion = self._loaded_grid[1]
+        view = grid.GridView(grid_dispersion, dispersion, key=key)
+        for mask_key in mask_keys:
+            view.add_mask(mask_key,
+                ~self.mask(view.dispersion, mask_key=mask_key))
+
+        logger.debug("Created grid view {0} for {1} grid pixels between "
+            "{2:.1f} and {3:.1f}".format(key, view.dispersion.size,
+                view.dispersion[0], view.dispersion[-1]))
+        return view
+
+
     def _continuum_degree(self, channel_index):
         """
         Parse the configuration and return the continuum degree for some channel
@@ -288,7 +541,241 @@ class Model(object):
 
 
 
-    def initial_theta(self, data, full_output=False, method="fast", **kwargs):
+    def _initial_channel_theta(self, i, channel, parameters, method,
+        highest_peak, search):
+        """
+        Return an initial guess of the radial velocity and continuum parameters
+        for a single channel, and the grid point with the highest CCF peak.
+
+        :param i:
+            The index of the channel.
+
+        :type i:
+            int
+
+        :param channel:
+            The observed channel.
+
+        :type channel:
+            :class:`oracle.specutils.Spectrum1D`
+
+        :param parameters:
+            The model parameters.
+
+        :type parameters:
+            list of str
+
+        :param method:
+            The method used to find the initial guess ('fast' or 'slow').
+
+        :type method:
+            str
+
+        :param highest_peak:
+            The grid point with the highest CCF peak in the first channel, which
+            is used for the other channels in 'fast' mode.
+
+        :type highest_peak:
+            int
+
+        :param search:
+            The grid search options for this star.
+
+        :type search:
+            dict
+
+        :returns:
+            The grid point index with the highest CCF peak, the radial velocity
+            (or None if it is not a model parameter), the channel parameters,
+            the expected dispersion and fluxes (or None), and the chi-squared
+            values and log-likelihoods of every grid point (or None).
+        """
+
+        grid_points, grid_dispersion, grid_fluxes = self._loaded_grid
+
+        theta, v_rad, expected = {}, None, None
+
+        # The grid pixels, masks and design matrices for this instrument setup.
+        view = search["views"][i]
+        indices = view.indices
+
+        # Temporarily transform the data to the model dispersion points
+        # (This is far cheaper than the alternative, and is good enough for
+        # a simple cross-correlation)
+        rebinned_channel_disp = view.dispersion
+        rebinned_channel_flux = view.rebin(channel.flux)
+
+        rebinned_channel_flux[rebinned_channel_flux < 0] = np.nan
+        finite = np.isfinite(rebinned_channel_flux)
+
+        # Get the continuum degree
+        degree = self._continuum_degree(i)
+        ccf_mask, (ccf_li, ccf_ri) = view.masked("cross_correlation_mask",
+            finite)
+
+        # Cross-correlate the observed data against the grid
+        if ("v_rad" in parameters) or ("v_rad.{}".format(i) in parameters):
+
+            ccf_disp = rebinned_channel_disp[ccf_li:ccf_ri]
+            ccf_flux = rebinned_channel_flux.copy()
+
+            # Interpolate over the small portions of non-useful pixels
+            if np.any(ccf_mask):
+                ccf_flux[ccf_mask] = np.interp(
+                    rebinned_channel_disp[ccf_mask],
+                    rebinned_channel_disp[~ccf_mask],
+                    ccf_flux[~ccf_mask])
+
+            # Slice edges that are *completely* ccf_masked
+            ccf_flux = ccf_flux[ccf_li:ccf_ri]
+
+            if method == "fast" and i > 0:
+                logger.debug("Using previous point..")
+                v_rads, v_errs, ccf_peaks = \
+                    specutils.cross_correlate.cross_correlate_grid(
+                        ccf_disp, np.array([grid_fluxes[highest_peak,
+                            indices[0]:indices[1]][ccf_li:ccf_ri]]),
+                        ccf_flux, continuum_degree=degree,
+                        threads=self.config["settings"]["threads"],
+                        remeasure_best=True, peak_method=search["peak_method"])
+                v_rad, v_err, ccf_peak = \
+                    v_rads[0], v_errs[0], ccf_peaks[0]
+
+            elif self.config["settings"].get("template_max_memory", None):
+                # Stream the templates so that the grid is never copied
+                # into memory all at once.
+                best, v_rads, v_errs, ccf_peaks = \
+                    specutils.cross_correlate.cross_correlate_grid_stream(
+                        ccf_disp,
+                        grid_fluxes[:, indices[0]:indices[1]][:, ccf_li:ccf_ri],
+                        ccf_flux, num_best=1, continuum_degree=degree,
+                        remeasure_best=True, peak_method=search["peak_method"],
+                        max_memory=self.config[
+                            "settings"]["template_max_memory"],
+                        rows=search["prior_rows"])
+
+                highest_peak = best[0]
+                v_rad, v_err, ccf_peak = v_rads[0], v_errs[0], ccf_peaks[0]
+
+            else:
+                v_rads, v_errs, ccf_peaks = \
+                    specutils.cross_correlate.cross_correlate_grid(
+                        ccf_disp,
+                        grid_fluxes[:, indices[0]:indices[1]][:, ccf_li:ccf_ri],
+                        ccf_flux, continuum_degree=degree,
+                        threads=self.config["settings"]["threads"],
+                        pool=search["pool"],
+                        remeasure_best=True, peak_method=search["peak_method"],
+                        template_cache=self._template_cache,
+                        cache_key=(search["grid_key"], tuple(indices),
+                            ccf_li, ccf_ri),
+                        clusters=search["template_clusters"],
+                        top_clusters=self.config["settings"].get(
+                            "top_template_clusters", 3),
+                        num_components=self.config["settings"].get(
+                            "template_components", None),
+                        rows=search["prior_rows"])
+
+                # Identify the grid point with highest CCF peak
+                highest_peak = np.nanargmax(ccf_peaks)
+                v_rad, v_err, ccf_peak = (v_rads[highest_peak],
+                    v_errs[highest_peak], ccf_peaks[highest_peak])
+
+            logger.debug("Grid point with highest CCF peak in channel "\
+                "{0} is {1} with v_rad = {2:.1f} km/s (+/- {3:.1f} km/"\
+                "s) and R = {4:.3f}".format(i, utils.readable_dict(
+                    grid_points.dtype.names, grid_points[highest_peak]),
+                v_rad, v_err, ccf_peak))
+
+            # Add in this channel velocity.
+            theta["v_rad.{}".format(i)] = v_rad
+
+        # We need the continuum mask regardless of whether continuum is
+        # actually determined or not. This is because the continuum mask
+        # is later used to determine which pixels are used for the nearest
+        # grid point
+        continuum_mask = view.masked("continuum_mask", finite)[0]
+
+        # Calculate the best continuum coefficients.
+        if degree >= 1:
+
+            disp = rebinned_channel_disp[~continuum_mask]
+
+            # Correct for the observed velocity.
+            corrected_disp = disp * (1 - v_rad/constants.c.to("km/s").value)
+            corrected_flux = np.interp(disp, corrected_disp,
+                rebinned_channel_flux[~continuum_mask], left=np.nan,
+                right=np.nan)
+
+            # Best fit from CCF.
+            synthetic_flux = grid_fluxes[highest_peak, indices[0]:indices[1]][~continuum_mask]
+
+            finite = np.isfinite(corrected_flux)
+
+            disp = corrected_disp[finite]
+            corrected_flux = corrected_flux[finite]
+            synthetic_flux = synthetic_flux[finite]
+
+            # The design matrix for the velocity-corrected dispersion points is
+            # a column-scaled version of the one for the grid points.
+            design = view.design(degree + 1)[~continuum_mask][finite] \
+                * (1 - v_rad/constants.c.to("km/s").value)**np.arange(
+                    degree + 1, -1, -1)
+
+            # Linear least-squares.
+            result = _fit_continuum(design, synthetic_flux, corrected_flux,
+                self.config["settings"].get("continuum_sigma_clip", None))[0]
+
+            # Create expected fluxes and save result
+            expected = (disp * (1 + 2 * v_rad/constants.c.to("km/s").value),
+                np.polyval(result, disp) * synthetic_flux)
+
+            for j, coefficient in enumerate(result):
+                theta["continuum.{0}.c{1}".format(i, j)] = coefficient
+
+        else:
+            expected_fluxes = \
+                grid_fluxes[highest_peak, indices[0]:indices[1]]
+
+        # Compare the velocity-corrected channel to every grid model at once.
+        likelihood = None
+        if search["grid_likelihood"]:
+
+            z = (v_rad or 0)/constants.c.to("km/s").value
+            rebinned_channel_variance = view.rebin(channel.variance)
+            corrected_flux, corrected_variance = [np.interp(
+                rebinned_channel_disp, rebinned_channel_disp * (1 - z), _,
+                left=np.nan, right=np.nan) \
+                for _ in (rebinned_channel_flux, rebinned_channel_variance)]
+
+            # Masked pixels are ignored.
+            ivariance = 1.0/corrected_variance
+            ivariance[continuum_mask + ~np.isfinite(corrected_flux) \
+                + ~np.isfinite(ivariance)] = 0
+
+            design = view.design(degree + 1, scaled=True) if degree >= 1 \
+                else None
+
+            rows = search["prior_rows"]
+            model_fluxes = grid_fluxes[:, indices[0]:indices[1]] \
+                if rows is None else grid_fluxes[rows, indices[0]:indices[1]]
+
+            chi_sqs, log_likelihoods = grid.marginalised_chi_sq(
+                corrected_flux, ivariance, model_fluxes, design)
+
+            if rows is not None:
+                likelihood = (np.inf * np.ones(grid_points.size),
+                    -np.inf * np.ones(grid_points.size))
+                likelihood[0][rows], likelihood[1][rows] \
+                    = chi_sqs, log_likelihoods
+            else:
+                likelihood = (chi_sqs, log_likelihoods)
+
+        return (highest_peak, v_rad, theta, expected, likelihood)
+
+
+    def initial_theta(self, data, full_output=False, method="fast",
+        prior_box=None, channel_threads=None, grid_info=False, **kwargs):
         """
         Return an initial guess of the model parameters theta using no prior
         information.
@@ -298,6 +785,40 @@ class Model(object):
 
         :type data:
             list of :class:`oracle.specutils.Spectrum1D` objects
+
+        :param full_output: [optional]
+            Return the expected dispersion and fluxes as well as theta.
+
+        :type full_output:
+            bool
+
+        :param prior_box: [optional]
+            Lower and upper bounds on grid parameters (e.g., from photometry or
+            previous estimates). Only grid points within these bounds will be
+            searched. For example: ``{"effective_temperature": (5000, 6000)}``
+
+        :type prior_box:
+            dict
+
+        :param channel_threads: [optional]
+            The number of channels to process concurrently. The default is the
+            channel_threads setting, or one.
+
+        :type channel_threads:
+            int
+
+        :param grid_info: [optional]
+            Also return a dictionary with the 'chi_sq' and 'posterior'
+            probability of every grid point (both None unless the
+            grid_likelihood setting is used).
+
+        :type grid_info:
+            bool
+
+        :returns:
+            The initial theta. With `full_output`, this is followed by the
+            expected dispersion and the expected fluxes. With `grid_info`, the
+            grid likelihood dictionary is returned last.
         """
 
         if not isinstance(data, (tuple, list)):
@@ -315,11 +836,54 @@ class Model(object):
         # This will include the stellar parameters (grid points), dispersion
         # points, and fluxes
         if not hasattr(self, "_loaded_grid"):
-            filename = kwargs.pop("grid_filename", None)
+            filename = kwargs.pop("grid_filename", None) \
+                or getattr(self, "_grid_filename", None)
             self._loaded_grid = self._load_grid(filename)
+            self._grid_filename = filename
 
         grid_points, grid_dispersion, grid_fluxes = self._loaded_grid
 
+        # The template transforms do not change between stars, so we keep them.
+        if not hasattr(self, "_template_cache"):
+            self._template_cache = specutils.cross_correlate.TemplateCache(
+                self.config["settings"].get("template_cache", None))
+        grid_key = getattr(self, "_grid_filename", None)
+
+        # Should we perform a hierarchical search of the grid?
+        num_clusters = self.config["settings"].get("template_clusters", 0)
+        if num_clusters > 0 and not hasattr(self, "_template_clusters"):
+            self.cluster_grid(num_clusters)
+        template_clusters = getattr(self, "_template_clusters", None)
+
+        # How should the highest CCF peaks be re-measured?
+        peak_method = self.config["settings"].get("ccf_peak_method", "fit")
+
+        # Restrict the search to grid points within the prior box.
+        if prior_box is None:
+            prior_rows = None
+
+        else:
+            if not hasattr(self, "_grid_index"):
+                self._grid_index = grid.GridIndex(grid_points)
+            prior_rows = self._grid_index.box(prior_box)
+            if prior_rows.size == 0:
+                raise ValueError("no grid points within the prior box {}"\
+                    .format(prior_box))
+            logger.debug("Searching {0} of {1} grid points within the prior "
+                "box".format(prior_rows.size, grid_points.size))
+
+        # The views are created before any channels are analysed concurrently.
+        search = {
+            "views": [self.grid_view(channel.disp) for channel in data],
+            "grid_key": grid_key,
+            "template_clusters": template_clusters,
+            "peak_method": peak_method,
+            "prior_rows": prior_rows,
+            "pool": self.cross_correlation_pool(),
+            "grid_likelihood": self.config["settings"].get("grid_likelihood",
+                False)
+        }
+
         theta = {}
         num_pixels = 0
         continuum_coefficients = {}
@@ -327,155 +891,54 @@ class Model(object):
         expected_channel_fluxes = []
         closest_grid_points = []
         chi_sqs = np.zeros(grid_points.size)
+        log_likelihoods = np.zeros(grid_points.size)
+
+        channel_threads = channel_threads or \
+            self.config["settings"].get("channel_threads", 1)
+
+        def channel_theta(args):
+            i, channel, highest_peak = args
+            return self._initial_channel_theta(i, channel, parameters, method,
+                highest_peak, search)
+
+        # Channels after the first re-use the first grid point in fast mode, so
+        # the first channel must be done first.
+        results = []
+        if method == "fast":
+            results.append(channel_theta((0, data[0], None)))
+            remaining = [(i, channel, results[0][0]) \
+                for i, channel in enumerate(data) if i > 0]
+        else:
+            remaining = [(i, channel, None) for i, channel in enumerate(data)]
 
-        for i, channel in enumerate(data):
-
-            # Splice the wavelengths
-            indices = grid_dispersion.searchsorted(
-                [channel.disp[0], channel.disp[-1]]) + [0, 1]
-
-            # Temporarily transform the data to the model dispersion points
-            # (This is far cheaper than the alternative, and is good enough for
-            # a simple cross-correlation)
-            rebinned_channel_disp = grid_dispersion[indices[0]:indices[1]]
-            rebinned_channel_flux = np.interp(rebinned_channel_disp,
-                channel.disp, channel.flux, left=np.nan, right=np.nan)
-
-            rebinned_channel_flux[rebinned_channel_flux < 0] = np.nan
-
-            # Get the continuum degree
-            degree = self._continuum_degree(i)
-            ccf_mask = ~(self.mask(rebinned_channel_disp,
-                mask_key="cross_correlation_mask") \
-                * np.isfinite(rebinned_channel_flux))
-
-            # Cross-correlate the observed data against the grid
-            if ("v_rad" in parameters) or ("v_rad.{}".format(i) in parameters):
-
-                # Apply the cross-correlation mask
-                if np.any(ccf_mask):
-
-                    ccf_disp = rebinned_channel_disp
-                    ccf_flux = rebinned_channel_flux.copy()
-
-                    # Interpolate over the small portions of non-useful pixels
-                    ccf_flux[ccf_mask] = np.interp(
-                        ccf_disp[ccf_mask],
-                        ccf_disp[~ccf_mask],
-                        ccf_flux[~ccf_mask])
-
-                    # Slice edges that are *completely* ccf_masked
-                    changes = np.where(np.diff(ccf_mask))[0]
-                    ccf_li = None if not ccf_mask[0]  else changes[0]  + 1
-                    ccf_ri = None if not ccf_mask[-1] else changes[-1] - 1
-
-                    ccf_disp = ccf_disp[ccf_li:ccf_ri]
-                    ccf_flux = ccf_flux[ccf_li:ccf_ri]
-
-                    ccf_li = [ccf_li, 0][ccf_li is None]
-                    ccf_ri = [ccf_ri, None][ccf_ri is None]
-
+        if channel_threads > 1 and len(remaining) > 1:
+            # The grid is shared (read-only) between the threads. The template
+            # cache has its own lock, and the views and template clusters were
+            # created above.
+            pool = ThreadPool(min(channel_threads, len(remaining)))
+            results.extend(pool.map(channel_theta, remaining))
+            pool.close()
+            pool.join()
 
-                else:
-                    ccf_li, ccf_ri = 0, 0
-                    ccf_disp = rebinned_channel_disp
-                    ccf_flux = rebinned_channel_flux.copy()
-
-                if method == "fast" and i > 0:
-                    logger.debug("Using previous point..")
-                    v_rads, v_errs, ccf_peaks = \
-                        specutils.cross_correlate.cross_correlate_grid(
-                            ccf_disp, np.array([grid_fluxes[highest_peak,
-                                indices[0]:indices[1]][ccf_li:ccf_ri]]),
-                            ccf_flux, continuum_degree=degree,
-                            threads=self.config["settings"]["threads"],
-                            remeasure_best=True)
-                    v_rad, v_err, ccf_peak = \
-                        v_rads[0], v_errs[0], ccf_peaks[0]
+        else:
+            results.extend(map(channel_theta, remaining))
 
-                else:
-                    v_rads, v_errs, ccf_peaks = \
-                        specutils.cross_correlate.cross_correlate_grid(
-                            ccf_disp,
-                            grid_fluxes[:, indices[0]:indices[1]][:, ccf_li:ccf_ri],
-                            ccf_flux, continuum_degree=degree,
-                            threads=self.config["settings"]["threads"],
-                            remeasure_best=True)
-
-                    # Identify the grid point with highest CCF peak
-                    highest_peak = ccf_peaks.argmax()
-                    v_rad, v_err, ccf_peak = (v_rads[highest_peak],
-                        v_errs[highest_peak], ccf_peaks[highest_peak])
-
-                logger.debug("Grid point with highest CCF peak in channel "\
-                    "{0} is {1} with v_rad = {2:.1f} km/s (+/- {3:.1f} km/"\
-                    "s) and R = {4:.3f}".format(i, utils.readable_dict(
-                        grid_points.dtype.names, grid_points[highest_peak]),
-                    v_rad, v_err, ccf_peak))
-
-                if "v_rad" in parameters:
-                    # Global, so add it to a list which we will use to take an
-                    # average from later
-                    if "v_rad" in theta:
-                        theta["v_rad"].append(v_rad)
-                    else:
-                        theta["v_rad"] = [v_rad]
-
-                # Either way, add in this channel velocity.
-                theta["v_rad.{}".format(i)] = v_rad
+        # Merge the channel results.
+        for highest_peak, v_rad, channel_parameters, expected, likelihood \
+            in results:
+            if "v_rad" in parameters and v_rad is not None:
+                # Global, so add it to a list which we will use to take an
+                # average from later
+                theta.setdefault("v_rad", []).append(v_rad)
 
+            theta.update(channel_parameters)
             closest_grid_points.append(highest_peak)
-
-            # We need the continuum mask regardless of whether continuum is
-            # actually determined or not. This is because the continuum mask
-            # is later used to determine which pixels are used for the nearest
-            # grid point
-            continuum_mask = ~(self.mask(rebinned_channel_disp,
-                mask_key="continuum_mask") * np.isfinite(rebinned_channel_flux))
-
-            # Calculate the best continuum coefficients.
-            if degree >= 1:
-
-                disp = rebinned_channel_disp[~continuum_mask]
-
-                # Correct for the observed velocity.
-                corrected_disp = disp * (1 - v_rad/constants.c.to("km/s").value)
-                corrected_flux = np.interp(disp, corrected_disp,
-                    rebinned_channel_flux[~continuum_mask], left=np.nan,
-                    right=np.nan)
-
-                # Best fit from CCF.
-                synthetic_flux = grid_fluxes[highest_peak, indices[0]:indices[1]][~continuum_mask]
-
-                finite = np.isfinite(corrected_flux)
-
-                disp = corrected_disp[finite]
-                corrected_flux = corrected_flux[finite]
-                synthetic_flux = synthetic_flux[finite]
-
-                # Initial guess.
-                p0 = np.polyfit(disp, corrected_flux/synthetic_flux, degree+1)
-
-                # Optimize.
-                difference = lambda p: np.polyval(p, disp) * synthetic_flux \
-                    - corrected_flux
-                chi_sq = lambda p: np.sum(difference(p)**2)
-
-                # Slow, but reliable.
-                result = op.fmin(chi_sq, p0, disp=False)
-
-                # Create expected fluxes and save result
-                expected_channel_disp.append(
-                    disp * (1 + 2 * v_rad/constants.c.to("km/s").value))
-                expected_channel_fluxes.append(
-                    (np.polyval(result, disp) * synthetic_flux))
-
-                for j, coefficient in enumerate(result):
-                    theta["continuum.{0}.c{1}".format(i, j)] = coefficient
-
-            else:
-                expected_fluxes = \
-                    grid_fluxes[highest_peak, indices[0]:indices[1]]
+            if expected is not None:
+                expected_channel_disp.append(expected[0])
+                expected_channel_fluxes.append(expected[1])
+            if likelihood is not None:
+                chi_sqs += likelihood[0]
+                log_likelihoods += likelihood[1]
 
         # Do we need to conglomerate radial velocity measurements together?
         if "v_rad" in parameters:
@@ -484,8 +947,17 @@ class Model(object):
                 "{1:.1f} km/s".format(theta["v_rad"], median_v_rad))
             theta["v_rad"] = median_v_rad
 
-        closest_grid_point = grid_points[max(set(closest_grid_points),
-            key=closest_grid_points.count)]
+        grid_likelihood = {"chi_sq": None, "posterior": None}
+        if search["grid_likelihood"]:
+            # Use the grid point with the highest posterior probability.
+            grid_likelihood.update(chi_sq=chi_sqs,
+                posterior=grid.posterior(log_likelihoods))
+            closest_grid_point = \
+                grid_points[grid_likelihood["posterior"].argmax()]
+
+        else:
+            closest_grid_point = grid_points[max(set(closest_grid_points),
+                key=closest_grid_points.count)]
 
         # Update theta with the nearest grid point
         theta.update(dict(zip(self._stellar_parameters, closest_grid_point)))
@@ -503,10 +975,13 @@ class Model(object):
             ", ".join(missing_parameters)))
 
         self._initial_theta = theta
+        output = (theta, )
         if full_output:
-            return (theta, np.hstack(expected_channel_disp),
+            output += (np.hstack(expected_channel_disp),
                 np.hstack(expected_channel_fluxes))
-        return theta
+        if grid_info:
+            output += (grid_likelihood, )
+        return output if len(output) > 1 else theta
 
 
     def fit_absorption_profile(self, wavelength, spectrum, continuum=None,
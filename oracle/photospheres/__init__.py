@@ -7,7 +7,7 @@ __author__ = "Andy Casey <arc@ast.cam.ac.uk>"
 
 import logging
 
-from .photosphere import Photosphere
+from .photosphere import Photosphere, write_moog
 from .abundances import asplund_2009 as solar_abundance
 from .castelli_kurucz import Interpolator as ck_interp
 from .marcs import Interpolator as marcs_interp
@@ -20,6 +20,7 @@ import scipy.interpolate as interpolate
 from scipy import __version__ as scipy_version
 
 from .photosphere import Photosphere
+from oracle import sharedmem
 
 major, minor = map(int, str(scipy_version).split(".")[:2])
 has_scipy_requirements = (major > 0 or minor >= 14)
@@ -101,6 +102,32 @@ class BaseInterpolator(object):
         return self.interpolate(*args, **kwargs)
 
 
+    def share(self, name=None):
+        """
+        Publish the grid of photospheres to shared memory. When the interpolator
+        is subsequently sent to other processes, the workers will attach to the
+        published arrays by name instead of receiving a copy.
+
+        :param name: [optional]
+            The name to publish the photospheres as. If not given, a name that
+            is unique to this process and interpolator is used.
+
+        :type name:
+            str
+
+        :returns:
+            The name of the published photospheres.
+        """
+
+        if name is None:
+            name = "photospheres-{0}-{1}".format(os.getpid(), id(self))
+
+        self.stellar_parameters = sharedmem.publish("{}-points".format(name),
+            self.stellar_parameters)
+        self.photospheres = sharedmem.publish(name, self.photospheres)
+        return name
+
+
     def _return_photosphere(self, stellar_parameters, quantities):
         """ 
         Prepare the interpolated photospheric quantities (with correct columns,
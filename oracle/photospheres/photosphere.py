@@ -8,10 +8,12 @@ from __future__ import division, absolute_import, print_function
 __author__ = "Andy Casey <arc@ast.cam.ac.uk>"
 
 import logging
+import os
 from textwrap import dedent
 
 import astropy.io
 import astropy.table
+import numpy as np
 
 # Create logger.
 logger = logging.getLogger(__name__)
@@ -24,10 +26,11 @@ class Photosphere(astropy.table.Table):
 
 
 # MOOG writer and identifier.
-def _moog_writer(photosphere, filename, **kwargs):
+def _moog_format(photosphere):
     """
-    Writes an :class:`oracle.photospheres.photosphere` to file in a MOOG-friendly
-    format.
+    Return the contents of a MOOG-friendly file for an
+    :class:`oracle.photospheres.photosphere`. The photospheric structure is
+    formatted as a whole array, rather than one depth at a time.
     """
 
     def _get_xi():
@@ -51,16 +54,10 @@ def _moog_writer(photosphere, filename, **kwargs):
                 photosphere.meta["stellar_parameters"]["metallicity"],
                 xi)).lstrip()
 
-        for i, line in enumerate(photosphere):
-            output += " {0:>3.0f} {0:>3.0f} {1:10.3e} {0:>3.0f} {2:10.3e} "\
-                "{3:10.3e} {4:10.3e}\n".format(i + 1, line["lgTau5"], line["T"],
-                    line["Pe"], line["Pg"])
-
-        output += "         {0:.3f}\n".format(xi)
-        output += "NATOMS        0     {0:.3f}\n".format(
-            photosphere.meta["stellar_parameters"]["metallicity"])
-        output += "NMOL          0\n"
-
+        index = np.arange(1, len(photosphere) + 1)
+        structure = np.array([index, index, photosphere["lgTau5"], index,
+            photosphere["T"], photosphere["Pe"], photosphere["Pg"]]).T
+        row_format = " %3.0f %3.0f %10.3e %3.0f %10.3e %10.3e %10.3e\n"
 
     elif photosphere.meta["kind"] == "castelli/kurucz":
 
@@ -77,25 +74,102 @@ def _moog_writer(photosphere, filename, **kwargs):
                 photosphere.meta["stellar_parameters"]["alpha_enhancement"],
                 xi)).lstrip()
 
-        for line in photosphere:
-            output += " {0:.8e} {1:10.3e}{2:10.3e}{3:10.3e}{4:10.3e}\n".format(
-                line["RHOX"], line["T"], line["P"], line["XNE"], line["ABROSS"])
-
-        output += "         {0:.3f}\n".format(xi)
-        output += "NATOMS        0     {0:.3f}\n".format(
-            photosphere.meta["stellar_parameters"]["metallicity"])
-        output += "NMOL          0\n"
+        structure = np.array([photosphere["RHOX"], photosphere["T"],
+            photosphere["P"], photosphere["XNE"], photosphere["ABROSS"]]).T
+        row_format = " %.8e %10.3e%10.3e%10.3e%10.3e\n"
 
     else:
         raise ValueError("photosphere kind '{}' cannot be written to a MOOG-"\
             "compatible format".format(photosphere.meta["kind"]))
 
+    output += (row_format * structure.shape[0]) % tuple(structure.flatten())
+    output += "         {0:.3f}\n".format(xi)
+    output += "NATOMS        0     {0:.3f}\n".format(
+        photosphere.meta["stellar_parameters"]["metallicity"])
+    output += "NMOL          0\n"
+    return output
+
+
+def _moog_writer(photosphere, filename, **kwargs):
+    """
+    Writes an :class:`oracle.photospheres.photosphere` to file in a MOOG-friendly
+    format.
+    """
+
     with open(filename, "w") as fp:
-        fp.write(output)
+        fp.write(_moog_format(photosphere))
 
     return None
 
 
+def write_moog(photospheres, filenames=None, archive=None, clobber=True):
+    """
+    Write many photospheres to disk in a MOOG-friendly format, using the same
+    format as the registered ``moog`` writer for
+    :class:`oracle.photospheres.photosphere` objects.
+
+    :param photospheres:
+        The photospheres to write.
+
+    :type photospheres:
+        iterable of :class:`oracle.photospheres.photosphere` objects
+
+    :param filenames: [optional]
+        The filenames to write each photosphere to.
+
+    :type filenames:
+        list of str
+
+    :param archive: [optional]
+        The filename to write all of the photospheres to, one after another.
+
+    :type archive:
+        str
+
+    :param clobber: [optional]
+        Overwrite existing files.
+
+    :type clobber:
+        bool
+
+    :returns:
+        The number of photospheres written.
+
+    :rtype:
+        int
+    """
+
+    if (filenames is None) == (archive is None):
+        raise ValueError("either filenames or an archive filename is required")
+
+    if filenames is not None:
+        photospheres = list(photospheres)
+        if len(filenames) != len(photospheres):
+            raise ValueError("number of filenames ({0}) does not match the "
+                "number of photospheres ({1})".format(len(filenames),
+                    len(photospheres)))
+
+        if not clobber:
+            existing = filter(os.path.exists, filenames)
+            if len(existing) > 0:
+                raise IOError("{0} filenames already exist, including {1}"\
+                    .format(len(existing), existing[0]))
+
+        for photosphere, filename in zip(photospheres, filenames):
+            _moog_writer(photosphere, filename)
+        return len(filenames)
+
+    if os.path.exists(archive) and not clobber:
+        raise IOError("archive filename {} already exists".format(archive))
+
+    N = 0
+    with open(archive, "w") as fp:
+        for photosphere in photospheres:
+            fp.write(_moog_format(photosphere))
+            N += 1
+    return N
+
+
 def _moog_identifier(*args, **kwargs):
     return isinstance(args[0], basestring) and args[0].lower().endswith(".moog")
 
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Run the stages of an analysis concurrently for many stars. """
+
+from __future__ import division, absolute_import, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+__all__ = ["Pipeline", "Result", "Stage"]
+
+# Standard library.
+import logging
+import multiprocessing
+import sys
+import threading
+import traceback
+from Queue import Empty, Full, Queue
+from time import time
+
+logger = logging.getLogger("oracle")
+
+# Marks the end of the items in a queue.
+_DONE = object()
+
+
+def _put(queue, item, stop):
+    """ Put an item in a queue, unless the pipeline is stopped. """
+
+    while not stop.is_set():
+        try:
+            queue.put(item, True, 0.1)
+        except Full:
+            continue
+        return True
+    return False
+
+
+class Stage(object):
+    """
+    A stage of a pipeline, which transforms the output of the previous stage.
+
+    :param name:
+        The name of the stage.
+
+    :type name:
+        str
+
+    :param function:
+        The function to call with the output of the previous stage (or the
+        item, for the first stage). Functions for stages that run in processes
+        must be importable at the module level, so that they can be pickled.
+
+    :type function:
+        callable
+
+    :param workers: [optional]
+        The maximum number of items in this stage at once.
+
+    :type workers:
+        int
+
+    :param processes: [optional]
+        Run the function in worker processes instead of threads. This is best
+        for stages that hold the GIL (e.g., pure Python loops), while threads
+        are best for stages that wait on I/O or release the GIL (e.g., NumPy,
+        FFTs, or MOOG).
+
+    :type processes:
+        bool
+    """
+
+    def __init__(self, name, function, workers=1, processes=False):
+
+        if 1 > workers:
+            raise ValueError("workers must be a positive integer")
+
+        self.name = name
+        self.function = function
+        self.workers = int(workers)
+        self.processes = processes
+
+
+    def __repr__(self):
+        return "<oracle.pipeline.Stage {0} with {1} {2}>".format(self.name,
+            self.workers, ["threads", "processes"][self.processes])
+
+
+class Result(object):
+    """
+    The outcome of an item that has been through a pipeline.
+
+    :ivar index:
+        The index of the item in the input.
+
+    :ivar item:
+        The input item.
+
+    :ivar value:
+        The output of the last stage, or None if a stage failed.
+
+    :ivar error:
+        The formatted exception if a stage failed, otherwise None.
+
+    :ivar stage:
+        The name of the stage that failed, if any.
+
+    :ivar timings:
+        The time taken (in seconds) by each completed stage.
+    """
+
+    def __init__(self, index, item):
+        self.index = index
+        self.item = item
+        self.value = item
+        self.error = None
+        self.stage = None
+        self.timings = {}
+
+
+    @property
+    def success(self):
+        return self.error is None
+
+
+    def __repr__(self):
+        return "<oracle.pipeline.Result {0} {1}>".format(self.index,
+            "succeeded" if self.success \
+                else "failed in stage {}".format(self.stage))
+
+
+class Pipeline(object):
+    """
+    Run items (e.g., stars) through a sequence of stages, where every stage has
+    its own pool of workers. Items move to the next stage as soon as they are
+    finished, so (for example) the spectra of the next star can be loaded and
+    cross-correlated while the previous star is in a MOOG-bound stage.
+
+    The queues between stages are bounded, so a fast stage cannot race ahead of
+    a slow one and hold many items in memory.
+
+    :param stages:
+        The stages of the pipeline, in order.
+
+    :type stages:
+        list of :class:`Stage`
+
+    :param max_queued: [optional]
+        The maximum number of items waiting before each stage.
+
+    :type max_queued:
+        int
+    """
+
+    def __init__(self, stages, max_queued=4):
+
+        if len(stages) == 0:
+            raise ValueError("no stages given")
+
+        names = [stage.name for stage in stages]
+        if len(set(names)) < len(names):
+            raise ValueError("stage names must be unique")
+
+        self.stages = list(stages)
+        self.max_queued = max_queued
+
+
+    def _work(self, stage, pool, inbox, outbox, remaining, lock, num_next,
+        stop):
+        """ Process items from the inbox of a stage until it is done. """
+
+        while not stop.is_set():
+            try:
+                result = inbox.get(True, 0.1)
+            except Empty:
+                continue
+
+            if result is _DONE:
+                # The last worker of this stage tells the next stage.
+                with lock:
+                    remaining[0] -= 1
+                    if remaining[0] == 0:
+                        for _ in xrange(num_next):
+                            _put(outbox, _DONE, stop)
+                return
+
+            if result.success:
+                t_init = time()
+                try:
+                    if pool is None:
+                        result.value = stage.function(result.value)
+                    else:
+                        result.value = pool.apply(stage.function,
+                            (result.value, ))
+
+                except:
+                    result.value = None
+                    result.stage = stage.name
+                    result.error = traceback.format_exc()
+                    logger.exception("Exception raised in stage {0} for item "
+                        "{1}".format(stage.name, result.index))
+
+                else:
+                    result.timings[stage.name] = time() - t_init
+
+            _put(outbox, result, stop)
+
+
+    def run(self, items):
+        """
+        Run items through the pipeline.
+
+        :param items:
+            The items to analyse (e.g., the filenames of each star).
+
+        :type items:
+            iterable
+
+        :returns:
+            A generator of :class:`Result` objects, in the order that they are
+            completed. If iterating over the items raises an exception, it is
+            raised once the items before it have been through the pipeline.
+        """
+
+        queues = [Queue(self.max_queued) for _ in self.stages] + [Queue()]
+
+        # Stops the threads if the results are not all consumed.
+        stop = threading.Event()
+
+        # Start the worker processes before any threads.
+        pools = [multiprocessing.Pool(stage.workers) if stage.processes \
+            else None for stage in self.stages]
+
+        threads = []
+        for i, (stage, pool) in enumerate(zip(self.stages, pools)):
+            num_next = self.stages[i + 1].workers \
+                if i + 1 < len(self.stages) else 1
+            args = (stage, pool, queues[i], queues[i + 1], [stage.workers],
+                threading.Lock(), num_next, stop)
+            for _ in xrange(stage.workers):
+                thread = threading.Thread(target=self._work, args=args,
+                    name="{0}-{1}".format(stage.name, len(threads)))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        # An exception raised by the items, which is raised by the generator.
+        feed_error = []
+
+        def feed():
+            try:
+                for index, item in enumerate(items):
+                    if not _put(queues[0], Result(index, item), stop):
+                        return
+            except:
+                feed_error.append(sys.exc_info())
+            finally:
+                for _ in xrange(self.stages[0].workers):
+                    _put(queues[0], _DONE, stop)
+
+        feeder = threading.Thread(target=feed, name="feeder")
+        feeder.daemon = True
+        feeder.start()
+
+        finished = False
+        try:
+            while True:
+                # Waiting with a timeout allows the wait to be interrupted.
+                try:
+                    result = queues[-1].get(True, 1)
+                except Empty:
+                    continue
+
+                if result is _DONE:
+                    finished = True
+                    break
+                yield result
+
+            if feed_error:
+                raise feed_error[0][0], feed_error[0][1], feed_error[0][2]
+
+        finally:
+            # Stop any outstanding work if we were interrupted.
+            stop.set()
+            for pool in pools:
+                if pool is None: continue
+                if finished:
+                    pool.close()
+                else:
+                    pool.terminate()
+                pool.join()
+
+            # Idle threads notice the stop within a fraction of a second.
+            deadline = time() + 1
+            for thread in threads + [feeder]:
+                thread.join(max(0, deadline - time()))
+
+
+    def map(self, items):
+        """
+        Run items through the pipeline and return all of the results.
+
+        :param items:
+            The items to analyse.
+
+        :type items:
+            iterable
+
+        :returns:
+            A list of :class:`Result` objects, in the same order as the items.
+        """
+
+        return sorted(self.run(items), key=lambda result: result.index)
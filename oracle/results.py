@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Record the results and progress of runs over many sources. """
+
+from __future__ import division, absolute_import, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+__all__ = ["CSVTable", "Manifest"]
+
+# Standard library.
+import csv
+import json
+import logging
+import os
+from hashlib import md5
+
+logger = logging.getLogger("oracle")
+
+
+class CSVTable(object):
+    """
+    A table of results that are written to a CSV file as they arrive, so that
+    the results of a long batch are not lost if it is interrupted.
+
+    The columns are the given leading columns, followed by the (sorted) keys of
+    the first successful result. Rows are held back until the first successful
+    result arrives. If a later row has keys that are not in the columns (e.g.,
+    a star with more channels), the columns are widened and the table is
+    rewritten.
+
+    :param filename:
+        The filename to write the table to.
+
+    :type filename:
+        str
+
+    :param columns:
+        The leading columns of the table, which every row will have.
+
+    :type columns:
+        list of str
+
+    :param success_column: [optional]
+        The column that indicates whether a row is a successful result.
+
+    :type success_column:
+        str
+
+    :param append: [optional]
+        Append rows to an existing table, using (and widening) its columns.
+
+    :type append:
+        bool
+    """
+
+    def __init__(self, filename, columns, success_column="success",
+        append=False):
+
+        self.filename = filename
+        self.columns = list(columns)
+        self.success_column = success_column
+
+        self._writer = None
+        self._pending = []
+        self.num_rows = 0
+
+        existing = None
+        if append and os.path.exists(filename):
+            with open(filename, "rb") as fp:
+                existing = list(csv.reader(fp))
+
+        if existing:
+            self.columns = existing[0]
+            self.num_rows = len(existing) - 1
+            self._fp = open(filename, "ab")
+            self._writer = csv.DictWriter(self._fp, self.columns,
+                extrasaction="ignore", restval="")
+
+        else:
+            self._fp = open(filename, "wb")
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def _start(self, row=None):
+        """ Write the header of the table. """
+
+        keys = set().union(*[row or {}] + self._pending)
+        self.columns.extend(sorted(keys.difference(self.columns)))
+
+        self._writer = csv.DictWriter(self._fp, self.columns,
+            extrasaction="ignore", restval="")
+        self._writer.writeheader()
+        for pending in self._pending:
+            self._write(pending)
+        self._pending = []
+
+
+    def _widen(self, row):
+        """
+        Rewrite an existing table with the columns of a row added to its header.
+        """
+
+        self._fp.close()
+        with open(self.filename, "rb") as fp:
+            rows = list(csv.DictReader(fp))
+
+        self.columns.extend(sorted(set(row).difference(self.columns)))
+        temporary_filename = "{}.tmp".format(self.filename)
+        with open(temporary_filename, "wb") as fp:
+            writer = csv.DictWriter(fp, self.columns, restval="")
+            writer.writeheader()
+            writer.writerows(rows)
+        os.rename(temporary_filename, self.filename)
+
+        self._fp = open(self.filename, "ab")
+        self._writer = csv.DictWriter(self._fp, self.columns,
+            extrasaction="ignore", restval="")
+
+
+    def _write(self, row):
+        self._writer.writerow(row)
+        self._fp.flush()
+        self.num_rows += 1
+
+
+    def write(self, row):
+        """
+        Add a row to the table.
+
+        :param row:
+            The values for each column.
+
+        :type row:
+            dict
+
+        :returns:
+            The (one-indexed) number of the row in the table.
+        """
+
+        if self._writer is None:
+            if not row.get(self.success_column, False):
+                self._pending.append(row)
+                return self.num_rows + len(self._pending)
+            self._start(row)
+
+        extra = set(row).difference(self.columns)
+        if extra:
+            logger.info("Adding columns to the table {0}: {1}".format(
+                self.filename, ", ".join(sorted(extra))))
+            self._widen(row)
+        self._write(row)
+        return self.num_rows
+
+
+    def close(self):
+        """ Write any rows that are held back and close the file. """
+
+        if self._fp.closed:
+            return
+
+        if self._writer is None:
+            self._start()
+        self._fp.close()
+        logger.info("Saved {0} rows to {1}".format(self.num_rows,
+            self.filename))
+
+
+class Manifest(object):
+    """
+    A record of the sources in a run, which allows an interrupted run to be
+    resumed. Each time a source is attempted, a line containing its status, the
+    hash of its input files, the number of attempts, and the row of its result
+    in the results table is appended to a JSON-lines file. The last line for a
+    source describes its current state.
+
+    :param filename:
+        The filename of the manifest.
+
+    :type filename:
+        str
+
+    :param overwrite: [optional]
+        Ignore (and replace) any existing manifest.
+
+    :type overwrite:
+        bool
+    """
+
+    def __init__(self, filename, overwrite=False):
+
+        self.filename = filename
+        self.entries = {}
+
+        if os.path.exists(filename) and not overwrite:
+            with open(filename, "r") as fp:
+                for i, line in enumerate(fp):
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line may be incomplete if a run crashed.
+                        logger.warn("Ignoring unreadable line {0} of manifest "
+                            "{1}".format(i + 1, filename))
+                        continue
+                    self.entries[entry["key"]] = entry
+
+            logger.info("Loaded {0} sources from manifest {1}".format(
+                len(self.entries), filename))
+
+        self._fp = open(filename, "w" if overwrite else "a+")
+
+        # Start new entries on a new line, even after an incomplete line.
+        self._fp.seek(0, os.SEEK_END)
+        if self._fp.tell() > 0:
+            self._fp.seek(-1, os.SEEK_END)
+            if self._fp.read(1) != "\n":
+                self._fp.seek(0, os.SEEK_END)
+                self._fp.write("\n")
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    @staticmethod
+    def key(filenames):
+        """ Return the key of a source with the given input filenames. """
+        return ";".join(filenames)
+
+
+    @staticmethod
+    def hash(filenames):
+        """
+        Return a MD5 hash of the contents of the input files for a source, or
+        None if any of the files cannot be read.
+
+        :param filenames:
+            The input filenames.
+
+        :type filenames:
+            list of str
+        """
+
+        digest = md5()
+        for filename in filenames:
+            try:
+                with open(filename, "rb") as fp:
+                    for chunk in iter(lambda: fp.read(2**20), b""):
+                        digest.update(chunk)
+            except IOError:
+                return None
+        return digest.hexdigest()
+
+
+    def pending(self, filenames, digest, max_attempts=3):
+        """
+        Return whether a source still needs to be run: either it has not been
+        attempted, its inputs have changed since it was run, or it failed fewer
+        than the maximum number of times.
+
+        :param filenames:
+            The input filenames of the source.
+
+        :type filenames:
+            list of str
+
+        :param digest:
+            The hash of the contents of the input files (see :func:`hash`).
+
+        :type digest:
+            str
+
+        :param max_attempts: [optional]
+            The maximum number of times a failed source is attempted.
+
+        :type max_attempts:
+            int
+        """
+
+        entry = self.entries.get(self.key(filenames), None)
+        if entry is None or entry["hash"] != digest:
+            return True
+        return entry["status"] != "done" and entry["attempts"] < max_attempts
+
+
+    def record(self, filenames, digest, success, **kwargs):
+        """
+        Record an attempt of a source in the manifest.
+
+        :param filenames:
+            The input filenames of the source.
+
+        :type filenames:
+            list of str
+
+        :param digest:
+            The hash of the contents of the input files (see :func:`hash`).
+
+        :type digest:
+            str
+
+        :param success:
+            Whether the attempt was successful.
+
+        :type success:
+            bool
+
+        Any additional keyword arguments (e.g., the row in the results table,
+        or the error) are stored in the entry.
+        """
+
+        key = self.key(filenames)
+        previous = self.entries.get(key, None)
+        attempts = 1 if previous is None or previous["hash"] != digest \
+            else previous["attempts"] + 1
+
+        entry = kwargs.copy()
+        entry.update(key=key, filenames=list(filenames), hash=digest,
+            status="done" if success else "failed", attempts=attempts)
+        self.entries[key] = entry
+
+        self._fp.write(json.dumps(entry, sort_keys=True) + "\n")
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        return entry
+
+
+    def close(self):
+        if not self._fp.closed:
+            self._fp.close()
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" A long-lived local analysis server that keeps grids and models loaded. """
+
+from __future__ import division, absolute_import, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+__all__ = ["Analyst", "serve"]
+
+# Standard library.
+import json
+import logging
+import os
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from time import time
+
+# Third-party.
+import numpy as np
+from astropy.table import Table
+
+# Module-specific.
+from oracle import photospheres, specutils, synthesis
+
+logger = logging.getLogger("oracle")
+
+
+def _serialise(value):
+    """ Convert arrays and numpy scalars so that they can be JSON-encoded. """
+
+    if isinstance(value, dict):
+        return dict([(k, _serialise(v)) for k, v in value.items()])
+    if isinstance(value, (list, tuple)):
+        return map(_serialise, value)
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class Analyst(object):
+    """
+    The analysis state that is kept between requests: a model with its grid,
+    template transforms and worker pool, photosphere interpolators, and line
+    lists.
+
+    :param model:
+        The model used to estimate initial parameters.
+
+    :type model:
+        :class:`oracle.models.Model`
+
+    :param grid_filename: [optional]
+        The filename of the model grid (a pickle or a memory-mapped grid
+        directory). By default the grid packaged with oracle is used.
+
+    :type grid_filename:
+        str
+
+    :param photosphere_kinds: [optional]
+        The kinds of model photospheres to load before the first request.
+
+    :type photosphere_kinds:
+        tuple of str
+    """
+
+    def __init__(self, model, grid_filename=None, photosphere_kinds=()):
+
+        self.model = model
+        self.started = time()
+        self.requests = 0
+
+        self._interpolators = {}
+        self._transitions = {}
+        self._lock = threading.Lock()
+
+        # The model lazily creates (and caches) its pool, template transforms
+        # and grid views, so only one estimate can use it at a time.
+        self._estimate_lock = threading.Lock()
+
+        # Requests are counted by the handler threads.
+        self._requests_lock = threading.Lock()
+
+        # Load everything now, not during the first request.
+        t_init = time()
+        self.model._loaded_grid = self.model._load_grid(grid_filename)
+        self.model._grid_filename = grid_filename
+        for kind in photosphere_kinds:
+            self.interpolator(kind)
+        logger.info("Loaded the grid and {0} photosphere interpolators in "
+            "{1:.1f} seconds".format(len(photosphere_kinds), time() - t_init))
+
+
+    def interpolator(self, kind="marcs"):
+        """
+        Return the (cached) photosphere interpolator of some kind.
+
+        :param kind: [optional]
+            The kind of model photospheres.
+
+        :type kind:
+            str
+        """
+
+        kind = kind.lower()
+        with self._lock:
+            if kind not in self._interpolators:
+                self._interpolators[kind] = photospheres.interpolator(kind)
+            return self._interpolators[kind]
+
+
+    def transitions(self, transitions):
+        """
+        Return a table of transitions, either from a filename (which is cached
+        until the file is modified) or from a dictionary of columns.
+
+        :param transitions:
+            The filename of the transitions table, or its columns.
+
+        :type transitions:
+            str or dict
+        """
+
+        if isinstance(transitions, dict):
+            return Table(transitions)
+
+        key = (transitions, os.stat(transitions).st_mtime)
+        with self._lock:
+            if key not in self._transitions:
+                self._transitions[key] = Table.read(transitions)
+            return self._transitions[key]
+
+
+    def _spectra(self, request):
+        """ Return the spectra from filenames or arrays in a request. """
+
+        if "filenames" in request:
+            return map(specutils.Spectrum1D.load, request["filenames"])
+
+        return [specutils.Spectrum1D(disp=np.array(spectrum["disp"]),
+            flux=np.array(spectrum["flux"]),
+            variance=np.array(spectrum["variance"]) \
+                if "variance" in spectrum else None) \
+            for spectrum in request["spectra"]]
+
+
+    def estimate(self, request):
+        """
+        Estimate the initial model parameters for some spectra.
+
+        :param request:
+            The 'filenames' of the spectra (or the 'spectra' as a list of
+            dictionaries containing 'disp', 'flux' and optionally 'variance'),
+            and whether to return the expected fluxes and the grid likelihood
+            ('full_output').
+
+        :type request:
+            dict
+        """
+
+        data = self._spectra(request)
+        if request.get("full_output", False):
+            with self._estimate_lock:
+                theta, expected_dispersion, expected_flux, grid_info = \
+                    self.model.initial_theta(data, full_output=True,
+                        grid_info=True)
+            return {
+                "theta": theta,
+                "expected_dispersion": expected_dispersion,
+                "expected_flux": expected_flux,
+                "grid_chi_sq": grid_info["chi_sq"],
+                "grid_posterior": grid_info["posterior"]
+            }
+
+        with self._estimate_lock:
+            theta = self.model.initial_theta(data)
+        return {"theta": theta}
+
+
+    def synthesise(self, request):
+        """
+        Synthesise a spectrum with MOOG.
+
+        :param request:
+            The 'transitions' (see :func:`transitions`), the
+            'stellar_parameters' (effective temperature, surface gravity and
+            metallicity), the 'microturbulence', and the 'kind' of model
+            photospheres (default: 'marcs'). Any other keys are passed to
+            :func:`oracle.synthesis.synthesise`.
+
+        :type request:
+            dict
+        """
+
+        request = request.copy()
+        transitions = self.transitions(request.pop("transitions"))
+        stellar_parameters = request.pop("stellar_parameters")
+        interpolator = self.interpolator(request.pop("kind", "marcs"))
+
+        with synthesis.lock:
+            wavelengths, fluxes = synthesis.synthesise(transitions,
+                stellar_parameters, _interpolator=interpolator, **request)
+        return {"wavelengths": wavelengths, "fluxes": fluxes}
+
+
+    def abundances(self, request):
+        """
+        Calculate atomic abundances from equivalent widths with MOOG.
+
+        :param request:
+            The 'transitions' (with equivalent widths; see
+            :func:`transitions`), the 'stellar_parameters' (effective
+            temperature, surface gravity and metallicity), the
+            'microturbulence', and the 'kind' of model photospheres (default:
+            'marcs').
+
+        :type request:
+            dict
+        """
+
+        request = request.copy()
+        transitions = self.transitions(request.pop("transitions"))
+        stellar_parameters = request.pop("stellar_parameters")
+        microturbulence = request.pop("microturbulence")
+        interpolator = self.interpolator(request.pop("kind", "marcs"))
+
+        with synthesis.lock:
+            abundances = synthesis.atomic_abundances(transitions,
+                stellar_parameters, microturbulence,
+                _interpolator=interpolator, **request)
+        return {"abundances": abundances}
+
+
+    def status(self, request=None):
+        """ Return the uptime, number of requests, and what is loaded. """
+
+        return {
+            "uptime": time() - self.started,
+            "requests": self.requests,
+            "grid": getattr(self.model, "_grid_filename", None),
+            "photospheres": sorted(self._interpolators.keys()),
+            "transitions": sorted(set([k[0] for k in self._transitions]))
+        }
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+
+    routes = {
+        "/estimate": "estimate",
+        "/synthesise": "synthesise",
+        "/abundances": "abundances",
+        "/status": "status"
+    }
+
+    def _respond(self, code, content):
+        body = json.dumps(_serialise(content))
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def _handle(self, request):
+        analyst = self.server.analyst
+        if self.path not in self.routes:
+            self._respond(404, {"error": "unknown path {}".format(self.path)})
+            return
+
+        t_init = time()
+        try:
+            result = getattr(analyst, self.routes[self.path])(request)
+
+        except Exception as e:
+            logger.exception("Exception raised when handling {}".format(
+                self.path))
+            self._respond(500 if not isinstance(e, (KeyError, TypeError,
+                ValueError, IOError)) else 400,
+                {"error": "{0}: {1}".format(type(e).__name__, e)})
+
+        else:
+            with analyst._requests_lock:
+                analyst.requests += 1
+            result["time_taken"] = time() - t_init
+            self._respond(200, result)
+
+
+    def do_GET(self):
+        self._handle({})
+
+
+    def do_POST(self):
+        length = int(self.headers.getheader("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length)) if length else {}
+        except ValueError:
+            self._respond(400, {"error": "request body is not valid JSON"})
+            return
+        self._handle(request)
+
+
+    def log_message(self, format, *args):
+        logger.debug("{0} {1}".format(self.address_string(), format % args))
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(analyst, host="127.0.0.1", port=8765):
+    """
+    Serve analysis requests over HTTP until interrupted.
+
+    Requests are JSON-encoded and POSTed to /estimate, /synthesise or
+    /abundances (see the corresponding :class:`Analyst` methods), and the
+    results are returned as JSON. A GET request to /status describes the
+    server.
+
+    :param analyst:
+        The analysis state to serve requests with.
+
+    :type analyst:
+        :class:`Analyst`
+
+    :param host: [optional]
+        The address to listen on. By default only local connections are
+        accepted.
+
+    :type host:
+        str
+
+    :param port: [optional]
+        The port to listen on.
+
+    :type port:
+        int
+    """
+
+    server = _ThreadingHTTPServer((host, port), _RequestHandler)
+    server.analyst = analyst
+    logger.info("Serving requests on http://{0}:{1}".format(
+        *server.server_address))
+
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+        logger.info("Stopping server")
+
+    finally:
+        server.server_close()
+        analyst.model.close_pool()
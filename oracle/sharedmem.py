@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Share read-only arrays between processes without copying them. """
+
+from __future__ import division, absolute_import, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+__all__ = ["SharedArray", "publish", "attach", "unlink"]
+
+# Standard library.
+import atexit
+import logging
+import os
+import re
+import tempfile
+
+# Third-party.
+import numpy as np
+
+logger = logging.getLogger("oracle")
+
+# Prefer POSIX shared memory, which is backed by RAM, and fall back to the
+# temporary directory (which is still shared through the page cache).
+SHARED_MEMORY_DIRECTORY = "/dev/shm" if os.path.isdir("/dev/shm") \
+    else tempfile.gettempdir()
+
+# Arrays published by this process, which will be removed when it exits.
+_published = set()
+
+
+def _path(name):
+    """ Return the path of the memory-mapped file for a published array. """
+    if not re.match("^[\w\-\.]+$", name):
+        raise ValueError("shared array name '{}' must only contain letters, "
+            "numbers, dashes, underscores or periods".format(name))
+    return os.path.join(SHARED_MEMORY_DIRECTORY, "oracle-{}.npy".format(name))
+
+
+class SharedArray(np.ndarray):
+    """
+    A read-only array that is memory-mapped from a published file. When pickled
+    (e.g., when sent to a worker process) only the name of the array is
+    serialised, and the receiving process attaches to the same physical pages.
+    """
+
+    def __new__(cls, name):
+        array = np.load(_path(name), mmap_mode="r")
+        obj = array.view(cls)
+        obj._shared_name = name
+        obj._shared_address = obj.__array_interface__["data"][0]
+        obj._shared_shape = obj.shape
+        return obj
+
+
+    def __array_finalize__(self, obj):
+        self._shared_name = getattr(obj, "_shared_name", None)
+        self._shared_address = getattr(obj, "_shared_address", None)
+        self._shared_shape = getattr(obj, "_shared_shape", None)
+
+
+    def __array_wrap__(self, obj, context=None):
+        # Computations on shared arrays return regular arrays (or scalars).
+        obj = obj.view(np.ndarray)
+        return obj[()] if obj.shape == () else obj
+
+
+    def __reduce__(self):
+        # Only the complete published array can be re-attached by name. Views
+        # and slices are pickled as regular arrays.
+        if self._shared_name is not None and self.shape == self._shared_shape \
+        and self.__array_interface__["data"][0] == self._shared_address:
+            return (SharedArray, (self._shared_name, ))
+        return np.array(self).__reduce__()
+
+
+    @property
+    def name(self):
+        """ The name that the array was published with. """
+        return self._shared_name
+
+
+def publish(name, array, overwrite=True, persist=False):
+    """
+    Publish an array to shared memory so that other processes can attach to it
+    by name without copying it.
+
+    :param name:
+        The name to publish the array as.
+
+    :type name:
+        str
+
+    :param array:
+        The array to publish. Record arrays are permitted.
+
+    :type array:
+        :class:`numpy.ndarray`
+
+    :param overwrite: [optional]
+        Overwrite any existing array published with the same name.
+
+    :type overwrite:
+        bool
+
+    :param persist: [optional]
+        Keep the published array after this process exits. Otherwise it is
+        removed when the publishing process exits.
+
+    :type persist:
+        bool
+
+    :returns:
+        The array, attached from shared memory.
+
+    :rtype:
+        :class:`SharedArray`
+    """
+
+    path = _path(name)
+    if os.path.exists(path) and not overwrite:
+        raise IOError("shared array '{}' already exists".format(name))
+
+    array = np.asanyarray(array)
+
+    # Write to a temporary file first so that processes never attach to a
+    # partially written array.
+    temporary_path = "{0}.{1}.tmp".format(path, os.getpid())
+    shared = np.lib.format.open_memmap(temporary_path, mode="w+",
+        dtype=array.dtype, shape=array.shape)
+    shared[:] = array
+    shared.flush()
+    del shared
+    os.rename(temporary_path, path)
+    if not persist:
+        _published.add(name)
+
+    logger.debug("Published shared array '{0}' ({1:.1f} MB) to {2}".format(
+        name, array.nbytes/1024.**2, path))
+    return SharedArray(name)
+
+
+def attach(name):
+    """
+    Attach to an array that has been published to shared memory.
+
+    :param name:
+        The name the array was published with.
+
+    :type name:
+        str
+
+    :returns:
+        The read-only shared array.
+
+    :rtype:
+        :class:`SharedArray`
+    """
+    if not os.path.exists(_path(name)):
+        raise IOError("no shared array named '{}' exists".format(name))
+    return SharedArray(name)
+
+
+def unlink(name):
+    """
+    Remove a published array. Processes that are attached to it keep their
+    mapping until they release it.
+
+    :param name:
+        The name the array was published with.
+
+    :type name:
+        str
+    """
+    _published.discard(name)
+    try:
+        os.remove(_path(name))
+    except OSError:
+        logger.debug("Shared array '{}' does not exist".format(name))
+
+
+@atexit.register
+def _unlink_published():
+    for name in list(_published):
+        unlink(name)
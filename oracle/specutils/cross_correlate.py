@@ -6,12 +6,27 @@ from __future__ import division, print_function
 
 __author__ = "Andy Casey <arc@ast.cam.ac.uk>"
 
-__all__ = ["cross_correlate", "cross_correlate_grid"]
+__all__ = ["cross_correlate", "cross_correlate_grid",
+    "cross_correlate_grid_many", "cross_correlate_grid_stream",
+    "cluster_templates", "CrossCorrelationPool", "EigenTemplateTransform",
+    "TemplateCache", "TemplateClusters", "TemplateTransform"]
+
+import cPickle as pickle
+import logging
+import os
+import threading
+from collections import OrderedDict
+from hashlib import md5
 
 import numpy as np
 import multiprocessing
 import astropy.units as u
 from astropy import modeling, constants
+from scipy.cluster import vq
+
+from oracle import sharedmem
+
+logger = logging.getLogger("oracle")
 
 
 def cross_correlate(observed, template, wavelength_range=None):
@@ -77,7 +92,7 @@ def cross_correlate(observed, template, wavelength_range=None):
 
     # Set up z array
     m = len(dispersion) / 2
-    z_array = dispersion/dispersion[N/2] - 1.0
+    z_array = dispersion/dispersion[N//2] - 1.0
 
     # Apodize edges
     edge_buffer = 0.1 * (dispersion[-1] - dispersion[0])
@@ -103,8 +118,8 @@ def cross_correlate(observed, template, wavelength_range=None):
 
     # Reflect about zero
     ccf = np.zeros(N)
-    ccf[:N/2] = correlation[N/2:]
-    ccf[N/2:] = correlation[:N/2]
+    ccf[:N//2] = correlation[N//2:]
+    ccf[N//2:] = correlation[:N//2]
 
     # Get height and redshift of best peak
     # TODO: Fit a Gaussian profile here instead, and get the z_err from the FWHM
@@ -140,149 +155,1536 @@ def cross_correlate(observed, template, wavelength_range=None):
     return (z_best * c, z_err * c)
 
 
-def _ccf(z_array, apod_template_flux, template_flux_corr, N, index=None,
-         method="fast", **kwargs):
+def _next_fast_length(N):
+    """
+    Return the smallest even length of at least N that only has prime factors
+    of 2, 3 and 5, for which FFTs are fastest.
+    """
+
+    M = N + (N % 2)
+    while True:
+        m = M
+        for factor in (2, 3, 5):
+            while m % factor == 0:
+                m //= factor
+        if m == 1:
+            return M
+        M += 2
+
+
+def _apodisation_curve(dispersion, apodize):
+    """
+    Return a cosine bell that apodises the given fraction of each edge of the
+    dispersion range.
+    """
+
+    edge_buffer = apodize * (dispersion[-1] - dispersion[0])
+    low_w_indices = np.nonzero(dispersion < dispersion[0] + edge_buffer)[0]
+    high_w_indices = np.nonzero(dispersion > dispersion[-1] - edge_buffer)[0]
+
+    apod_curve = np.ones(dispersion.size, dtype='d')
+    apod_curve[low_w_indices] = (1.0 + np.cos(np.pi*(
+        1.0 - (dispersion[low_w_indices] - dispersion[0])/edge_buffer)))/2.
+    apod_curve[high_w_indices] = (1.0 + np.cos(np.pi*(
+        1.0 - (dispersion[-1] - dispersion[high_w_indices])/edge_buffer)))/2.
+    return apod_curve
+
+
+class TemplateTransform(object):
+    """
+    The apodised real Fourier transforms of a grid of template spectra, and
+    everything else that is needed to cross-correlate observed spectra against
+    them. The templates are zero-padded to a length that is fast to transform.
+
+    :param template_dispersion:
+        The dispersion points of the templates, with shape (N_pixels, ).
+
+    :type template_dispersion:
+        :class:`numpy.array`
+
+    :param template_fluxes:
+        The template fluxes, with shape (N_models, N_pixels).
+
+    :type template_fluxes:
+        :class:`numpy.ndarray`
+
+    :param apodize: [optional]
+        The fraction of each edge of the spectrum to apodise.
+
+    :type apodize:
+        float
+
+    :param flux_range: [optional]
+        The minimum and peak-to-peak range of the template fluxes. This is
+        required when the templates are a subset of a larger grid, so that
+        observed spectra are scaled the same way for every subset.
+
+    :type flux_range:
+        tuple
+    """
+
+    def __init__(self, template_dispersion, template_fluxes, apodize=0.10,
+        flux_range=None):
+
+        apod_template_flux = self._initialise(template_dispersion,
+            template_fluxes, apodize, flux_range)
+        self.norms = np.sqrt((apod_template_flux**2).sum(axis=1))
+        self.fft = np.fft.rfft(apod_template_flux, n=self.M, axis=1)
+
+
+    def _initialise(self, template_dispersion, template_fluxes, apodize,
+        flux_range=None):
+        """
+        Set the dispersion, padding, apodisation and flux scaling of the
+        transform, and return the apodised template fluxes.
+        """
+
+        if template_dispersion.shape[0] != template_fluxes.shape[1]:
+            raise ValueError("template dispersion must have size (N_pixels,) "\
+                "and template fluxes must have size (N_models, N_pixels)")
+
+        assert 1 > apodize >= 0, "Apodisation fraction must be between 0 and 1"
+
+        N = template_dispersion.size
+        N = N - 1 if N % 2 > 0 else N
+
+        self.N = N
+        self.M = _next_fast_length(N)
+        self.apodize = apodize
+        self.dispersion = np.array(template_dispersion[:N])
+        self.z_array = self.dispersion/self.dispersion[N//2] - 1.0
+        self.apod_curve = _apodisation_curve(self.dispersion, apodize)
+
+        template_flux = template_fluxes[:, :N]
+        if flux_range is None:
+            self.flux_min, self.flux_ptp = template_flux.min(), template_flux.ptp()
+        else:
+            self.flux_min, self.flux_ptp = flux_range
+
+        return template_flux * self.apod_curve
+
+
+    @property
+    def N_models(self):
+        """ The number of templates. """
+        return self.fft.shape[0]
+
+
+    def share(self, name=None):
+        """
+        Publish the arrays of this transform to shared memory. When the
+        transform is subsequently sent to other processes, the workers will
+        attach to the published arrays by name instead of receiving a copy.
+
+        :param name: [optional]
+            The name to publish the arrays with. If not given, a name that is
+            unique to this process and transform is used.
+
+        :type name:
+            str
+
+        :returns:
+            The name of the published transform.
+        """
+
+        if name is None:
+            name = "transform-{0}-{1}".format(os.getpid(), id(self))
+
+        for key, value in self.__dict__.items():
+            if isinstance(value, np.ndarray) \
+            and not isinstance(value, sharedmem.SharedArray):
+                setattr(self, key, sharedmem.publish("{0}-{1}".format(name,
+                    key.replace("_", "-")), value))
+        self._shared_name = name
+        return name
+
+
+    @property
+    def shared(self):
+        """ Whether the arrays of this transform are in shared memory. """
+        return getattr(self, "_shared_name", None) is not None
+
+
+    def unshare(self):
+        """
+        Remove the arrays of this transform from shared memory. The transform
+        keeps private copies of the arrays, so it remains usable.
+        """
+
+        for key, value in self.__dict__.items():
+            if isinstance(value, sharedmem.SharedArray):
+                setattr(self, key, np.array(value))
+                sharedmem.unlink(value.name)
+        self._shared_name = None
+
+
+    def correlate(self, fft_observed, rows=slice(None)):
+        """
+        Return the (unscaled) circular cross-correlations between observed
+        spectra and some templates.
+
+        :param fft_observed:
+            The normalised real Fourier transform of an observed spectrum, or
+            of many observed spectra with shape (N_spectra, M//2 + 1).
+
+        :type fft_observed:
+            :class:`numpy.ndarray`
+
+        :param rows: [optional]
+            The templates to cross-correlate against.
+
+        :type rows:
+            slice or :class:`numpy.array`
+
+        :returns:
+            The cross-correlations with shape (N_rows, M), or with shape
+            (N_spectra, N_rows, M) if many observed spectra are given.
+        """
+
+        flux_correlation = fft_observed[..., None, :] \
+            * self.fft[rows].conjugate() / self.norms[rows, None]
+        return np.fft.irfft(flux_correlation, n=self.M, axis=-1)
+
+
+    def observed_fft(self, observed_flux, continuum_degree=4):
+        """
+        Return the normalised real Fourier transform of an apodised observed
+        spectrum, sampled on the template dispersion points.
+
+        :param observed_flux:
+            The observed flux on the template dispersion points.
+
+        :type observed_flux:
+            :class:`numpy.array`
+
+        :param continuum_degree: [optional]
+            The polynomial degree used to normalise the observed flux.
+
+        :type continuum_degree:
+            int
+        """
+        return self.observed_ffts(np.atleast_2d(observed_flux),
+            continuum_degree)[0]
+
+
+    def observed_ffts(self, observed_fluxes, continuum_degree=4):
+        """
+        Return the normalised real Fourier transforms of many apodised observed
+        spectra, all sampled on the template dispersion points.
+
+        :param observed_fluxes:
+            The observed fluxes on the template dispersion points, with shape
+            (N_spectra, N_pixels).
+
+        :type observed_fluxes:
+            :class:`numpy.ndarray`
+
+        :param continuum_degree: [optional]
+            The polynomial degree used to normalise the observed fluxes.
+
+        :type continuum_degree:
+            int
+        """
+
+        try:
+            continuum_degree = int(continuum_degree + 1)
+        except (TypeError, ValueError):
+            raise TypeError("continuum order must be an integer-like object")
+
+        dispersion = self.dispersion
+        observed_fluxes = np.array(observed_fluxes, dtype=float)[:, :self.N]
+        for observed_flux in observed_fluxes:
+            non_finite = ~np.isfinite(observed_flux)
+            if non_finite.sum() > 0:
+                observed_flux[non_finite] = np.interp(dispersion[non_finite],
+                    dispersion[~non_finite], observed_flux[~non_finite])
+
+        # Normalise
+        if continuum_degree >= 1:
+            coeffs = np.polyfit(dispersion, observed_fluxes.T, continuum_degree)
+            observed_fluxes /= np.dot(
+                np.vander(dispersion, continuum_degree + 1), coeffs).T
+
+        # Scale the flux level to that the template intensities
+        observed_fluxes = (observed_fluxes * self.flux_ptp) + self.flux_min
+
+        apod_observed_fluxes = observed_fluxes * self.apod_curve
+        return np.fft.rfft(apod_observed_fluxes, n=self.M, axis=1) \
+            / np.sqrt((apod_observed_fluxes**2).sum(axis=1))[:, None]
+
+
+class EigenTemplateTransform(TemplateTransform):
+    """
+    A compressed template transform, where the apodised templates are described
+    by a mean spectrum and a number of principal eigenspectra. Observed spectra
+    are only cross-correlated against the mean spectrum and the eigenspectra,
+    and the cross-correlation function of every template is reconstructed as a
+    linear combination of those, so the number of Fourier transforms required
+    does not depend on the number of templates.
+
+    Reconstructing every cross-correlation function in full costs
+    N_models x (K + 1) x M operations for K eigenspectra, which is comparable
+    to the Fourier transforms it replaces. When only the peaks are required
+    (see :func:`ccf_peaks`), the functions are reconstructed in full only in a
+    window around the peak of the mean template, and at every
+    ``peak_stride``-th lag elsewhere.
+
+    :param template_dispersion:
+        The dispersion points of the templates, with shape (N_pixels, ).
+
+    :type template_dispersion:
+        :class:`numpy.array`
+
+    :param template_fluxes:
+        The template fluxes, with shape (N_models, N_pixels).
+
+    :type template_fluxes:
+        :class:`numpy.ndarray`
+
+    :param num_components:
+        The number of eigenspectra to keep.
+
+    :type num_components:
+        int
+
+    :param apodize: [optional]
+        The fraction of each edge of the spectrum to apodise.
+
+    :type apodize:
+        float
+
+    :param peak_stride: [optional]
+        The stride between the lags that are reconstructed outside the window
+        around the peak, when searching for peaks.
+
+    :type peak_stride:
+        int
+    """
+
+    peak_stride = 8
+
+    def __init__(self, template_dispersion, template_fluxes, num_components,
+        apodize=0.10, peak_stride=8):
+
+        apod_template_flux = self._initialise(template_dispersion,
+            template_fluxes, apodize)
+        self.peak_stride = max(1, int(peak_stride))
+
+        mean = apod_template_flux.mean(axis=0)
+        U, S, V = np.linalg.svd(apod_template_flux - mean, full_matrices=False)
+
+        num_components = max(1, min(int(num_components), S.size))
+        self.coefficients = U[:, :num_components] * S[:num_components]
+        self.explained_variance = (S[:num_components]**2).sum()/(S**2).sum() \
+            if np.any(S > 0) else 1.
+
+        # The norms of the compressed templates (the eigenspectra are
+        # orthonormal).
+        self.norms = np.sqrt(np.dot(mean, mean) \
+            + 2 * np.dot(self.coefficients, np.dot(V[:num_components], mean)) \
+            + (self.coefficients**2).sum(axis=1))
+
+        # The Fourier transforms of the mean spectrum and the eigenspectra.
+        basis = np.vstack([mean, V[:num_components]])
+        self.fft = np.fft.rfft(basis, n=self.M, axis=1)
+
+        logger.debug("Compressed {0} templates to {1} eigenspectra, which "
+            "explain {2:.4f} of the variance".format(
+                apod_template_flux.shape[0], num_components,
+                self.explained_variance))
+
+
+    @property
+    def N_models(self):
+        """ The number of templates. """
+        return self.coefficients.shape[0]
+
+
+    @property
+    def num_components(self):
+        """ The number of eigenspectra. """
+        return self.coefficients.shape[1]
+
+
+    def correlate(self, fft_observed, rows=slice(None)):
+        """
+        Return the (unscaled) circular cross-correlations between observed
+        spectra and some templates, reconstructed from the cross-correlations
+        against the mean spectrum and the eigenspectra.
 
-    denominator = np.sqrt(np.inner(apod_template_flux, apod_template_flux))
-    flux_correlation = template_flux_corr / denominator
-    correlation = np.fft.ifft(flux_correlation).real
+        :param fft_observed:
+            The normalised real Fourier transform of an observed spectrum, or
+            of many observed spectra with shape (N_spectra, M//2 + 1).
+
+        :type fft_observed:
+            :class:`numpy.ndarray`
+
+        :param rows: [optional]
+            The templates to cross-correlate against.
+
+        :type rows:
+            slice or :class:`numpy.array`
+
+        :returns:
+            The cross-correlations with shape (N_rows, M), or with shape
+            (N_spectra, N_rows, M) if many observed spectra are given.
+        """
+
+        basis_correlation = np.fft.irfft(
+            fft_observed[..., None, :] * self.fft.conjugate(), n=self.M, axis=-1)
+
+        # (N_rows, K + 1) x (..., K + 1, M) -> (..., N_rows, M)
+        return np.einsum("rk,...km->...rm", self._weights(rows),
+            basis_correlation)
+
+
+    def _weights(self, rows=slice(None)):
+        """ Return the weights of the basis spectra for some templates. """
+
+        coefficients = self.coefficients[rows]
+        weights = np.hstack([np.ones((coefficients.shape[0], 1)), coefficients])
+        return weights / self.norms[rows, None]
+
+
+    def ccf_peaks(self, fft_observed, rows=slice(None)):
+        """
+        Return the redshift, redshift width and height of the highest peak in
+        the scaled cross-correlation function of an observed spectrum with some
+        templates, as per :func:`_ccf_batch`.
+
+        The functions are reconstructed in full only within a window around
+        the peak of the mean template, and at every ``peak_stride``-th lag
+        elsewhere. Templates whose functions are above half of their peak
+        height at the edge of the window or at any lag outside it are
+        reconstructed in full. The peak redshifts and heights are the same as
+        those from the full functions. The minimum of each function outside
+        the window is refined around the lowest of the reconstructed lags, but
+        if the functions vary on scales smaller than ``peak_stride`` lags the
+        minimum (and so the width) of a few templates can differ slightly. The
+        widths are the same if ``peak_stride`` is one.
+
+        :param fft_observed:
+            The normalised real Fourier transform of an observed spectrum.
+
+        :type fft_observed:
+            :class:`numpy.array`
+
+        :param rows: [optional]
+            The templates to cross-correlate against.
+
+        :type rows:
+            slice or :class:`numpy.array`
+        """
+
+        N, M = self.N, self.M
+        rows = np.arange(self.N_models)[rows]
+
+        # The cross-correlations with the basis spectra, reflected about zero.
+        basis = np.fft.irfft(fft_observed * self.fft.conjugate(), n=M, axis=-1)
+        basis = np.hstack([basis[:, M - N//2:], basis[:, :N//2]])
+        weights = self._weights(rows)
+
+        # The window is three times the extent of the region above half the
+        # peak of the mean template.
+        mean_ccf = np.dot(weights.mean(axis=0), basis)
+        above = np.where(mean_ccf >= 0.5 * (mean_ccf.max() + mean_ccf.min()))[0]
+        extent = above[-1] - above[0] + 1
+        lower, upper = max(0, above[0] - extent), min(N, above[-1] + extent + 1)
+
+        lags = np.arange(0, N, self.peak_stride)
+        lags = lags[(lags < lower) + (lags >= upper)]
+
+        window_ccf = np.dot(weights, basis[:, lower:upper])
+        outside_ccf = np.dot(weights, basis[:, lags])
+
+        h = window_ccf.max(axis=1)
+        ccf_min = window_ccf.min(axis=1)
+        if lags.size > 0:
+            # Refine the minimum around the lowest lag outside the window.
+            nearby = lags[outside_ccf.argmin(axis=1)][:, None] \
+                + np.arange(-self.peak_stride, self.peak_stride + 1)
+            nearby = np.clip(nearby, 0, N - 1)
+            nearby_ccf = np.einsum("rk,krj->rj", weights, basis[:, nearby])
+            ccf_min = np.minimum(ccf_min, nearby_ccf.min(axis=1))
+
+        # The scaled function is above half the peak height where the function
+        # is above the average of its peak and minimum.
+        threshold = 0.5 * (h + ccf_min)
+        above = window_ccf >= threshold[:, None]
+        full = above[:, 0] + above[:, -1]
+        if lags.size > 0:
+            full += np.any(outside_ccf >= threshold[:, None], axis=1)
+
+        first = lower + above.argmax(axis=1)
+        last = lower + above.shape[1] - 1 - above[:, ::-1].argmax(axis=1)
+
+        z = self.z_array[lower + window_ccf.argmax(axis=1)]
+        z_err = (self.z_array[last] - self.z_array[first])/2.355
+
+        if np.any(full):
+            z[full], z_err[full], h[full] = _ccf_peaks(self.z_array,
+                *_scale_ccfs(self.correlate(fft_observed, rows[full]), N, M))
+
+        return (z, z_err, h)
+
+
+class TemplateCache(object):
+    """
+    A cache of template transforms, which are held in memory and optionally
+    persisted to disk. The template transforms do not change between observed
+    spectra, so they only need to be calculated once for each grid, dispersion
+    slice, apodisation and mask.
+
+    :param directory: [optional]
+        A directory to persist the template transforms to. The Fourier
+        transforms are memory-mapped when they are loaded from disk.
+
+    :type directory:
+        str
+
+    :param maxsize: [optional]
+        The maximum number of template transforms to hold in memory.
+
+    :type maxsize:
+        int
+    """
+
+    def __init__(self, directory=None, maxsize=32):
+        self.directory = directory
+        self.maxsize = maxsize
+        self._transforms = OrderedDict()
+        self._lock = threading.RLock()
+
+        if directory is not None and not os.path.exists(directory):
+            os.makedirs(directory)
+
+
+    def __len__(self):
+        return len(self._transforms)
+
+
+    def _digest(self, template_dispersion, template_fluxes, apodize, key,
+        num_components=None):
+        """ Return a digest for the given templates or key. """
+        digest = md5(repr((key, float(apodize)) if num_components is None \
+            else (key, float(apodize), int(num_components))).encode("utf-8"))
+        if key is None:
+            digest.update(np.ascontiguousarray(template_dispersion).data)
+            digest.update(np.ascontiguousarray(template_fluxes).data)
+        return digest.hexdigest()
+
+
+    def _paths(self, digest):
+        return [os.path.join(self.directory, "{0}.{1}".format(digest, ext)) \
+            for ext in ("npy", "pkl")]
+
+
+    def get(self, template_dispersion, template_fluxes, apodize=0.10,
+        key=None, num_components=None):
+        """
+        Return the template transform for a grid of templates.
+
+        :param template_dispersion:
+            The dispersion points of the templates, with shape (N_pixels, ).
+
+        :type template_dispersion:
+            :class:`numpy.array`
+
+        :param template_fluxes:
+            The template fluxes, with shape (N_models, N_pixels).
+
+        :type template_fluxes:
+            :class:`numpy.ndarray`
+
+        :param apodize: [optional]
+            The fraction of each edge of the spectrum to apodise.
+
+        :type apodize:
+            float
+
+        :param key: [optional]
+            A hashable key that uniquely describes the templates (e.g., the grid
+            filename, the dispersion slice and the mask). If not given, a digest
+            of the templates is used, which requires reading all of them.
+
+        :param num_components: [optional]
+            Compress the templates to this many eigenspectra.
+
+        :type num_components:
+            int
+
+        :returns:
+            The template transform.
+
+        :rtype:
+            :class:`TemplateTransform` or :class:`EigenTemplateTransform`
+        """
+
+        with self._lock:
+            return self._get(template_dispersion, template_fluxes, apodize,
+                key, num_components)
+
+
+    def _get(self, template_dispersion, template_fluxes, apodize, key,
+        num_components):
+
+        digest = self._digest(template_dispersion, template_fluxes, apodize,
+            key, num_components)
+        cls = TemplateTransform if num_components is None \
+            else EigenTemplateTransform
+        try:
+            return self._transforms[digest]
+        except KeyError:
+            pass
+
+        transform = None
+        if self.directory is not None:
+            fft_path, state_path = self._paths(digest)
+            if os.path.exists(fft_path) and os.path.exists(state_path):
+                logger.debug("Loading template transform from {}".format(
+                    fft_path))
+                transform = cls.__new__(cls)
+                with open(state_path, "rb") as fp:
+                    transform.__dict__.update(pickle.load(fp))
+                transform.fft = np.load(fft_path, mmap_mode="r")
+
+        if transform is None:
+            transform = TemplateTransform(template_dispersion, template_fluxes,
+                apodize) if num_components is None else EigenTemplateTransform(
+                    template_dispersion, template_fluxes, num_components,
+                    apodize)
+
+            if self.directory is not None:
+                fft_path, state_path = self._paths(digest)
+                np.save(fft_path, transform.fft)
+                state = transform.__dict__.copy()
+                del state["fft"]
+                with open(state_path, "wb") as fp:
+                    pickle.dump(state, fp, -1)
+                logger.debug("Saved template transform to {}".format(fft_path))
+
+        self._transforms[digest] = transform
+        while len(self._transforms) > self.maxsize:
+            digest, evicted = self._transforms.popitem(last=False)
+            if evicted.shared:
+                evicted.unshare()
+        return transform
+
+
+class TemplateClusters(object):
+    """
+    Groups of similar templates, each with a representative template.
+
+    :param labels:
+        The cluster index of each template.
+
+    :type labels:
+        :class:`numpy.array`
+
+    :param representatives:
+        The index of the representative template for each cluster.
+
+    :type representatives:
+        :class:`numpy.array`
+    """
+
+    def __init__(self, labels, representatives):
+        self.labels = np.array(labels, dtype=int)
+        self.representatives = np.array(representatives, dtype=int)
+
+
+    def __len__(self):
+        return self.representatives.size
+
+
+    def members(self, clusters):
+        """
+        Return the indices of all templates in the given clusters.
+
+        :param clusters:
+            The indices of the clusters.
+
+        :type clusters:
+            list of int
+        """
+        return np.where(np.in1d(self.labels, clusters))[0]
+
+
+def cluster_templates(template_fluxes, num_clusters, points=None,
+    num_components=10, stride=1, iterations=20, seed=None):
+    """
+    Cluster a grid of templates by spectral similarity, or tile them in
+    parameter space. The template nearest to the centre of each cluster is used
+    as the cluster representative. This only needs to be done once per grid.
+
+    :param template_fluxes:
+        The template fluxes, with shape (N_models, N_pixels).
+
+    :type template_fluxes:
+        :class:`numpy.ndarray`
+
+    :param num_clusters:
+        The number of clusters.
+
+    :type num_clusters:
+        int
+
+    :param points: [optional]
+        The parameters of each template, as a record array. If given, the
+        templates are clustered in (scaled) parameter space instead of by their
+        fluxes.
+
+    :type points:
+        :class:`numpy.core.records.recarray`
+
+    :param num_components: [optional]
+        The number of principal components of the fluxes to cluster in.
+
+    :type num_components:
+        int
+
+    :param stride: [optional]
+        Only use every ``stride`` pixel when clustering by flux.
+
+    :type stride:
+        int
+
+    :param iterations: [optional]
+        The number of k-means iterations.
+
+    :type iterations:
+        int
+
+    :param seed: [optional]
+        The seed used to choose the initial cluster centres.
+
+    :type seed:
+        int
+
+    :returns:
+        The template clusters.
+
+    :rtype:
+        :class:`TemplateClusters`
+    """
+
+    N_models = template_fluxes.shape[0]
+    num_clusters = min(int(num_clusters), N_models)
+
+    if points is not None:
+        features = points.view(float).reshape(len(points), -1)
+        ptp = np.ptp(features, axis=0)
+        features = (features - features.min(axis=0))/np.where(ptp > 0, ptp, 1)
+
+    else:
+        fluxes = np.array(template_fluxes[:, ::stride], dtype=float)
+        fluxes -= fluxes.mean(axis=0)
+        U, S, V = np.linalg.svd(fluxes, full_matrices=False)
+        features = U[:, :num_components] * S[:num_components]
+
+    random = np.random.RandomState(seed)
+    initial = features[random.choice(N_models, num_clusters, replace=False)]
+    centroids, labels = vq.kmeans2(features, initial, iter=iterations,
+        minit="matrix")
+
+    # Remove empty clusters, and use the template closest to the centroid of
+    # each cluster as the representative.
+    representatives, relabelled = [], np.zeros(N_models, dtype=int)
+    for cluster in np.unique(labels):
+        members = np.where(labels == cluster)[0]
+        distance = ((features[members] - centroids[cluster])**2).sum(axis=1)
+        relabelled[members] = len(representatives)
+        representatives.append(members[distance.argmin()])
+
+    logger.debug("Clustered {0} templates into {1} groups".format(N_models,
+        len(representatives)))
+    return TemplateClusters(relabelled, representatives)
+
+
+def _scale_ccfs(correlation, N, M):
+    """
+    Return the scaled cross-correlation functions from the circular
+    cross-correlations of length M, and the height of their highest peaks.
+    """
 
     # Reflect about zero
-    ccf = np.zeros(N)
-    ccf[:N/2] = correlation[N/2:]
-    ccf[N/2:] = correlation[:N/2]
+    ccf = np.hstack([correlation[:, M - N//2:], correlation[:, :N//2]])
 
-    # Get height and redshift of best peak
-    h = ccf.max()
+    # Get height of best peak
+    h = ccf.max(axis=1)
 
     # Scale the CCF
-    ccf -= ccf.min()
-    ccf *= (h/ccf.max())
+    ccf_min = ccf.min(axis=1)
+    ccf -= ccf_min[:, None]
+    ccf *= (h/(h - ccf_min))[:, None]
 
-    if method != "fast":
-        mean = ccf.argmax()
+    return (ccf, h)
 
-        model = modeling.models.Gaussian1D(mean=mean, amplitude=h,
-                                           stddev=1)
-        model += modeling.models.Const1D()
 
-        fitter = modeling.fitting.LevMarLSQFitter()
+def _ccf_peaks(z_array, ccf, h):
+    """
+    Return the redshift, redshift width and height of the highest peak in each
+    of the scaled cross-correlation functions.
+    """
 
-        fit_sigma = kwargs.pop("__fit_sigma", 1.5)
-        x = np.arange(N)
-        # TODO revise this range?
-        use = (mean + 5 >= x) * (x >= mean - 5)
-        model.bounds["stddev_0"] = [0, 1.5]
-        profile = fitter(model, x[use], ccf[use])
+    peak_index = ccf.argmax(axis=1)
 
-        mean, stddev, amplitude = profile.mean_0.value, \
-            profile.stddev_0.value * np.diff(z_array)[0], \
-            profile.amplitude_0.value + profile.amplitude_1.value
+    # Estimate the width from the extent of the CCF above half the peak height
+    above = ccf >= 0.5 * h[:, None]
+    first = above.argmax(axis=1)
+    last = z_array.size - 1 - above[:, ::-1].argmax(axis=1)
+    stddev = (z_array[last] - z_array[first])/2.355
+    stddev[~np.any(above, axis=1)] = np.nan
 
-    else:
+    return (z_array[peak_index], stddev, h)
+
+
+def _ccf_functions(transform, fft_observed, rows=slice(None)):
+    """
+    Return the scaled cross-correlation functions for some templates, and the
+    height of their highest peaks.
+
+    :param transform:
+        The template transform.
+
+    :type transform:
+        :class:`TemplateTransform`
+
+    :param fft_observed:
+        The normalised real Fourier transform of the observed spectrum.
+
+    :type fft_observed:
+        :class:`numpy.array`
 
-        stddev = np.ptp(z_array[np.where(ccf >= 0.5 * h)]/2.355)
-        mean, amplitude = ccf.argmax(), h
+    :param rows: [optional]
+        The templates to cross-correlate against.
 
-    mean = np.interp(mean, np.arange(N), z_array)
+    :type rows:
+        slice or :class:`numpy.array`
+    """
+
+    return _scale_ccfs(transform.correlate(fft_observed, rows), transform.N,
+        transform.M)
+
+
+def _ccf_batch(transform, fft_observed, rows=slice(None)):
+    """
+    Calculate the cross-correlation functions for many templates at once, and
+    return the redshift, width and height of the highest peak in each.
+
+    :param transform:
+        The template transform.
+
+    :type transform:
+        :class:`TemplateTransform`
+
+    :param fft_observed:
+        The normalised real Fourier transform of the observed spectrum.
+
+    :type fft_observed:
+        :class:`numpy.array`
+
+    :param rows: [optional]
+        The templates to cross-correlate against.
+
+    :type rows:
+        slice or :class:`numpy.array`
+
+    :returns:
+        The redshift, redshift width and peak height for each template.
+    """
 
-    if index is not None:
-        return (index, mean, stddev, amplitude)
-    return (mean, stddev, amplitude)
+    if isinstance(transform, EigenTemplateTransform):
+        return transform.ccf_peaks(fft_observed, rows)
+    return _ccf_peaks(transform.z_array,
+        *_ccf_functions(transform, fft_observed, rows))
+
+
+def _ccf_block(args):
+    return _ccf_batch(*args)
+
+
+class CrossCorrelationPool(object):
+    """
+    A persistent pool of worker processes to cross-correlate observed spectra
+    against blocks of templates. Template transforms are published to shared
+    memory the first time they are used, so only their names, the observed
+    transform, and the indices of each block are sent to the workers.
+
+    :param threads:
+        The number of worker processes.
+
+    :type threads:
+        int
+    """
+
+    def __init__(self, threads):
+        self.threads = threads
+        self._pool = multiprocessing.Pool(threads)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def map(self, transform, fft_observed, blocks):
+        """
+        Cross-correlate an observed spectrum against blocks of templates.
+
+        :param transform:
+            The template transform.
+
+        :type transform:
+            :class:`TemplateTransform`
+
+        :param fft_observed:
+            The normalised real Fourier transform of the observed spectrum.
+
+        :type fft_observed:
+            :class:`numpy.array`
+
+        :param blocks:
+            The slices (or indices) of the templates in each block.
+
+        :type blocks:
+            list
+
+        :returns:
+            The redshift, redshift width and peak height for each template in
+            each block.
+        """
+
+        if self._pool is None:
+            raise ValueError("cross-correlation pool has been closed")
+
+        if not transform.shared:
+            transform.share()
+        return self._pool.map(_ccf_block,
+            [(transform, fft_observed, block) for block in blocks])
+
+
+    def close(self):
+        """ Close the pool and wait for the worker processes to exit. """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+def _fit_ccf_peak(z_array, ccf, h):
+    """
+    Fit a Gaussian profile to the highest peak of a cross-correlation function,
+    and return the redshift and redshift width of the peak.
+    """
+
+    N = z_array.size
+    mean = ccf.argmax()
+
+    model = modeling.models.Gaussian1D(mean=mean, amplitude=h,
+                                       stddev=1)
+    model += modeling.models.Const1D()
+
+    fitter = modeling.fitting.LevMarLSQFitter()
+
+    x = np.arange(N)
+    # TODO revise this range?
+    use = (mean + 5 >= x) * (x >= mean - 5)
+    model.bounds["stddev_0"] = [0, 1.5]
+    profile = fitter(model, x[use], ccf[use])
+
+    mean, stddev = profile.mean_0.value, \
+        profile.stddev_0.value * np.diff(z_array)[0]
+
+    return (np.interp(mean, x, z_array), stddev)
+
+
+def _refine_ccf_peaks(z_array, ccfs, method="gaussian", half_width=1):
+    """
+    Refine the redshift and redshift width of the highest peak in many
+    cross-correlation functions at once, with closed-form fits to the pixels
+    around each peak after the median level of each function is subtracted.
+
+    :param z_array:
+        The redshift at each pixel of the cross-correlation functions.
+
+    :type z_array:
+        :class:`numpy.array`
+
+    :param ccfs:
+        The scaled cross-correlation functions, with shape (N_ccfs, N).
+
+    :type ccfs:
+        :class:`numpy.ndarray`
+
+    :param method: [optional]
+        Fit a quadratic to the logarithm of the peak pixels, which is exact for
+        a Gaussian profile ('gaussian'), or a quadratic to the peak pixels
+        themselves ('parabolic'). Peaks with non-positive pixels fall back to
+        the parabolic fit.
+
+    :type method:
+        str
+
+    :param half_width: [optional]
+        The number of pixels either side of each peak to fit.
+
+    :type half_width:
+        int
+
+    :returns:
+        The redshift and redshift width (the Gaussian standard deviation) of
+        each peak.
+    """
+
+    if method not in ("gaussian", "parabolic"):
+        raise ValueError("peak refinement method must be 'gaussian' or "
+            "'parabolic'")
+
+    ccfs = np.atleast_2d(ccfs)
+    N_ccfs, N = ccfs.shape
+    half_width = max(1, min(int(half_width), int((N - 1)/2)))
+
+    # Keep the fitting window within the cross-correlation functions.
+    peak = np.clip(ccfs.argmax(axis=1), half_width, N - 1 - half_width)
+    offsets = np.arange(-half_width, half_width + 1)
+    y = ccfs[np.arange(N_ccfs)[:, None], peak[:, None] + offsets] \
+        - np.median(ccfs, axis=1)[:, None]
+
+    # Least-squares quadratic coefficients for every window at once.
+    design = np.vstack([offsets**2, offsets, np.ones(offsets.size)]).T
+    projection = np.linalg.pinv(design)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        a, b, c = np.dot(projection, y.T)
+        x, stddev = -b/(2 * a), np.sqrt(-c/(2 * a) + b**2/(8 * a**2))
+
+        if method == "gaussian":
+            positive = np.all(y > 0, axis=1)
+            log_a, log_b, log_c = np.dot(projection, np.log(y[positive]).T)
+            x[positive] = -log_b/(2 * log_a)
+            stddev[positive] = np.sqrt(-1./(2 * log_a))
+
+    # Peaks that are not maxima (or are poorly conditioned) keep the pixel.
+    bad = ~np.isfinite(x) | (np.abs(x) > half_width)
+    x[bad] = 0
+
+    # Match the bounds of the profile fitted by _fit_ccf_peak.
+    stddev = np.clip(np.nan_to_num(stddev), 0, 1.5)
+
+    pixels = np.arange(N)
+    return (np.interp(peak + x, pixels, z_array),
+        stddev * np.diff(z_array)[0])
+
+
+def _remeasure_peaks(z_array, ccfs, heights, method="fit"):
+    """
+    Re-measure the redshift and redshift width of the highest peak in some
+    cross-correlation functions, either by fitting a Gaussian profile to each
+    ('fit'), or with vectorised closed-form fits ('gaussian' or 'parabolic').
+    """
+
+    if method == "fit":
+        if len(ccfs) == 0:
+            return (np.zeros(0), np.zeros(0))
+        return map(np.array, zip(*[_fit_ccf_peak(z_array, ccf, h) \
+            for ccf, h in zip(ccfs, heights)]))
+    return _refine_ccf_peaks(z_array, ccfs, method)
 
 
 def cross_correlate_grid(template_dispersion, template_fluxes, observed_flux,
                          continuum_degree=4, apodize=0.10, remeasure_best=True,
-                         threads=1):
+                         threads=1, remeasure_top=1, block_size=1000,
+                         template_cache=None, cache_key=None, clusters=None,
+                         top_clusters=3, num_components=None, rows=None,
+                         peak_method="fit", pool=None):
+    """
+    Cross-correlate an observed spectrum against a grid of template spectra.
 
-    if template_dispersion.shape[0] != template_fluxes.shape[1]:
-        raise ValueError("template dispersion must have size (N_pixels,) and "\
-            "template fluxes must have size (N_models, N_pixels)")
-    try:
-        continuum_degree = int(continuum_degree + 1)
-    except (TypeError, ValueError):
-        raise TypeError("continuum order must be an integer-like object")
+    The cross-correlation functions for all templates are calculated as batched
+    array operations using real FFTs, and the redshift of the highest peaks are
+    optionally re-measured by fitting a Gaussian profile.
 
-    assert 1 > apodize >= 0, "Apodisation fraction must be between 0 and 1"
+    :param template_dispersion:
+        The dispersion points of the templates, with shape (N_pixels, ).
 
-    N = template_dispersion.size
-    N = N - 1 if N % 2 > 0 else N
-    N_models = template_fluxes.shape[0]
+    :type template_dispersion:
+        :class:`numpy.array`
 
-    dispersion = template_dispersion[:N]
-    template_flux = template_fluxes[:, :N]
+    :param template_fluxes:
+        The template fluxes, with shape (N_models, N_pixels), or a previously
+        calculated template transform.
 
-    observed_flux = observed_flux.copy()[:N]
-    non_finite = ~np.isfinite(observed_flux)
-    if non_finite.sum() > 0:
-        observed_flux[non_finite] = np.interp(dispersion[non_finite],
-            dispersion[~non_finite], observed_flux[~non_finite])
+    :type template_fluxes:
+        :class:`numpy.ndarray` or :class:`TemplateTransform`
 
-    # Normalise
-    if continuum_degree >= 1:
-        coeffs = np.polyfit(dispersion, observed_flux, continuum_degree)
-        observed_flux /= np.polyval(coeffs, dispersion)
+    :param observed_flux:
+        The observed flux on the template dispersion points.
 
-    # Scale the flux level to that the template intensities
-    observed_flux = (observed_flux * template_flux.ptp()) + template_flux.min()
+    :type observed_flux:
+        :class:`numpy.array`
 
-    # Apodize edges
-    edge_buffer = apodize * (dispersion[-1] - dispersion[0])
-    low_w_indices = np.nonzero(dispersion < dispersion[0] + edge_buffer)[0]
-    high_w_indices = np.nonzero(dispersion > dispersion[-1] - edge_buffer)[0]
+    :param continuum_degree: [optional]
+        The polynomial degree used to normalise the observed flux.
 
-    apod_curve = np.ones(N, dtype='d')
-    apod_curve[low_w_indices] = (1.0 + np.cos(np.pi*(
-        1.0 - (dispersion[low_w_indices] - dispersion[0])/edge_buffer)))/2.
-    apod_curve[high_w_indices] = (1.0 + np.cos(np.pi*(
-        1.0 - (dispersion[-1] - dispersion[high_w_indices])/edge_buffer)))/2.
+    :type continuum_degree:
+        int
 
-    apod_observed_flux = observed_flux * apod_curve
-    apod_template_flux = template_flux * apod_curve
+    :param apodize: [optional]
+        The fraction of each edge of the spectrum to apodise.
 
-    fft_observed_flux = np.fft.fft(apod_observed_flux)
-    fft_template_flux = np.fft.fft(apod_template_flux)
-    template_flux_corr = (fft_observed_flux * fft_template_flux.conjugate())
-    template_flux_corr /= np.sqrt(np.inner(apod_observed_flux, apod_observed_flux))
+    :type apodize:
+        float
+
+    :param remeasure_best: [optional]
+        Re-measure the redshift of the highest peaks by fitting a Gaussian
+        profile to the cross-correlation function.
 
-    z_array = np.array(dispersion.copy())/dispersion[N/2] - 1.0
+    :type remeasure_best:
+        bool
+
+    :param threads: [optional]
+        The number of processes to calculate the cross-correlation functions.
+
+    :type threads:
+        int
+
+    :param remeasure_top: [optional]
+        The number of highest peaks to re-measure if ``remeasure_best`` is True.
+
+    :type remeasure_top:
+        int
+
+    :param peak_method: [optional]
+        How to re-measure the highest peaks: by fitting a Gaussian profile with
+        a non-linear optimiser ('fit'), or with vectorised closed-form fits to
+        the logarithm of the peak ('gaussian') or to the peak ('parabolic').
+
+    :type peak_method:
+        str
+
+    :param block_size: [optional]
+        The maximum number of templates to calculate cross-correlation functions
+        for at once. This limits the temporary memory required.
+
+    :type block_size:
+        int
+
+    :param template_cache: [optional]
+        A cache to retrieve (or store) the template transform from.
+
+    :type template_cache:
+        :class:`TemplateCache`
+
+    :param cache_key: [optional]
+        A hashable key that uniquely describes the templates in the cache.
+
+    :param num_components: [optional]
+        Compress the templates to this many principal eigenspectra, and
+        reconstruct the cross-correlation function of each template from the
+        cross-correlation functions of the eigenspectra.
+
+    :type num_components:
+        int
+
+    :param clusters: [optional]
+        Clusters of similar templates. If given, the observed spectrum is first
+        cross-correlated against the representative of each cluster, and then
+        against all templates in the ``top_clusters`` clusters with the highest
+        peaks. Templates that were not cross-correlated have non-finite values.
+
+    :type clusters:
+        :class:`TemplateClusters`
+
+    :param top_clusters: [optional]
+        The number of clusters to search completely.
+
+    :type top_clusters:
+        int
+
+    :param rows: [optional]
+        The indices of the templates to cross-correlate against (e.g., those
+        within some prior box in parameter space). By default all templates are
+        used. Templates that were not cross-correlated have non-finite values.
+
+    :type rows:
+        :class:`numpy.array`
+
+    :param pool: [optional]
+        A persistent pool of worker processes to use instead of ``threads``.
+
+    :type pool:
+        :class:`CrossCorrelationPool`
+
+    :returns:
+        The velocity (km/s), velocity width (km/s) and peak height of the
+        cross-correlation function for each template.
+    """
+
+    if isinstance(template_fluxes, TemplateTransform):
+        transform = template_fluxes
+
+    elif template_cache is not None:
+        transform = template_cache.get(template_dispersion, template_fluxes,
+            apodize, key=cache_key, num_components=num_components)
+
+    elif num_components is not None:
+        transform = EigenTemplateTransform(template_dispersion, template_fluxes,
+            num_components, apodize)
+
+    else:
+        transform = TemplateTransform(template_dispersion, template_fluxes,
+            apodize)
+
+    N_models = transform.N_models
+    fft_observed = transform.observed_fft(observed_flux, continuum_degree)
 
     z = np.ones(N_models) * np.nan
     z_err = np.ones(N_models) * np.nan
     R = np.ones(N_models) * np.nan
 
-    if threads > 1:
-        processes = []
-        pool = multiprocessing.Pool(threads)
-        for i in xrange(N_models):
-            processes.append(pool.apply_async(_ccf, args=(z_array,
-                apod_template_flux[i, :], template_flux_corr[i, :], N, i)))
+    def evaluate(rows=None):
+        if rows is None:
+            blocks = [slice(i, i + block_size) \
+                for i in xrange(0, N_models, block_size)]
+        else:
+            blocks = [rows[i:i + block_size] \
+                for i in xrange(0, len(rows), block_size)]
 
-        for process in processes:
-            result = process.get()
-            index = result[0]
-            z[index], z_err[index], R[index] = result[1:]
+        if pool is not None and len(blocks) > 1:
+            results = pool.map(transform, fft_observed, blocks)
 
-        pool.close()
-        pool.join()
+        elif threads > 1 and len(blocks) > 1:
+            shared = transform.shared
+            with CrossCorrelationPool(threads) as temporary_pool:
+                results = temporary_pool.map(transform, fft_observed, blocks)
+            if not shared:
+                transform.unshare()
 
-    else:
-        # Thread this!
-        for i in xrange(N_models):
-            z[i], z_err[i], R[i] = _ccf(z_array, apod_template_flux[i, :],
-                template_flux_corr[i, :], N)
+        else:
+            results = map(_ccf_block,
+                [(transform, fft_observed, block) for block in blocks])
+
+        for block, (block_z, block_z_err, block_R) in zip(blocks, results):
+            z[block], z_err[block], R[block] = block_z, block_z_err, block_R
+
+    if rows is not None:
+        rows = np.unique(rows)
+
+    if clusters is None:
+        evaluate(rows)
 
+    else:
+        # Cross-correlate against the cluster representatives first, then
+        # against all members of the clusters with the highest peaks.
+        evaluate(clusters.representatives)
+        candidates = np.arange(len(clusters)) if rows is None \
+            else np.unique(clusters.labels[rows])
+        best_clusters = candidates[np.argsort(
+            -R[clusters.representatives[candidates]])[:top_clusters]]
+        members = clusters.members(best_clusters)
+        if rows is not None:
+            members = np.intersect1d(members, rows)
+        evaluate(members[~np.isfinite(R[members])])
+
+    if rows is not None:
+        # Representatives outside the given templates are not results.
+        outside = np.ones(N_models, dtype=bool)
+        outside[rows] = False
+        z[outside], z_err[outside], R[outside] = np.nan, np.nan, np.nan
 
     c = constants.c.to("km/s").value
 
-    # Should we precisely re-measure the best point?
+    # Should we precisely re-measure the best points?
     if remeasure_best:
-        best = R.argmax()
+        best = np.argsort(-R)[:remeasure_top]
+        ccfs, heights = _ccf_functions(transform, fft_observed, best)
+        z[best], z_err[best] = _remeasure_peaks(transform.z_array, ccfs,
+            heights, peak_method)
+
+    return (z * c, z_err * c, R)
+
+
+def cross_correlate_grid_many(dispersion, template_fluxes, observed_fluxes,
+    continuum_degree=4, apodize=0.10, max_memory=512 * 1024**2,
+    template_cache=None, cache_key=None, num_components=None):
+    """
+    Cross-correlate many observed spectra that share the same dispersion points
+    against a grid of template spectra. All spectra are cross-correlated
+    against all templates in Fourier space as batched array operations, in
+    blocks that are limited by the memory available.
+
+    :param dispersion:
+        The dispersion points of the templates and the observed spectra, with
+        shape (N_pixels, ).
+
+    :type dispersion:
+        :class:`numpy.array`
+
+    :param template_fluxes:
+        The template fluxes, with shape (N_models, N_pixels), or a previously
+        calculated template transform.
+
+    :type template_fluxes:
+        :class:`numpy.ndarray` or :class:`TemplateTransform`
+
+    :param observed_fluxes:
+        The observed fluxes, with shape (N_stars, N_pixels).
+
+    :type observed_fluxes:
+        :class:`numpy.ndarray`
+
+    :param continuum_degree: [optional]
+        The polynomial degree used to normalise the observed fluxes.
+
+    :type continuum_degree:
+        int
+
+    :param apodize: [optional]
+        The fraction of each edge of the spectrum to apodise.
+
+    :type apodize:
+        float
+
+    :param max_memory: [optional]
+        The approximate maximum memory (in bytes) to use for the temporary
+        cross-correlation functions of each block.
+
+    :type max_memory:
+        int
+
+    :param template_cache: [optional]
+        A cache to retrieve (or store) the template transform from.
+
+    :type template_cache:
+        :class:`TemplateCache`
 
-        b_z, b_z_err, b_R = _ccf(z_array, apod_observed_flux,
-            template_flux_corr[best, :], N, None, method="slow")
+    :param cache_key: [optional]
+        A hashable key that uniquely describes the templates in the cache.
 
-        z[best] = b_z
-        z_err[best] = b_z_err
+    :param num_components: [optional]
+        Compress the templates to this many principal eigenspectra, and
+        reconstruct the cross-correlation function of each template from the
+        cross-correlation functions of the eigenspectra.
 
+    :type num_components:
+        int
+
+    :returns:
+        The velocity (km/s), velocity width (km/s) and peak height of the
+        cross-correlation function for each star and template, each with shape
+        (N_stars, N_models).
+    """
+
+    if isinstance(template_fluxes, TemplateTransform):
+        transform = template_fluxes
+
+    elif template_cache is not None:
+        transform = template_cache.get(dispersion, template_fluxes, apodize,
+            key=cache_key, num_components=num_components)
+
+    elif num_components is not None:
+        transform = EigenTemplateTransform(dispersion, template_fluxes,
+            num_components, apodize)
+
+    else:
+        transform = TemplateTransform(dispersion, template_fluxes, apodize)
+
+    N, M, N_models = transform.N, transform.M, transform.N_models
+    fft_observed = transform.observed_ffts(observed_fluxes, continuum_degree)
+    N_stars = fft_observed.shape[0]
+
+    z = np.nan * np.ones((N_stars, N_models))
+    z_err = np.nan * np.ones((N_stars, N_models))
+    R = np.nan * np.ones((N_stars, N_models))
+
+    # Each star-template pair requires a complex product, the correlation, and
+    # the reflected and scaled cross-correlation function.
+    pairs_per_block = max(1, int(max_memory/(8 * (M + 2) + 8 * M + 9 * N)))
+    star_block_size = min(N_stars, pairs_per_block)
+    model_block_size = max(1, int(pairs_per_block/star_block_size))
+
+    for i in xrange(0, N_stars, star_block_size):
+        stars = slice(i, i + star_block_size)
+        for j in xrange(0, N_models, model_block_size):
+            models = slice(j, j + model_block_size)
+
+            correlation = transform.correlate(fft_observed[stars], models)
+            shape = correlation.shape[:2]
+
+            block = _ccf_peaks(transform.z_array, *_scale_ccfs(
+                correlation.reshape(-1, M), N, M))
+            z[stars, models], z_err[stars, models], R[stars, models] \
+                = [each.reshape(shape) for each in block]
+
+    c = constants.c.to("km/s").value
     return (z * c, z_err * c, R)
+
+
+def cross_correlate_grid_stream(template_dispersion, template_fluxes,
+    observed_flux, num_best=10, continuum_degree=4, apodize=0.10,
+    remeasure_best=True, remeasure_top=1, max_memory=256 * 1024**2,
+    flux_range=None, rows=None, peak_method="fit"):
+    """
+    Cross-correlate an observed spectrum against a grid of template spectra
+    that may be larger than the available memory. The templates are read in
+    blocks (e.g., from a memory-mapped array), and only the templates with the
+    ``num_best`` highest cross-correlation peaks are kept. The peak memory
+    required is bounded by ``max_memory``, regardless of the grid size.
+
+    :param template_dispersion:
+        The dispersion points of the templates, with shape (N_pixels, ).
+
+    :type template_dispersion:
+        :class:`numpy.array`
+
+    :param template_fluxes:
+        The template fluxes with shape (N_models, N_pixels), which may be a
+        memory-mapped array, or the filename of a saved (.npy) array which
+        will be memory-mapped.
+
+    :type template_fluxes:
+        :class:`numpy.ndarray` or str
+
+    :param observed_flux:
+        The observed flux on the template dispersion points.
+
+    :type observed_flux:
+        :class:`numpy.array`
+
+    :param num_best: [optional]
+        The number of templates with the highest peaks to return.
+
+    :type num_best:
+        int
+
+    :param continuum_degree: [optional]
+        The polynomial degree used to normalise the observed flux.
+
+    :type continuum_degree:
+        int
+
+    :param apodize: [optional]
+        The fraction of each edge of the spectrum to apodise.
+
+    :type apodize:
+        float
+
+    :param remeasure_best: [optional]
+        Re-measure the redshift of the highest peaks by fitting a Gaussian
+        profile to the cross-correlation function.
+
+    :type remeasure_best:
+        bool
+
+    :param remeasure_top: [optional]
+        The number of highest peaks to re-measure if ``remeasure_best`` is True.
+
+    :type remeasure_top:
+        int
+
+    :param peak_method: [optional]
+        How to re-measure the highest peaks: by fitting a Gaussian profile with
+        a non-linear optimiser ('fit'), or with vectorised closed-form fits to
+        the logarithm of the peak ('gaussian') or to the peak ('parabolic').
+
+    :type peak_method:
+        str
+
+    :param max_memory: [optional]
+        The approximate maximum memory (in bytes) to use for each block of
+        templates and their cross-correlation functions.
+
+    :type max_memory:
+        int
+
+    :param flux_range: [optional]
+        The minimum and peak-to-peak range of all template fluxes. If not given,
+        this requires an additional pass through the templates.
+
+    :type flux_range:
+        tuple
+
+    :param rows: [optional]
+        The indices of the templates to cross-correlate against. By default all
+        templates are used.
+
+    :type rows:
+        :class:`numpy.array`
+
+    :returns:
+        The indices of the best templates, and their velocities (km/s),
+        velocity widths (km/s) and peak heights, all ordered by decreasing
+        peak height.
+    """
+
+    if isinstance(template_fluxes, basestring):
+        template_fluxes = np.load(template_fluxes, mmap_mode="r")
+
+    N_models, N_pixels = template_fluxes.shape
+    if template_dispersion.shape[0] != N_pixels:
+        raise ValueError("template dispersion must have size (N_pixels,) "\
+            "and template fluxes must have size (N_models, N_pixels)")
+
+    N = N_pixels - 1 if N_pixels % 2 > 0 else N_pixels
+    M = _next_fast_length(N)
+
+    # Each template requires a copy of the fluxes, the apodised fluxes, the
+    # Fourier transform and its product, the correlation, and the scaled
+    # cross-correlation function.
+    block_size = max(1, int(max_memory/(8 * (4 * N + 3 * M + 4))))
+    if rows is None:
+        blocks = [slice(i, i + block_size) \
+            for i in xrange(0, N_models, block_size)]
+    else:
+        rows = np.unique(rows)
+        blocks = [rows[i:i + block_size] \
+            for i in xrange(0, rows.size, block_size)]
+
+    if flux_range is None:
+        flux_min, flux_max = np.inf, -np.inf
+        for block in blocks:
+            flux = template_fluxes[block, :N]
+            flux_min = min(flux_min, flux.min())
+            flux_max = max(flux_max, flux.max())
+        flux_range = (flux_min, flux_max - flux_min)
+
+    best = np.zeros(0, dtype=int)
+    z, z_err, R = np.zeros(0), np.zeros(0), np.zeros(0)
+
+    fft_observed = None
+    for block in blocks:
+        transform = TemplateTransform(template_dispersion,
+            np.array(template_fluxes[block]), apodize, flux_range)
+        if fft_observed is None:
+            fft_observed = transform.observed_fft(observed_flux,
+                continuum_degree)
+
+        block_z, block_z_err, block_R = _ccf_batch(transform, fft_observed)
+
+        # Keep the running best results.
+        best = np.hstack([best, np.arange(N_models)[block]])
+        z, z_err, R = [np.hstack(each) for each \
+            in ((z, block_z), (z_err, block_z_err), (R, block_R))]
+        if R.size > num_best:
+            keep = np.argpartition(-np.nan_to_num(R), num_best)[:num_best]
+            best, z, z_err, R = best[keep], z[keep], z_err[keep], R[keep]
+
+    order = np.argsort(-np.nan_to_num(R))
+    best, z, z_err, R = best[order], z[order], z_err[order], R[order]
+
+    # Should we precisely re-measure the best points?
+    if remeasure_best and best.size > 0:
+        rows = np.sort(best[:remeasure_top])
+        transform = TemplateTransform(template_dispersion,
+            np.array(template_fluxes[rows]), apodize, flux_range)
+        ccfs, heights = _ccf_functions(transform, fft_observed)
+        i = np.array([np.where(best == index)[0][0] for index in rows])
+        z[i], z_err[i] = _remeasure_peaks(transform.z_array, ccfs, heights,
+            peak_method)
+
+    c = constants.c.to("km/s").value
+    return (best, z * c, z_err * c, R)
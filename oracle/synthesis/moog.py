@@ -5,12 +5,13 @@
 from __future__ import absolute_import, print_function
 
 __author__ = "Andy Casey <arc@ast.cam.ac.uk>"
-__all__ = ["atomic_abundances", "synthesise"]
+__all__ = ["atomic_abundances", "lock", "synthesise"]
 
 import logging
 import multiprocessing
 import numpy as np
 import os
+import threading
 import warnings
 
 from astropy.table import Table
@@ -20,6 +21,10 @@ from . import _mini_moog as moog
 
 logger = logging.getLogger("oracle")
 
+# MOOG keeps its state in Fortran common blocks, so only one thread in a
+# process can use it at a time. Hold this lock while calling MOOG from threads.
+lock = threading.Lock()
+
 
 class MOOGException(BaseException):
     def __call__(self, status="MOOG fell over unexpectedly"):
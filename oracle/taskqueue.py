@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" A work queue in a shared directory, for workers on many nodes. """
+
+from __future__ import division, absolute_import, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+__all__ = ["Task", "TaskQueue", "worker_name"]
+
+# Standard library.
+import json
+import logging
+import os
+import socket
+import uuid
+from time import time
+
+logger = logging.getLogger("oracle")
+
+
+def worker_name():
+    """ Return a name for this process that is unique across nodes. """
+    return "{0}-{1}".format(socket.gethostname().split(".")[0], os.getpid())
+
+
+class Task(object):
+    """
+    A batch of sources that has been claimed from a :class:`TaskQueue`.
+
+    :ivar id:
+        The identifier of the task.
+
+    :ivar path:
+        The path of the claimed task file, whose modification time is the start
+        of the current lease.
+
+    :ivar data:
+        The task description, including the 'kind' of task, the 'sources', and
+        the number of 'attempts'.
+    """
+
+    def __init__(self, id, path, data):
+        self.id = id
+        self.path = path
+        self.data = data
+
+
+    def __repr__(self):
+        return "<oracle.taskqueue.Task {0} ({1} {2} sources)>".format(self.id,
+            len(self.data["sources"]), self.data["kind"])
+
+
+class TaskQueue(object):
+    """
+    A queue of tasks in a directory that is shared between nodes. No server is
+    required: a worker claims a task by atomically renaming its file from the
+    pending directory into the claimed directory, so each task is claimed by
+    exactly one worker.
+
+    Claimed tasks are leased. A worker renews its lease by updating the
+    modification time of the claimed file, and any worker can return tasks with
+    expired leases (e.g., from workers on nodes that died) to the queue.
+
+    :param directory:
+        The queue directory.
+
+    :type directory:
+        str
+    """
+
+    states = ("pending", "claimed", "done", "failed", "results")
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        for state in self.states:
+            path = os.path.join(directory, state)
+            if not os.path.exists(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # Another worker may have created it.
+                    if not os.path.isdir(path): raise
+
+
+    def _path(self, state, filename=""):
+        return os.path.join(self.directory, state, filename)
+
+
+    def _write(self, path, data):
+        """ Write JSON to a path such that it appears atomically. """
+
+        temporary_path = "{0}.{1}.tmp".format(path, worker_name())
+        with open(temporary_path, "w") as fp:
+            json.dump(data, fp)
+        os.rename(temporary_path, path)
+
+
+    def _tasks(self, state):
+        """ Return the filenames of the tasks in some state. """
+        return sorted([filename for filename in os.listdir(self._path(state)) \
+            if filename.endswith(".json")])
+
+
+    def put(self, sources, kind="estimate", batch_size=10, **kwargs):
+        """
+        Add sources to the queue, in batches.
+
+        :param sources:
+            The sources to add. For 'estimate' tasks each source is a list of
+            spectrum filenames.
+
+        :type sources:
+            list
+
+        :param kind: [optional]
+            The kind of task.
+
+        :type kind:
+            str
+
+        :param batch_size: [optional]
+            The number of sources in each task.
+
+        :type batch_size:
+            int
+
+        Any additional keyword arguments are stored in each task.
+
+        :returns:
+            The identifiers of the tasks that were added.
+        """
+
+        ids = []
+        for i in xrange(0, len(sources), batch_size):
+            task_id = "{0:.0f}-{1}".format(time(), uuid.uuid4().hex[:8])
+            data = kwargs.copy()
+            data.update(kind=kind, sources=sources[i:i + batch_size],
+                attempts=0, created=time())
+            self._write(self._path("pending", "{}.json".format(task_id)), data)
+            ids.append(task_id)
+
+        logger.info("Added {0} sources in {1} {2} tasks to {3}".format(
+            len(sources), len(ids), kind, self.directory))
+        return ids
+
+
+    def claim(self, worker=None):
+        """
+        Claim the next pending task.
+
+        :param worker: [optional]
+            The name of the worker claiming the task.
+
+        :type worker:
+            str
+
+        :returns:
+            The claimed :class:`Task`, or None if no tasks are pending.
+        """
+
+        worker = worker or worker_name()
+        for filename in self._tasks("pending"):
+            task_id = filename[:-len(".json")]
+            claimed_path = self._path("claimed",
+                "{0}@{1}.json".format(task_id, worker))
+
+            # Start the lease before the task is claimed, not when it was
+            # created, so that the claimed task is never already expired.
+            # Only one worker can rename the file.
+            pending_path = self._path("pending", filename)
+            try:
+                os.utime(pending_path, None)
+                os.rename(pending_path, claimed_path)
+            except OSError:
+                continue
+
+            try:
+                os.utime(claimed_path, None)
+                with open(claimed_path, "r") as fp:
+                    data = json.load(fp)
+            except (OSError, IOError):
+                # The lease expired and it was requeued in the meantime.
+                continue
+
+            logger.info("Worker {0} claimed task {1}".format(worker, task_id))
+            return Task(task_id, claimed_path, data)
+
+        return None
+
+
+    def renew(self, task):
+        """
+        Renew the lease on a claimed task.
+
+        :param task:
+            The claimed task.
+
+        :type task:
+            :class:`Task`
+        """
+        os.utime(task.path, None)
+
+
+    def complete(self, task, results_filename=None):
+        """
+        Mark a claimed task as done, and publish its results.
+
+        :param task:
+            The claimed task.
+
+        :type task:
+            :class:`Task`
+
+        :param results_filename: [optional]
+            The filename of the results, which is moved into the results
+            directory of the queue.
+
+        :type results_filename:
+            str
+        """
+
+        if results_filename is not None:
+            extension = os.path.splitext(results_filename)[1]
+            os.rename(results_filename,
+                self._path("results", task.id + extension))
+
+        data = task.data.copy()
+        data.update(completed=time())
+        self._write(self._path("done", "{}.json".format(task.id)), data)
+
+        try:
+            os.remove(task.path)
+        except OSError:
+            # The task will be run again, but the results are the same.
+            logger.warn("The lease on task {} expired before it was completed"\
+                .format(task.id))
+
+
+    def fail(self, task, error, max_attempts=3):
+        """
+        Return a claimed task that failed to the queue, or mark it as failed if
+        it has been attempted too many times.
+
+        :param task:
+            The claimed task.
+
+        :type task:
+            :class:`Task`
+
+        :param error:
+            A description of the error.
+
+        :type error:
+            str
+
+        :param max_attempts: [optional]
+            The maximum number of times to attempt a task.
+
+        :type max_attempts:
+            int
+        """
+
+        if not os.path.exists(task.path):
+            logger.warn("The lease on task {} expired before it failed".format(
+                task.id))
+            return
+        self._release(task.path, task.id, task.data, error, max_attempts)
+
+
+    def _release(self, path, task_id, data, error, max_attempts):
+
+        data = data.copy()
+        data["attempts"] = data.get("attempts", 0) + 1
+        data.setdefault("errors", []).append(error)
+
+        state = "pending" if data["attempts"] < max_attempts else "failed"
+        self._write(self._path(state, "{}.json".format(task_id)), data)
+        os.remove(path)
+
+        logger.warn("Task {0} failed on attempt {1} ({2}) and is now {3}"\
+            .format(task_id, data["attempts"], error, state))
+        return state
+
+
+    def requeue_expired(self, lease, max_attempts=3):
+        """
+        Return claimed tasks whose leases have expired to the queue.
+
+        :param lease:
+            The duration of a lease in seconds.
+
+        :type lease:
+            float
+
+        :param max_attempts: [optional]
+            The maximum number of times to attempt a task.
+
+        :type max_attempts:
+            int
+
+        :returns:
+            The identifiers of the tasks that were returned to the queue (or
+            marked as failed).
+        """
+
+        requeued = []
+        for filename in self._tasks("claimed"):
+            path = self._path("claimed", filename)
+            try:
+                expired = time() - os.path.getmtime(path) > lease
+            except OSError:
+                # It was completed or requeued in the meantime.
+                continue
+
+            if not expired: continue
+
+            # Take the task away from the worker before changing it, so that
+            # only one worker returns it to the queue.
+            task_id, worker = filename[:-len(".json")].split("@", 1)
+            requeue_path = "{0}.{1}.requeue".format(path, worker_name())
+            try:
+                os.rename(path, requeue_path)
+            except OSError:
+                continue
+
+            with open(requeue_path, "r") as fp:
+                data = json.load(fp)
+
+            self._release(requeue_path, task_id, data,
+                "lease expired for worker {}".format(worker), max_attempts)
+            requeued.append(task_id)
+
+        return requeued
+
+
+    def counts(self):
+        """ Return the number of tasks in each state. """
+        return dict([(state, len(self._tasks(state))) \
+            for state in self.states if state != "results"])
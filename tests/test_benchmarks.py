@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Test the leave-one-out photosphere interpolation benchmark. """
+
+from __future__ import division, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+import cPickle as pickle
+import os
+import tempfile
+
+import numpy as np
+
+from oracle import benchmarks
+from oracle.photospheres.interpolator import BaseInterpolator
+
+
+class _Interpolator(BaseInterpolator):
+    opacity_scale = "lgTau5"
+    logarithmic_photosphere_quantities = ["P"]
+
+
+def test_leave_one_out_methods():
+
+    teff, logg, feh = np.meshgrid([4000., 4500, 5000, 5500, 6000],
+        [1., 2, 3, 4], [-2., -1, 0], indexing="ij")
+    points = np.core.records.fromarrays([teff.flatten(), logg.flatten(),
+        feh.flatten()], names=("effective_temperature", "surface_gravity",
+        "metallicity"))
+
+    # Photospheres that are linear in the stellar parameters (and in log space
+    # for the pressure) are interpolated exactly by every linear method.
+    tau = np.linspace(-5, 1, 20)
+    photospheres = np.array([np.array([tau,
+        point[0] * (1 + 0.1 * tau) + 100 * point[2],
+        10**(4 + 0.5 * tau + 0.2 * point[1] + 0.1 * point[2])]).T \
+            for point in points])
+
+    fd, filename = tempfile.mkstemp(suffix=".pkl")
+    os.close(fd)
+    try:
+        with open(filename, "wb") as fp:
+            pickle.dump((points, photospheres, ["lgTau5", "T", "P"],
+                {"kind": "test"}), fp, -1)
+
+        benchmarks._interpolator = _Interpolator(filename,
+            live_dangerously=False)
+        benchmarks._initialise_methods(("cached-simplex", "multilinear"))
+
+        failures = {}
+        for method in ("linear", "cached-simplex", "multilinear"):
+            output = [benchmarks._leave_one_out((index, method)) \
+                for index in range(len(points))]
+            differences = np.array([each[1] for each in output])
+            failed = ~np.isfinite([each[2] for each in output])
+            assert np.allclose(differences[~failed], 0, atol=1e-8), method
+            failures[method] = failed
+
+        # Only the corners of the grid are outside the other models, but the
+        # multilinear method cannot interpolate at the edges in temperature.
+        corners = np.all([(points[name] == points[name].min()) \
+            + (points[name] == points[name].max()) \
+            for name in points.dtype.names], axis=0)
+        assert np.all(failures["linear"] == corners)
+        assert np.all(failures["cached-simplex"] == corners)
+        assert np.all(failures["multilinear"] == np.in1d(teff.flatten(),
+            (4000, 6000)))
+
+    finally:
+        benchmarks._interpolator = None
+        benchmarks._triangulation = benchmarks._regular_grid = None
+        os.remove(filename)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Test cross-correlation against a grid of synthetic templates. """
+
+from __future__ import division, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+import os
+import tempfile
+
+import numpy as np
+from oracle.specutils import cross_correlate
+
+c = 299792.458 # km/s
+
+def _synthetic_grid(N_models=50, N_lines=60, v_rad=30., seed=42):
+
+    np.random.seed(seed)
+    dispersion = np.exp(np.linspace(np.log(5000), np.log(5100), 2001))
+
+    wavelengths = np.random.uniform(5005, 5095, N_lines)
+    widths = np.random.uniform(0.05, 0.15, N_lines)
+    depths = np.random.uniform(0.1, 0.8, N_lines)
+
+    def spectrum(scale, z=0):
+        flux = np.ones(dispersion.size)
+        for wavelength, width, depth in zip(wavelengths, widths, depths):
+            flux -= scale * depth \
+                * np.exp(-0.5 * ((dispersion - wavelength * (1 + z))/width)**2)
+        return flux
+
+    scales = np.linspace(0.5, 1.0, N_models)
+    template_fluxes = np.array([spectrum(scale) for scale in scales])
+
+    best = int(N_models/2)
+    observed_flux = spectrum(scales[best], z=v_rad/c) \
+        + np.random.normal(0, 0.01, size=dispersion.size)
+    return (dispersion, template_fluxes, observed_flux, best)
+
+
+def test_cross_correlate_grid(v_rad=30.):
+
+    dispersion, template_fluxes, observed_flux, best \
+        = _synthetic_grid(v_rad=v_rad)
+
+    v, v_err, R = cross_correlate.cross_correlate_grid(dispersion,
+        template_fluxes, observed_flux)
+
+    assert v.shape == v_err.shape == R.shape == (template_fluxes.shape[0], )
+    assert np.all(np.isfinite(R))
+    assert abs(v[R.argmax()] - v_rad) < 0.5
+
+    # Blocks should not change the result.
+    blocked = cross_correlate.cross_correlate_grid(dispersion,
+        template_fluxes, observed_flux, block_size=7)
+    assert np.allclose(blocked, (v, v_err, R))
+
+
+def test_template_cache():
+
+    dispersion, template_fluxes, observed_flux, best = _synthetic_grid()
+
+    # Use an awkward number of pixels so that the templates are padded.
+    dispersion, template_fluxes, observed_flux = \
+        dispersion[:1949], template_fluxes[:, :1949], observed_flux[:1949]
+
+    directory = tempfile.mkdtemp()
+    cache = cross_correlate.TemplateCache(directory)
+    expected = cross_correlate.cross_correlate_grid(dispersion,
+        template_fluxes, observed_flux, template_cache=cache)
+    assert len(cache) == 1
+
+    transform = cache.get(dispersion, template_fluxes)
+    assert transform.M > transform.N
+
+    # Load the persisted transform in a new cache.
+    cache = cross_correlate.TemplateCache(directory)
+    v, v_err, R = cross_correlate.cross_correlate_grid(dispersion,
+        template_fluxes, observed_flux, template_cache=cache)
+    assert np.allclose((v, v_err, R), expected)
+    assert abs(v[R.argmax()] - 30.) < 0.5
+
+
+def test_hierarchical_search():
+
+    dispersion, template_fluxes, observed_flux, best = _synthetic_grid(200)
+
+    clusters = cross_correlate.cluster_templates(template_fluxes, 20, seed=0)
+    assert len(clusters) <= 20
+    assert clusters.labels.size == template_fluxes.shape[0]
+
+    v, v_err, R = cross_correlate.cross_correlate_grid(dispersion,
+        template_fluxes, observed_flux, clusters=clusters, top_clusters=2)
+
+    # Only some templates should have been cross-correlated.
+    assert template_fluxes.shape[0] > np.isfinite(R).sum() >= len(clusters)
+
+    expected = cross_correlate.cross_correlate_grid(dispersion,
+        template_fluxes, observed_flux)
+    assert np.nanargmax(R) == np.argmax(expected[2])
+    assert abs(v[np.nanargmax(R)] - 30.) < 0.5
+
+
+def test_cross_correlate_grid_many():
+
+    dispersion, template_fluxes, observed_flux, best = _synthetic_grid()
+
+    observed_fluxes = np.array([observed_flux, observed_flux[::-1],
+        template_fluxes[3]])
+    v, v_err, R = cross_correlate.cross_correlate_grid_many(dispersion,
+        template_fluxes, observed_fluxes, max_memory=1024**2)
+    assert v.shape == v_err.shape == R.shape \
+        == (observed_fluxes.shape[0], template_fluxes.shape[0])
+
+    for i, each in enumerate(observed_fluxes):
+        expected = cross_correlate.cross_correlate_grid(dispersion,
+            template_fluxes, each, remeasure_best=False)
+        assert np.allclose((v[i], v_err[i], R[i]), expected)
+
+
+def test_eigen_template_transform():
+
+    dispersion, template_fluxes, observed_flux, best = _synthetic_grid()
+
+    # With all components the compressed templates are exact.
+    v, v_err, R = cross_correlate.cross_correlate_grid(dispersion,
+        template_fluxes, observed_flux, remeasure_best=False)
+    transform = cross_correlate.EigenTemplateTransform(dispersion,
+        template_fluxes, template_fluxes.shape[0])
+    eigen_v, eigen_v_err, eigen_R = cross_correlate.cross_correlate_grid(
+        dispersion, transform, observed_flux, remeasure_best=False)
+    assert np.allclose(R, eigen_R)
+    assert np.allclose(v, eigen_v)
+
+    # With few components the same template is found.
+    compressed_v, compressed_v_err, compressed_R = \
+        cross_correlate.cross_correlate_grid(dispersion, template_fluxes,
+            observed_flux, remeasure_best=False, num_components=2)
+    assert np.nanargmax(compressed_R) == np.nanargmax(R)
+    assert np.allclose(v, compressed_v)
+
+    # Peaks found from windows of the functions match the full functions.
+    fft_observed = transform.observed_fft(observed_flux)
+    z, z_err, h = cross_correlate._ccf_peaks(transform.z_array,
+        *cross_correlate._ccf_functions(transform, fft_observed))
+    for peak_stride, rtol in ((8, 0.1), (1, 1e-5)):
+        transform.peak_stride = peak_stride
+        peaks = transform.ccf_peaks(fft_observed, np.arange(0, 50, 2))
+        assert np.all(peaks[0] == z[::2]) and np.allclose(peaks[2], h[::2])
+        assert np.allclose(peaks[1], z_err[::2], rtol=rtol)
+
+
+def test_cross_correlate_grid_stream():
+
+    dispersion, template_fluxes, observed_flux, best = _synthetic_grid()
+
+    v, v_err, R = cross_correlate.cross_correlate_grid(dispersion,
+        template_fluxes, observed_flux, remeasure_top=3)
+
+    # Stream the templates from disk in small blocks.
+    path = os.path.join(tempfile.mkdtemp(), "templates.npy")
+    np.save(path, template_fluxes)
+    indices, stream_v, stream_v_err, stream_R = \
+        cross_correlate.cross_correlate_grid_stream(dispersion, path,
+            observed_flux, num_best=5, remeasure_top=3, max_memory=1024**2)
+
+    assert indices.size == 5
+    assert np.all(indices == np.argsort(-R)[:5])
+    assert np.allclose(stream_R, R[indices])
+    assert np.allclose(stream_v, v[indices])
+
+
+def test_restricted_rows():
+
+    dispersion, template_fluxes, observed_flux, best = _synthetic_grid()
+
+    rows = np.arange(10, 20)
+    v, v_err, R = cross_correlate.cross_correlate_grid(dispersion,
+        template_fluxes, observed_flux, remeasure_best=False)
+    restricted_v, restricted_v_err, restricted_R = \
+        cross_correlate.cross_correlate_grid(dispersion, template_fluxes,
+            observed_flux, remeasure_best=False, rows=rows)
+
+    assert np.sum(np.isfinite(restricted_R)) == rows.size
+    assert np.allclose(restricted_R[rows], R[rows])
+    assert np.nanargmax(restricted_R) in rows
+
+    clusters = cross_correlate.cluster_templates(template_fluxes, 5, seed=0)
+    clustered_R = cross_correlate.cross_correlate_grid(dispersion,
+        template_fluxes, observed_flux, remeasure_best=False, rows=rows,
+        clusters=clusters)[2]
+    assert np.all(np.in1d(np.where(np.isfinite(clustered_R))[0], rows))
+
+
+def test_closed_form_peaks():
+
+    dispersion, template_fluxes, observed_flux, best = _synthetic_grid()
+
+    v, v_err, R = cross_correlate.cross_correlate_grid(dispersion,
+        template_fluxes, observed_flux, remeasure_top=5)
+    for method in ("gaussian", "parabolic"):
+        closed_v, closed_v_err, closed_R = \
+            cross_correlate.cross_correlate_grid(dispersion, template_fluxes,
+                observed_flux, remeasure_top=5, peak_method=method)
+
+        top = np.argsort(-R)[:5]
+        assert np.allclose(closed_R, R)
+        assert np.all(np.abs(closed_v[top] - v[top]) < 0.5)
+        assert np.all(np.isfinite(closed_v_err[top]))
+
+
+def test_cross_correlation_pool():
+
+    dispersion, template_fluxes, observed_flux, best = _synthetic_grid()
+
+    transform = cross_correlate.TemplateTransform(dispersion, template_fluxes)
+    expected = cross_correlate.cross_correlate_grid(dispersion, transform,
+        observed_flux, block_size=7)
+
+    with cross_correlate.CrossCorrelationPool(2) as pool:
+        for i in range(2):
+            result = cross_correlate.cross_correlate_grid(dispersion, transform,
+                observed_flux, block_size=7, pool=pool)
+            assert np.allclose(result, expected)
+        assert transform.shared
+
+    transform.unshare()
+    assert not transform.shared
+    result = cross_correlate.cross_correlate_grid(dispersion, transform,
+        observed_flux, block_size=7, threads=2)
+    assert np.allclose(result, expected)
+    assert not transform.shared
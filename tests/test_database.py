@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Test the results database. """
+
+from __future__ import division, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+import os
+import tempfile
+
+import numpy as np
+import pytest
+from oracle import database
+
+
+def test_results_database():
+
+    fd, filename = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+
+    try:
+        db = database.ResultsDatabase(filename)
+        db.insert_stars([
+            {"hash": "a", "basename": "sun", "success": True,
+                "effective_temperature": 5777., "v_rad.0": 0.1},
+            {"hash": "b", "basename": "arcturus", "success": True,
+                "effective_temperature": 4286., "v_helio": np.nan},
+            {"hash": "c", "basename": "broken", "success": False,
+                "error": "IOError: no such file"}
+        ])
+
+        db.insert_lines("a", [
+            {"wavelength": 5000.1, "species": 26.0, "log_eps": 7.5,
+                "[X/M]": 0.0, "outlier": False, "reduced_equivalent_width": -5},
+            {"wavelength": 5000.2, "species": 26.1, "log_eps": 7.4,
+                "[X/M]": -0.1, "outlier": True}
+        ])
+
+        stars = db.stars(effective_temperature=(5000, None))
+        assert [star["name"] for star in stars] == ["sun"]
+        assert stars[0]["theta"] == {"v_rad.0": 0.1}
+        assert db.stars(name="arcturus")[0]["v_helio"] is None
+        assert len(db.stars(success=False)) == 1
+
+        lines = db.lines(star="sun", species=26.0)
+        assert len(lines) == 1 and lines[0]["x_m"] == 0.0
+        assert lines[0]["extra"] == {"reduced_equivalent_width": -5}
+        assert len(db.lines(outlier=True)) == 1
+
+        # Reprocessing a star replaces its results and lines.
+        db.insert_stars([{"hash": "a", "basename": "sun", "success": True,
+            "effective_temperature": 5772.}])
+        assert len(db.stars()) == 3 and db.lines() == []
+        assert db.stars(name="sun")[0]["effective_temperature"] == 5772.
+
+        # A failed attempt and its retry can be in the same batch.
+        db.insert_stars([
+            {"hash": "d", "basename": "retry", "success": False},
+            {"hash": "d", "basename": "retry", "success": True,
+                "effective_temperature": 6000.}
+        ])
+        stars = db.stars(name="retry")
+        assert len(stars) == 1 and stars[0]["success"] == 1
+
+        with pytest.raises(ValueError):
+            db.stars(**{"1 = 1 OR name": "sun"})
+        with pytest.raises(ValueError):
+            db.lines(effective_temperature=(None, 6000))
+        db.close()
+
+    finally:
+        os.remove(filename)
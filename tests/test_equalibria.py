@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Test the equalibrium solver. """
+
+from __future__ import division, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+import threading
+
+import numpy as np
+from astropy.table import Table
+
+from oracle import photospheres
+from oracle.models import equalibria
+
+
+def _abundances(truth, calls):
+    """
+    Return a function that gives abundances in equalibrium at the true stellar
+    parameters (teff, xi, logg, [M/H]), instead of running MOOG.
+    """
+
+    def atomic_abundances(transitions, photosphere, microturbulence, **kwargs):
+        calls.append(photosphere)
+        teff, logg, metallicity = photosphere
+        rew = np.log(transitions["equivalent_width"]/transitions["wavelength"])
+        ionised = (transitions["species"] % 1) > 0
+        return photospheres.solar_abundance(transitions["species"]) \
+            + metallicity + 0.5 * (metallicity - truth[3]) \
+            + 1e-4 * (teff - truth[0]) * (transitions["excitation_potential"] \
+                - 2.5) \
+            + 0.3 * (microturbulence - truth[1]) * (rew + 4.8) \
+            + 0.5 * (logg - truth[2]) * ionised
+    return atomic_abundances
+
+
+def test_concurrent_solves():
+
+    rng = np.random.RandomState(0)
+    transitions = Table({
+        "wavelength": rng.uniform(4800, 6500, 60),
+        "species": [26.0] * 45 + [26.1] * 15,
+        "excitation_potential": rng.uniform(0, 5, 60),
+        "loggf": rng.uniform(-3, 0, 60),
+        "equivalent_width": rng.uniform(25, 110, 60)
+    })
+
+    truths = [(5200., 1.1, 3.5, -1.0), (6100., 1.5, 4.3, 0.1)]
+    calls, results = [[], []], [None, None]
+
+    def solve(i):
+        model = equalibria.BaseEqualibriumModel.__new__(
+            equalibria.BaseEqualibriumModel)
+        model._photosphere_interpolator = lambda *stellar_parameters: \
+            stellar_parameters
+        results[i] = model.estimate_stellar_parameters(transitions.copy(),
+            initial_theta=np.array([5500., 1.2, 4.0, -0.2]), clips=0,
+            transition_limits={}, atomic_abundances=_abundances(truths[i],
+                calls[i]), op_fsolve_kwargs={"fprime": None}, full_output=True)
+
+    threads = [threading.Thread(target=solve, args=(i, )) for i in (0, 1)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Each solve only sees its own samples.
+    for truth, num_calls, result in zip(truths, map(len, calls), results):
+        x, table, state, sampled_theta, sampled_state_sums, info = result
+        assert np.allclose(x, truth, rtol=1e-4)
+        assert len(sampled_theta) == len(sampled_state_sums) == num_calls
+        assert not np.any(table["outlier"])
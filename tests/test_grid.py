@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Test the parameter-space index of grid points. """
+
+from __future__ import division, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from oracle.models import grid
+
+
+def _grid_points():
+    teff, logg, feh = np.meshgrid(np.arange(4000, 6501, 250),
+        np.arange(0, 5.1, 0.5), np.arange(-2, 0.6, 0.5), indexing="ij")
+    return np.core.records.fromarrays([teff.flatten(), logg.flatten(),
+        feh.flatten()], names=("effective_temperature", "surface_gravity",
+        "metallicity"))
+
+
+def test_box():
+
+    points = _grid_points()
+    index = grid.GridIndex(points)
+
+    bounds = {
+        "effective_temperature": (4900, 5750),
+        "surface_gravity": (None, 2.5)
+    }
+    expected = np.where((points["effective_temperature"] >= 4900) \
+        * (points["effective_temperature"] <= 5750) \
+        * (points["surface_gravity"] <= 2.5))[0]
+    assert np.all(index.box(bounds) == expected)
+    assert np.all(index.box({}) == np.arange(points.size))
+
+
+def test_nearest():
+
+    points = _grid_points()
+    index = grid.GridIndex(points)
+
+    nearest = index.nearest({"effective_temperature": 5010,
+        "surface_gravity": 4.4, "metallicity": -0.1}, k=1)
+    point = points[nearest[0]]
+    assert (point["effective_temperature"], point["surface_gravity"],
+        point["metallicity"]) == (5000, 4.5, 0)
+
+
+def test_marginalised_chi_sq():
+
+    np.random.seed(0)
+    x = np.linspace(-0.5, 0.5, 500)
+    model_fluxes = 1 - np.random.uniform(0, 0.5, size=(20, 1)) \
+        * np.exp(-0.5 * ((x - np.random.uniform(-0.4, 0.4, size=(20, 1)))/0.01)**2)
+
+    design = np.vander(x, 3)
+    continuum = np.dot(design, [0.3, -0.2, 2.0])
+    ivariance = np.ones(x.size)/0.01**2
+    flux = model_fluxes[7] * continuum \
+        + np.random.normal(0, 0.01, size=x.size)
+
+    chi_sqs, log_likelihoods = grid.marginalised_chi_sq(flux, ivariance,
+        model_fluxes, design, block_size=6)
+
+    # Compare to an explicit weighted least-squares fit for every model.
+    for model_flux, chi_sq in zip(model_fluxes, chi_sqs):
+        A = model_flux[:, None] * design
+        coefficients = np.linalg.lstsq(A, flux)[0]
+        expected = np.sum((flux - np.dot(A, coefficients))**2 * ivariance)
+        assert np.allclose(chi_sq, expected)
+
+    assert grid.posterior(log_likelihoods).argmax() == 7
+
+    # Models whose continuum cannot be determined are excluded.
+    model_fluxes[3] = 0
+    chi_sqs, log_likelihoods = grid.marginalised_chi_sq(flux, ivariance,
+        model_fluxes, design, block_size=6)
+    assert np.isinf(chi_sqs[3]) and log_likelihoods[3] == -np.inf
+    assert np.sum(np.isfinite(chi_sqs)) == 19
+    assert grid.posterior(log_likelihoods).argmax() == 7
+
+    # As are all models, if there are fewer pixels than coefficients.
+    ivariance[2:] = 0
+    chi_sqs, log_likelihoods = grid.marginalised_chi_sq(flux, ivariance,
+        model_fluxes, design)
+    assert np.all(np.isinf(chi_sqs))
+
+
+def test_store():
+
+    points = _grid_points()
+    dispersion = np.linspace(5000, 5100, 50)
+    fluxes = np.random.uniform(0.5, 1, size=(points.size, dispersion.size))
+
+    directory = tempfile.mkdtemp()
+    try:
+        grid.write(directory, points, dispersion, fluxes, block_size=100)
+        loaded_points, loaded_dispersion, loaded_fluxes = grid.load(directory)
+
+        assert np.all(loaded_points == points)
+        assert np.allclose(loaded_dispersion, dispersion)
+        assert loaded_fluxes.shape == fluxes.shape
+        assert np.allclose(loaded_fluxes, fluxes)
+
+        # Stored by wavelength, so a range of pixels is contiguous on disk.
+        assert loaded_fluxes[:, 10:20].T.flags["C_CONTIGUOUS"]
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_view():
+
+    grid_dispersion = np.linspace(4990, 5110, 1201)
+    dispersion = np.sort(np.random.uniform(5000, 5100, 800))
+    flux = np.random.uniform(0.5, 1, size=dispersion.size)
+
+    view = grid.GridView(grid_dispersion, dispersion)
+    expected = np.interp(view.dispersion, dispersion, flux, left=np.nan,
+        right=np.nan)
+    assert np.allclose(view.rebin(flux), expected, equal_nan=True)
+
+    # Pixels outside the channel are masked, in addition to the given mask.
+    mask = np.zeros(view.dispersion.size, dtype=bool)
+    mask[5:10] = True
+    view.add_mask("test", mask)
+    assert view.masked("test") == (mask, (0, None))
+
+    finite = np.ones(mask.size, dtype=bool)
+    finite[:3] = False
+    masked, (left, right) = view.masked("test", finite)
+    assert left == 3 and right is None
+    assert np.all(masked[:3]) and not np.any(masked[3:5])
+    assert view.design(2).shape == (view.dispersion.size, 3)
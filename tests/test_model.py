@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Test the initial guess of model parameters on a synthetic grid. """
+
+from __future__ import division, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+import cPickle as pickle
+import shutil
+import tempfile
+
+import numpy as np
+from scipy import optimize as op
+
+import oracle
+from oracle.models import grid, model
+
+
+def _spectrum(point, dispersion, lines, z=0):
+    centres, sensitivity = lines
+    depth = 0.3 * (1 + sensitivity * (point[0] - 5250)/1500.) \
+        * 10**(0.2 * point[2]) * (1 + 0.1 * sensitivity * (point[1] - 3))
+    return 1 - np.sum(depth * np.exp(-0.5 * \
+        ((dispersion[:, None] - centres * (1 + z))/0.15)**2), axis=1)
+
+
+def _grid(directory, seed=0):
+
+    rng = np.random.RandomState(seed)
+    teff, logg, feh = np.meshgrid([4500., 5000, 5500, 6000], [2., 4.],
+        [-1., 0.], indexing="ij")
+    points = np.core.records.fromarrays([teff.flatten(), logg.flatten(),
+        feh.flatten()], names=("effective_temperature", "surface_gravity",
+        "metallicity"))
+    dispersion = np.linspace(5000, 5100, 2000)
+    lines = (rng.uniform(5005, 5095, 40), rng.uniform(-1, 1, 40))
+
+    grid.write(directory, points, dispersion,
+        np.array([_spectrum(point, dispersion, lines) for point in points]))
+    return (points, lines)
+
+
+def _observed(point, lines, v_rad=20, seed=1, ranges=((5010, 5090), )):
+
+    rng = np.random.RandomState(seed)
+    data = []
+    for start, end in ranges:
+        x = np.linspace(start, end, 20 * (end - start))
+        flux = (100 + 0.2 * (x - start)) * _spectrum(point, x, lines,
+            z=v_rad/299792.458) + rng.normal(0, 0.5, x.size)
+        data.append(oracle.specutils.Spectrum1D(x, flux,
+            0.25 * np.ones(x.size)))
+    return data
+
+
+def _assert_close(theta, expected):
+    assert set(theta.keys()) == set(expected.keys())
+    for key, value in expected.items():
+        assert np.isclose(theta[key], value, rtol=1e-6, atol=1e-6), key
+
+
+def test_grid_views_are_bounded():
+
+    directory = tempfile.mkdtemp()
+    try:
+        _grid(directory)
+        model = oracle.models.Model({"model": {}, "settings": {"threads": 1,
+            "grid_views": 2}})
+        model._loaded_grid = model._load_grid(directory)
+        model._grid_filename = directory
+
+        # Every star has slightly different dispersion points.
+        views = [model.grid_view(np.linspace(5010 + i/10., 5090, 1500)) \
+            for i in range(3)]
+        assert len(model._grid_views) == 2
+        assert views[0].key not in model._grid_views
+
+        # The most recently used views are kept.
+        assert model.grid_view(np.linspace(5010.2, 5090, 1500)) is views[2]
+        assert model.grid_view(np.linspace(5010.1, 5090, 1500)) is views[1]
+
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_channel_threads():
+
+    directory = tempfile.mkdtemp()
+    try:
+        points, lines = _grid(directory)
+        data = _observed(points[9], lines,
+            ranges=((5010, 5040), (5040, 5065), (5065, 5090)))
+
+        for method in ("fast", "slow"):
+            model = oracle.models.Model({"model": {"redshift": True,
+                "continuum": 1}, "settings": {"threads": 1}})
+            serial = model.initial_theta(data, method=method,
+                grid_filename=directory, channel_threads=1)
+
+            # A new model, so that the views are created by the threads too.
+            model = oracle.models.Model({"model": {"redshift": True,
+                "continuum": 1}, "settings": {"threads": 1}})
+            concurrent = model.initial_theta(data, method=method,
+                grid_filename=directory, channel_threads=3)
+
+            assert serial == concurrent
+
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_prior_box_and_grid_likelihood():
+
+    directory = tempfile.mkdtemp()
+    try:
+        points, lines = _grid(directory)
+        data = _observed(points[9], lines)
+        model = oracle.models.Model({"model": {"redshift": True,
+            "continuum": 1}, "settings": {"threads": 1,
+            "grid_likelihood": True}})
+
+        theta, disp, flux, likelihood = model.initial_theta(data,
+            full_output=True, grid_info=True, grid_filename=directory)
+        assert theta["effective_temperature"] == points[9][0]
+        assert theta["surface_gravity"] == points[9][1]
+        assert theta["metallicity"] == points[9][2]
+        assert abs(theta["v_rad"] - 20) < 1
+        assert likelihood["posterior"].argmax() == 9
+        assert np.isclose(likelihood["posterior"].sum(), 1)
+
+        # The grid likelihood is only returned when it is asked for.
+        box = {"effective_temperature": (4400, 5100), "metallicity": (-1, 0)}
+        theta, disp, flux = model.initial_theta(data, full_output=True,
+            prior_box=box)
+        assert 4400 <= theta["effective_temperature"] <= 5100
+        assert disp.size == flux.size
+
+        theta, likelihood = model.initial_theta(data, prior_box=box,
+            grid_info=True)
+        outside = points["effective_temperature"] > 5100
+        assert 4400 <= theta["effective_temperature"] <= 5100
+        assert np.all(likelihood["posterior"][outside] == 0)
+        assert np.all(np.isinf(likelihood["chi_sq"][outside]))
+
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_fit_continuum():
+
+    rng = np.random.RandomState(2)
+    disp = np.linspace(5010, 5090, 1600)
+    lines = (rng.uniform(5010, 5090, 30), np.zeros(30))
+    synthetic_flux = _spectrum((5250, 3, 0), disp, lines)
+
+    for degree in (1, 2):
+        continuum = np.polyval([1e-3, 0.2, 100][-degree - 1:], disp - 5050)
+        flux = continuum * synthetic_flux + rng.normal(0, 0.5, disp.size)
+
+        # The Nelder-Mead search that the linear solution replaced.
+        chi_sq = lambda p: np.sum((np.polyval(p, disp) * synthetic_flux \
+            - flux)**2)
+        p0 = np.polyfit(disp, flux/synthetic_flux, degree + 1)
+        expected = op.fmin(chi_sq, p0, disp=False)
+
+        coefficients, use = model._fit_continuum(
+            np.vander(disp, degree + 2), synthetic_flux, flux)
+        assert np.all(use)
+        assert chi_sq(coefficients) <= chi_sq(expected) * (1 + 1e-9)
+        assert np.allclose(np.polyval(coefficients, disp),
+            np.polyval(expected, disp), rtol=1e-4)
+
+    # Sigma-clipping rejects outliers, and recovers the continuum without them.
+    flux[800:820] += 30
+    unclipped = model._fit_continuum(np.vander(disp, 4), synthetic_flux,
+        flux)[0]
+    coefficients, use = model._fit_continuum(np.vander(disp, 4),
+        synthetic_flux, flux, sigma_clip=5)
+    assert not np.any(use[800:820]) and use.sum() > 0.98 * disp.size
+    assert np.abs(np.polyval(coefficients, disp) - continuum).max() \
+        < np.abs(np.polyval(unclipped, disp) - continuum).max()
+
+
+def test_streamed_grid():
+
+    directory = tempfile.mkdtemp()
+    try:
+        points, lines = _grid(directory)
+        data = _observed(points[9], lines)
+        config = {"model": {"redshift": True, "continuum": 1},
+            "settings": {"threads": 1}}
+        expected = oracle.models.Model(config).initial_theta(data,
+            grid_filename=directory)
+
+        # Stream the templates a few at a time.
+        config["settings"]["template_max_memory"] = 100000
+        streamed = oracle.models.Model(config).initial_theta(data,
+            grid_filename=directory)
+        _assert_close(streamed, expected)
+
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_pickled_memory_mapped_grid():
+
+    directory = tempfile.mkdtemp()
+    try:
+        points, lines = _grid(directory)
+        data = _observed(points[9], lines)
+        model = oracle.models.Model({"model": {"redshift": True,
+            "continuum": 1}, "settings": {"threads": 1}})
+        expected = model.initial_theta(data, grid_filename=directory)
+        assert isinstance(model._loaded_grid[2], np.memmap)
+
+        # A pickled model loads the memory-mapped grid again by its filename.
+        unpickled = pickle.loads(pickle.dumps(model, -1))
+        assert unpickled._grid_filename == directory
+        assert not hasattr(unpickled, "_loaded_grid")
+        _assert_close(unpickled.initial_theta(data), expected)
+        assert isinstance(unpickled._loaded_grid[2], np.memmap)
+
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_cross_correlation_settings():
+
+    directory = tempfile.mkdtemp()
+    try:
+        points, lines = _grid(directory)
+        data = _observed(points[9], lines)
+        config = {"model": {"redshift": True, "continuum": 1},
+            "settings": {"threads": 1}}
+        expected = oracle.models.Model(config).initial_theta(data,
+            grid_filename=directory)
+
+        for settings in ({"template_clusters": 8, "top_template_clusters": 2},
+            {"template_components": 8}, {"ccf_peak_method": "gaussian"},
+            {"ccf_peak_method": "parabolic"}, {"threads": 2}):
+
+            config["settings"] = {"threads": 1}
+            config["settings"].update(settings)
+            model = oracle.models.Model(config)
+            if "template_clusters" in settings:
+                # Choose the same initial cluster centres every time.
+                model.cluster_grid(settings["template_clusters"],
+                    filename=directory, seed=0)
+            try:
+                theta = model.initial_theta(data, grid_filename=directory)
+            finally:
+                model.close_pool()
+
+            for parameter in points.dtype.names:
+                assert theta[parameter] == expected[parameter], settings
+            assert abs(theta["v_rad"] - expected["v_rad"]) < 1, settings
+
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Test the MOOG-friendly photosphere writer. """
+
+from __future__ import division, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+import os
+import shutil
+import tempfile
+from textwrap import dedent
+
+import numpy as np
+
+from oracle.photospheres import Photosphere, write_moog
+from oracle.photospheres import photosphere as photosphere_module
+
+
+def _row_by_row(photosphere):
+    """
+    Format a photosphere for MOOG one row at a time, exactly as the writer did
+    before it was vectorised.
+    """
+
+    parameters = photosphere.meta["stellar_parameters"]
+    xi = parameters.get("microturbulence", 0.0)
+
+    if photosphere.meta["kind"] == "marcs":
+        output = dedent("""
+            WEBMARCS
+             ORACLE 1D MARCS (2011) TEFF/LOGG/[M/H]/XI {1:.0f}/{2:.3f}/{3:.3f}/{4:.3f}
+            NTAU       {0:.0f}
+            5000.0
+            """.format(len(photosphere), parameters["effective_temperature"],
+                parameters["surface_gravity"], parameters["metallicity"],
+                xi)).lstrip()
+
+        for i, line in enumerate(photosphere):
+            output += " {0:>3.0f} {0:>3.0f} {1:10.3e} {0:>3.0f} {2:10.3e} "\
+                "{3:10.3e} {4:10.3e}\n".format(i + 1, line["lgTau5"],
+                    line["T"], line["Pe"], line["Pg"])
+
+    else:
+        output = dedent("""
+            KURUCZ
+             ORACLE 1D CASTELLI/KURUCZ (2004) TEFF/LOGG/[M/H]/[alpha/M]/XI {1:.0f}/{2:.3f}/{3:.3f}/{4:.3f}/{5:.3f}
+            NTAU       {0:.0f}
+            """.format(len(photosphere), parameters["effective_temperature"],
+                parameters["surface_gravity"], parameters["metallicity"],
+                parameters["alpha_enhancement"], xi)).lstrip()
+
+        for line in photosphere:
+            output += " {0:.8e} {1:10.3e}{2:10.3e}{3:10.3e}{4:10.3e}\n".format(
+                line["RHOX"], line["T"], line["P"], line["XNE"],
+                line["ABROSS"])
+
+    output += "         {0:.3f}\n".format(xi)
+    output += "NATOMS        0     {0:.3f}\n".format(parameters["metallicity"])
+    output += "NMOL          0\n"
+    return output
+
+
+def _photospheres(N=12):
+
+    rng = np.random.RandomState(28)
+    depth = np.linspace(-5, 1.5, N)
+    parameters = {
+        "effective_temperature": 5777.,
+        "surface_gravity": 4.438,
+        "metallicity": -0.25,
+        "microturbulence": 1.07,
+        "alpha_enhancement": 0.1
+    }
+
+    marcs = Photosphere(
+        data=[depth, 4000 + 3000 * rng.rand(N), 10**rng.uniform(-3, 3, N),
+            -10**rng.uniform(-1, 6, N)],
+        names=("lgTau5", "T", "Pe", "Pg"),
+        meta={"kind": "marcs", "stellar_parameters": parameters.copy()})
+
+    kurucz = Photosphere(
+        data=[10**depth, 4000 + 3000 * rng.rand(N), 10**rng.uniform(-1, 6, N),
+            10**rng.uniform(9, 15, N), 10**rng.uniform(-4, 2, N)],
+        names=("RHOX", "T", "P", "XNE", "ABROSS"),
+        meta={"kind": "castelli/kurucz",
+            "stellar_parameters": parameters.copy()})
+
+    return (marcs, kurucz)
+
+
+def test_moog_format():
+
+    for photosphere in _photospheres():
+        assert photosphere_module._moog_format(photosphere) \
+            == _row_by_row(photosphere)
+
+
+def test_write_moog():
+
+    photospheres = _photospheres()
+    expected = map(_row_by_row, photospheres)
+    folder = tempfile.mkdtemp()
+
+    try:
+        filenames = [os.path.join(folder, "{}.moog".format(i)) \
+            for i in range(len(photospheres))]
+        assert write_moog(photospheres, filenames=filenames) == 2
+
+        for filename, contents in zip(filenames, expected):
+            with open(filename, "r") as fp:
+                assert fp.read() == contents
+
+        archive = os.path.join(folder, "archive.moog")
+        assert write_moog(iter(photospheres), archive=archive) == 2
+        with open(archive, "r") as fp:
+            assert fp.read() == "".join(expected)
+
+    finally:
+        shutil.rmtree(folder)
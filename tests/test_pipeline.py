@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Test the concurrent analysis pipeline. """
+
+from __future__ import division, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+import threading
+
+import pytest
+from oracle import pipeline
+
+# Set when two items are being loaded at once.
+_loading = [0, threading.Lock(), threading.Event()]
+
+
+def _load(x):
+    lock, concurrent = _loading[1:]
+    with lock:
+        _loading[0] += 1
+        if _loading[0] == 2:
+            concurrent.set()
+
+    # Wait for another item to be loaded at the same time.
+    concurrent.wait(10)
+    with lock:
+        _loading[0] -= 1
+    return x
+
+
+def _square(x):
+    if x == 3:
+        raise ValueError("three")
+    return x**2
+
+
+def test_pipeline():
+
+    stages = [
+        pipeline.Stage("load", _load, workers=2),
+        pipeline.Stage("square", _square, workers=2, processes=True),
+        pipeline.Stage("increment", lambda x: x + 1)
+    ]
+
+    results = pipeline.Pipeline(stages, max_queued=2).map(range(10))
+
+    assert [result.index for result in results] == range(10)
+    assert [result.value for result in results if result.success] \
+        == [x**2 + 1 for x in range(10) if x != 3]
+
+    # Failures are recorded and skip the remaining stages.
+    assert results[3].stage == "square" and "three" in results[3].error
+    assert "increment" not in results[3].timings
+    assert set(results[0].timings) == set(["load", "square", "increment"])
+
+    # Items are loaded concurrently.
+    assert _loading[2].is_set()
+
+
+def test_pipeline_items_raise():
+
+    def items():
+        for x in range(3):
+            yield x
+        raise IOError("no more items")
+
+    stages = [pipeline.Stage("increment", lambda x: x + 1, workers=2)]
+    results = []
+    with pytest.raises(IOError):
+        for result in pipeline.Pipeline(stages).run(items()):
+            results.append(result.value)
+
+    # The items before the exception are still processed.
+    assert sorted(results) == [1, 2, 3]
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Test the results table and manifest for runs over many sources. """
+
+from __future__ import division, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+import csv
+import os
+import shutil
+import tempfile
+
+from oracle import results
+
+
+def test_csv_table():
+
+    fd, filename = tempfile.mkstemp(suffix=".csv")
+    os.close(fd)
+
+    try:
+        # Failures before the first success are held back until the columns
+        # are known.
+        with results.CSVTable(filename, ("index", "success", "error")) as table:
+            table.write({"index": 1, "success": False, "error": "IOError"})
+            table.write({"index": 2, "success": True, "teff": 5777, "logg": 4.4})
+            table.write({"index": 3, "success": True, "teff": 4000})
+
+        with open(filename, "r") as fp:
+            rows = list(csv.DictReader(fp))
+
+        assert [row["index"] for row in rows] == ["1", "2", "3"]
+        assert rows[0]["error"] == "IOError" and rows[0]["teff"] == ""
+        assert rows[1]["logg"] == "4.4" and rows[2]["logg"] == ""
+
+    finally:
+        os.remove(filename)
+
+
+def test_resume_csv_table():
+
+    fd, filename = tempfile.mkstemp(suffix=".csv")
+    os.close(fd)
+
+    columns = ("index", "success", "error")
+    try:
+        with results.CSVTable(filename, columns) as table:
+            table.write({"index": 1, "success": False, "error": "IOError"})
+
+        # The first success in a resumed table of failures widens the columns.
+        with results.CSVTable(filename, columns, append=True) as table:
+            assert table.write({"index": 1, "success": True, "teff": 5777}) == 2
+            table.write({"index": 2, "success": True, "teff": 4000, "x": 1})
+
+        with open(filename, "r") as fp:
+            rows = list(csv.DictReader(fp))
+
+        assert [row["teff"] for row in rows] == ["", "5777", "4000"]
+        assert rows[0]["error"] == "IOError"
+        assert [row["x"] for row in rows] == ["", "", "1"]
+
+    finally:
+        os.remove(filename)
+
+
+def test_csv_table_with_more_columns():
+
+    fd, filename = tempfile.mkstemp(suffix=".csv")
+    os.close(fd)
+
+    try:
+        # Stars with more channels have more columns.
+        with results.CSVTable(filename, ("index", "success", "error")) as table:
+            table.write({"index": 1, "success": True, "v_rad.0": 10.})
+            table.write({"index": 2, "success": True, "v_rad.0": 11.,
+                "v_rad.1": 12.})
+            table.write({"index": 3, "success": False, "error": "IOError"})
+            table.write({"index": 4, "success": True, "v_rad.0": 13.,
+                "v_rad.1": 14., "v_rad.2": 15.})
+
+        with open(filename, "r") as fp:
+            rows = list(csv.DictReader(fp))
+
+        assert [row["index"] for row in rows] == ["1", "2", "3", "4"]
+        assert [row["v_rad.1"] for row in rows] == ["", "12.0", "", "14.0"]
+        assert [row["v_rad.2"] for row in rows] == ["", "", "", "15.0"]
+        assert not os.path.exists("{}.tmp".format(filename))
+
+    finally:
+        os.remove(filename)
+
+
+def test_manifest():
+
+    directory = tempfile.mkdtemp()
+    source = os.path.join(directory, "source.txt")
+    filename = os.path.join(directory, "run.manifest")
+    with open(source, "w") as fp:
+        fp.write("5000 1.0\n")
+
+    try:
+        digest = results.Manifest.hash([source])
+        with results.Manifest(filename) as manifest:
+            assert manifest.pending([source], digest)
+            manifest.record([source], digest, False, error="ValueError")
+            manifest.record([source], digest, False, error="ValueError")
+
+        # Failed sources are retried until the maximum number of attempts.
+        with results.Manifest(filename) as manifest:
+            assert manifest.pending([source], digest, max_attempts=3)
+            assert not manifest.pending([source], digest, max_attempts=2)
+            manifest.record([source], digest, True, row=1)
+
+        with results.Manifest(filename) as manifest:
+            assert not manifest.pending([source], digest)
+            assert manifest.entries[manifest.key([source])]["row"] == 1
+
+            # Sources are run again if their inputs change.
+            with open(source, "a") as fp:
+                fp.write("5001 1.0\n")
+            assert manifest.pending([source], manifest.hash([source]))
+
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Test the local analysis server. """
+
+from __future__ import division, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+import json
+import shutil
+import tempfile
+import threading
+import urllib2
+
+import numpy as np
+
+import oracle
+from oracle import server
+from oracle.models import grid
+
+
+def _spectrum(point, dispersion, centres, z=0):
+    depth = 0.5 * np.exp(-point[0]/5000.) * 10**(0.3 * point[2]) \
+        * (1 + 0.05 * point[1])
+    return 1 - np.sum(depth * np.exp(-0.5 * \
+        ((dispersion[:, None] - centres * (1 + z))/0.1)**2), axis=1)
+
+
+def test_server():
+
+    rng = np.random.RandomState(0)
+    teff, logg, feh = np.meshgrid([4500., 5000, 5500, 6000], [2., 4.],
+        [-1., 0.], indexing="ij")
+    points = np.core.records.fromarrays([teff.flatten(), logg.flatten(),
+        feh.flatten()], names=("effective_temperature", "surface_gravity",
+        "metallicity"))
+    dispersion = np.linspace(5000, 5100, 2000)
+    centres = rng.uniform(5005, 5095, 40)
+
+    directory = tempfile.mkdtemp()
+    grid.write(directory, points, dispersion,
+        np.array([_spectrum(point, dispersion, centres) for point in points]))
+
+    model = oracle.models.Model({"model": {"redshift": True, "continuum": 1},
+        "settings": {"threads": 1}})
+    httpd = server._ThreadingHTTPServer(("127.0.0.1", 0),
+        server._RequestHandler)
+    httpd.analyst = server.Analyst(model, grid_filename=directory)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://{0}:{1}".format(*httpd.server_address)
+
+    try:
+        x = np.linspace(5010, 5090, 1500)
+        flux = 100 * _spectrum(points[9], x, centres, z=20/299792.458) \
+            + rng.normal(0, 0.5, x.size)
+        request = json.dumps({"spectra": [{"disp": x.tolist(),
+            "flux": flux.tolist(), "variance": [0.25] * x.size}]})
+
+        # Requests at the same time share the model.
+        responses = [None, None]
+        def estimate(i):
+            responses[i] = json.load(urllib2.urlopen(url + "/estimate",
+                request))
+        threads = [threading.Thread(target=estimate, args=(i, )) \
+            for i in (0, 1)]
+        for each in threads:
+            each.start()
+        for each in threads:
+            each.join()
+
+        assert responses[0]["theta"] == responses[1]["theta"]
+        theta = responses[0]["theta"]
+        assert theta["effective_temperature"] in teff
+        assert np.isfinite(theta["v_rad"])
+
+        status = json.load(urllib2.urlopen(url + "/status"))
+        assert status["requests"] == 2 and status["grid"] == directory
+
+        try:
+            urllib2.urlopen(url + "/unknown")
+        except urllib2.HTTPError as e:
+            assert e.code == 404
+        else:
+            raise AssertionError("expected a 404 response")
+
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        model.close_pool()
+        shutil.rmtree(directory)
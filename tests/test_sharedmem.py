@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Make sure shared arrays are only pickled by name. """
+
+from __future__ import division, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+import cPickle as pickle
+import shutil
+import tempfile
+
+import numpy as np
+from oracle import models, sharedmem
+from oracle.models import grid
+
+
+def test_pickled_by_name():
+
+    array = np.random.uniform(size=(100, 1000))
+    shared = sharedmem.publish("test-pickled-by-name", array)
+
+    try:
+        serialised = pickle.dumps(shared, -1)
+        assert len(serialised) < 1000
+        assert np.all(pickle.loads(serialised) == array)
+
+        # Slices cannot be attached by name, so they should be copied.
+        sliced = pickle.loads(pickle.dumps(shared[10:20], -1))
+        assert np.all(sliced == array[10:20])
+
+    finally:
+        sharedmem.unlink("test-pickled-by-name")
+
+
+def test_shared_model_grid():
+
+    points = np.core.records.fromarrays([[5000., 6000.], [4., 4.], [0., 0.]],
+        names=("effective_temperature", "surface_gravity", "metallicity"))
+    dispersion = np.linspace(5000, 5100, 100)
+
+    directory = tempfile.mkdtemp()
+    try:
+        grid.write(directory, points, dispersion,
+            np.random.uniform(0.5, 1, size=(2, 100)))
+        model = models.Model({"settings": {"threads": 1}})
+        model.share_grid("test-shared-model-grid", filename=directory)
+
+        # Workers need the filename to key their caches by grid.
+        worker_model = pickle.loads(pickle.dumps(model, -1))
+        assert worker_model._grid_filename == directory
+        assert np.all(worker_model._loaded_grid[1] == dispersion)
+
+    finally:
+        for suffix in ("points", "dispersion", "fluxes"):
+            sharedmem.unlink("test-shared-model-grid-{}".format(suffix))
+        shutil.rmtree(directory)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Test the work queue in a shared directory. """
+
+from __future__ import division, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+import os
+import shutil
+import tempfile
+
+from oracle import taskqueue
+
+
+def test_task_queue():
+
+    directory = tempfile.mkdtemp()
+    try:
+        queue = taskqueue.TaskQueue(directory)
+        queue.put([["a.fits"], ["b.fits"], ["c.fits"]], batch_size=2)
+        assert queue.counts()["pending"] == 2
+
+        # Each task can only be claimed once.
+        first, second = queue.claim("one"), queue.claim("two")
+        assert first.id != second.id and queue.claim("three") is None
+        assert len(first.data["sources"]) + len(second.data["sources"]) == 3
+
+        # Expired leases are returned to the queue, until they fail too often.
+        os.utime(first.path, (0, 0))
+        assert queue.requeue_expired(lease=60, max_attempts=2) == [first.id]
+        assert queue.requeue_expired(lease=60, max_attempts=2) == []
+
+        again = queue.claim("three")
+        assert again.id == first.id and again.data["attempts"] == 1
+        queue.fail(again, "ValueError: bad", max_attempts=2)
+
+        queue.complete(second)
+        assert queue.counts() == {"pending": 0, "claimed": 0, "done": 1,
+            "failed": 1}
+
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_claim_old_task_while_requeueing(monkeypatch):
+
+    directory = tempfile.mkdtemp()
+    try:
+        queue = taskqueue.TaskQueue(directory)
+        task_id, = queue.put([["a.fits"]])
+        pending, = os.listdir(os.path.join(directory, "pending"))
+        os.utime(os.path.join(directory, "pending", pending), (0, 0))
+
+        # Another worker looks for expired leases as soon as the task is
+        # claimed, before the claiming worker has read it.
+        rename, requeued = os.rename, []
+        def rename_then_requeue(source, destination):
+            rename(source, destination)
+            if os.path.basename(os.path.dirname(destination)) == "claimed":
+                requeued.extend(queue.requeue_expired(lease=60))
+        monkeypatch.setattr(taskqueue.os, "rename", rename_then_requeue)
+
+        task = queue.claim("one")
+        assert task.id == task_id and task.data["attempts"] == 0
+        assert requeued == [] and queue.claim("two") is None
+        assert queue.counts()["claimed"] == 1
+
+    finally:
+        shutil.rmtree(directory)